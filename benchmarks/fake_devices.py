@@ -0,0 +1,92 @@
+# devices that need no /dev/input or /dev/uinput
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+import libevdev
+
+from evdev_transformer.device import (
+    DestinationDevice,
+    ReplaySourceDevice,
+)
+
+from .streams import Record
+
+class _RecordStream:
+    # in memory stand-in for RecordingReader
+    def __init__(self, details: Dict, records: List[Record], loop: bool):
+        self.details = details
+        self._records = records
+        self._loop = loop
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def records(self) -> Iterable[Record]:
+        if not self._loop:
+            yield from self._records
+            return
+        # repeated with the timestamps continuing after the previous round
+        first_sec, first_usec, *_ = self._records[0]
+        last_sec, last_usec, *_ = self._records[-1]
+        period = (last_sec - first_sec) * 1_000_000 + last_usec - first_usec
+        frames = sum(1 for record in self._records if record[2] == libevdev.EV_SYN.value)
+        # one more frame interval between the rounds
+        period += period // max(1, frames - 1)
+        offset = 0
+        while True:
+            for sec, usec, type_, code, value in self._records:
+                shifted_sec, shifted_usec = divmod(sec * 1_000_000 + usec + offset, 1_000_000)
+                yield shifted_sec, shifted_usec, type_, code, value
+            offset += period
+
+    def close(self):
+        return
+
+class FakeSourceDevice(ReplaySourceDevice):
+    @classmethod
+    def from_stream(
+        cls,
+        descriptor: Dict,
+        records: List[Record],
+        speed: float = 0.0,
+        identifier: Optional[Dict] = None,
+        loop: bool = False,
+    ) -> 'FakeSourceDevice':
+        return cls(
+            _RecordStream(descriptor, records, loop),
+            identifier or {'synthetic': descriptor['name']},
+            speed,
+        )
+
+    def input_frames(self) -> List[List[libevdev.InputEvent]]:
+        # prebuilt events for driving _handle_event directly
+        frames: List[List[libevdev.InputEvent]] = [[]]
+        for sec, usec, type_, code, value in self._device.records():
+            event_code = self._lookup_event_code(type_, code)
+            frames[-1].append(libevdev.InputEvent(event_code, value, sec, usec))
+            if type_ == libevdev.EV_SYN.value:
+                frames.append([])
+        return [frame for frame in frames if frame]
+
+class FakeDestinationDevice(DestinationDevice):
+    def _create_device(self):
+        class _FakeDevice:
+            def __init__(self):
+                self.frames = 0
+                self.events = 0
+            def send_events(self, events: List[libevdev.InputEvent]):
+                self.frames += 1
+                self.events += len(events)
+        return _FakeDevice()
+
+    @property
+    def sent_frames(self) -> int:
+        return self._device.frames
+
+    @property
+    def sent_events(self) -> int:
+        return self._device.events
@@ -0,0 +1,78 @@
+# python -m benchmarks.hid_report_encoding [--frames N] [--keyboard-report boot|nkro]
+import time
+import argparse
+from typing import (
+    List,
+)
+
+import libevdev
+
+from evdev_transformer.device import HidGadgetDestinationDevice
+
+def _syn() -> libevdev.InputEvent:
+    return libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0)
+
+def _key_frames() -> List[List[libevdev.InputEvent]]:
+    frames = []
+    for name in ['KEY_A', 'KEY_LEFTSHIFT', 'KEY_SPACE', 'KEY_ENTER']:
+        code = libevdev.evbit(name)
+        frames.append([libevdev.InputEvent(code, 1), _syn()])
+        frames.append([libevdev.InputEvent(code, 0), _syn()])
+    return frames
+
+def _chord_frames() -> List[List[libevdev.InputEvent]]:
+    codes = [libevdev.evbit(f'KEY_{c}') for c in 'QWERTYUIOP']
+    return [
+        [libevdev.InputEvent(code, 1) for code in codes] + [_syn()],
+        [libevdev.InputEvent(code, 0) for code in codes] + [_syn()],
+    ]
+
+def _mouse_frames() -> List[List[libevdev.InputEvent]]:
+    return [
+        [
+            libevdev.InputEvent(libevdev.EV_REL.REL_X, 3),
+            libevdev.InputEvent(libevdev.EV_REL.REL_Y, -2),
+            _syn(),
+        ],
+        [
+            libevdev.InputEvent(libevdev.EV_REL.REL_WHEEL, 1),
+            libevdev.InputEvent(libevdev.EV_REL.REL_WHEEL_HI_RES, 120),
+            _syn(),
+        ],
+    ]
+
+def _run(device, name: str, frames: List[List[libevdev.InputEvent]], count: int):
+    event_count = sum(len(frame) for frame in frames) * (count // len(frames))
+    start = time.perf_counter()
+    for _ in range(count // len(frames)):
+        for frame in frames:
+            device.send_events(frame)
+    elapsed = time.perf_counter() - start
+    print(
+        f'{name:8} {count / elapsed:12.0f} frames/s'
+        f' {elapsed / event_count * 1e9:8.0f} ns/event'
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='HID gadget report encoding throughput')
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--keyboard-report', choices=['boot', 'nkro'], default='boot')
+    parser.add_argument('--device', type=str, default='/dev/null')
+    args = parser.parse_args()
+
+    device = HidGadgetDestinationDevice(
+        'benchmark',
+        {'bustype': 0, 'vendor': 0, 'product': 0, 'version': 0},
+        {},
+        {},
+        {},
+        [],
+        {'device': args.device, 'keyboard_report': args.keyboard_report},
+    )
+    _run(device, 'keys', _key_frames(), args.frames)
+    _run(device, 'chords', _chord_frames(), args.frames)
+    _run(device, 'mouse', _mouse_frames(), args.frames)
+    device.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# python -m benchmarks.pipeline [--frames N] [--scenario NAME] [--save-baseline PATH] [--compare PATH]
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import libevdev
+
+from evdev_transformer.config import (
+    Activator,
+    Transform,
+)
+from evdev_transformer.device import (
+    DestinationDevice,
+    HidGadgetDestinationDevice,
+)
+from evdev_transformer.metrics import LatencyHistogram
+from evdev_transformer.transform import EventTransform
+from evdev_transformer import log
+
+from . import streams
+from .fake_devices import (
+    FakeDestinationDevice,
+    FakeSourceDevice,
+)
+
+_KEY_REMAP = {
+    'type': 'key_remap',
+    'properties': {'mapping': {'KEY_CAPSLOCK': 'KEY_ESC', 'KEY_RIGHTCTRL': 'KEY_BACKSPACE'}},
+}
+_DROP_MSC = {'type': 'filter', 'properties': {'drop': ['EV_MSC']}}
+_TOUCHPAD = {'type': 'touchpad', 'properties': {}}
+_HOTKEY = {'type': 'hotkey', 'properties': {'hotkey': {'key': 'KEY_F12', 'modifiers': ['KEY_LEFTCTRL']}}}
+
+class _Scenario:
+    def __init__(
+        self,
+        name: str,
+        stream: Callable[[int], Tuple[Dict, List[streams.Record]]],
+        transforms: List[Dict],
+        destination: str,
+    ):
+        self.name = name
+        self.stream = stream
+        self.transforms = transforms
+        self.destination = destination
+
+_SCENARIOS = [
+    _Scenario('keyboard', streams.keyboard, [_KEY_REMAP], 'fake'),
+    _Scenario('keyboard_hid', streams.keyboard, [_KEY_REMAP, _DROP_MSC], 'hid'),
+    _Scenario('mouse_1k', lambda n: streams.mouse(n, 1000.0), [], 'fake'),
+    _Scenario('mouse_8k', lambda n: streams.mouse(n, 8000.0), [_DROP_MSC], 'fake'),
+    _Scenario('mouse_8k_hid', lambda n: streams.mouse(n, 8000.0), [_DROP_MSC], 'hid'),
+    _Scenario('multitouch', streams.multitouch, [], 'fake'),
+    _Scenario('multitouch_touchpad', streams.multitouch, [_TOUCHPAD], 'fake'),
+    _Scenario('multitouch_hid', streams.multitouch, [_DROP_MSC], 'hid'),
+]
+
+def _create_pipeline(
+    scenario: _Scenario,
+    frames: int,
+) -> Tuple[FakeSourceDevice, DestinationDevice, List[List[libevdev.InputEvent]]]:
+    descriptor, records = scenario.stream(frames)
+    source_device = FakeSourceDevice.from_stream(descriptor, records)
+    transforms = [
+        EventTransform.from_config(Transform.from_dict(t), source_device.absinfo)
+        for t in scenario.transforms
+    ]
+    source_device.set_transforms(transforms)
+    # a hotkey that never matches, its check runs for every event
+    source_device.set_activators([(Activator.from_dict(_HOTKEY), lambda: None)])
+    destination_device: DestinationDevice
+    if scenario.destination == 'hid':
+        destination_device = HidGadgetDestinationDevice.create(source_device, {'device': os.devnull}, transforms)
+    else:
+        destination_device = FakeDestinationDevice.create(source_device, {}, transforms)
+    return source_device, destination_device, source_device.input_frames()
+
+def _forward(
+    source_device: FakeSourceDevice,
+    destination_device: DestinationDevice,
+    frames: List[List[libevdev.InputEvent]],
+):
+    handle_event = source_device._handle_event
+    send_events = destination_device.send_events
+    for frame in frames:
+        for event in frame:
+            for events in handle_event(event):
+                send_events(events)
+
+def _forward_timed(
+    source_device: FakeSourceDevice,
+    destination_device: DestinationDevice,
+    frames: List[List[libevdev.InputEvent]],
+    histogram: LatencyHistogram,
+):
+    handle_event = source_device._handle_event
+    send_events = destination_device.send_events
+    perf_counter_ns = time.perf_counter_ns
+    for frame in frames:
+        start_time = perf_counter_ns()
+        for event in frame:
+            for events in handle_event(event):
+                send_events(events)
+        histogram.record(perf_counter_ns() - start_time)
+
+def _run_scenario(scenario: _Scenario, frame_count: int) -> Dict:
+    source_device, destination_device, frames = _create_pipeline(scenario, frame_count)
+    event_count = sum(len(frame) for frame in frames)
+    # warm up caches and lazily built tables
+    _forward(source_device, destination_device, frames[:1000])
+
+    gc.collect()
+    allocated_blocks = sys.getallocatedblocks()
+    start_time = time.perf_counter()
+    _forward(source_device, destination_device, frames)
+    elapsed = time.perf_counter() - start_time
+    gc.collect()
+    # blocks still allocated afterwards, growth points to a leak
+    retained_blocks = sys.getallocatedblocks() - allocated_blocks
+
+    histogram = LatencyHistogram()
+    _forward_timed(source_device, destination_device, frames, histogram)
+
+    tracemalloc.start()
+    _forward(source_device, destination_device, frames)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    destination_device.close()
+
+    return {
+        'frames': len(frames),
+        'events': event_count,
+        'frames_per_s': len(frames) / elapsed,
+        'ns_per_event': elapsed / event_count * 1e9,
+        'p50_ns': histogram.percentile(50),
+        'p99_ns': histogram.percentile(99),
+        'p999_ns': histogram.percentile(99.9),
+        'max_ns': histogram.max,
+        'retained_blocks_per_frame': retained_blocks / len(frames),
+        'peak_traced_kib': peak_memory / 1024,
+    }
+
+def _print_result(name: str, result: Dict):
+    print(
+        f'{name:20}'
+        f' {result["frames_per_s"]:10.0f} frames/s'
+        f' {result["ns_per_event"]:6.0f} ns/event'
+        f' p50 {result["p50_ns"] / 1000:7.1f} us'
+        f' p99 {result["p99_ns"] / 1000:7.1f} us'
+        f' p99.9 {result["p999_ns"] / 1000:7.1f} us'
+        f' {result["retained_blocks_per_frame"]:6.3f} blocks/frame'
+        f' {result["peak_traced_kib"]:8.1f} KiB peak'
+    )
+
+def _compare(results: Dict[str, Dict], baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        baseline_result = baseline['results'].get(name)
+        if baseline_result is None:
+            continue
+        if result['frames_per_s'] < baseline_result['frames_per_s'] * (1 - threshold):
+            regressions.append(
+                f'{name}: {result["frames_per_s"]:.0f} frames/s, '
+                f'baseline {baseline_result["frames_per_s"]:.0f}'
+            )
+        if result['p99_ns'] > baseline_result['p99_ns'] * (1 + threshold):
+            regressions.append(
+                f'{name}: p99 {result["p99_ns"] / 1000:.1f} us, '
+                f'baseline {baseline_result["p99_ns"] / 1000:.1f} us'
+            )
+        # new per frame allocations that are never freed
+        if result['retained_blocks_per_frame'] > baseline_result['retained_blocks_per_frame'] + 0.01:
+            regressions.append(
+                f'{name}: {result["retained_blocks_per_frame"]:.3f} retained blocks/frame, '
+                f'baseline {baseline_result["retained_blocks_per_frame"]:.3f}'
+            )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Forwarding pipeline benchmarks with synthetic devices')
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--scenario', type=str, action='append',
+                        choices=[s.name for s in _SCENARIOS],
+                        help='Run only these scenarios, can be repeated')
+    parser.add_argument('--save-baseline', type=str, help='Write the results to a JSON file')
+    parser.add_argument('--compare', type=str, help='Compare with a baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative change in frames/s or p99 reported as a regression')
+    args = parser.parse_args()
+    log.init('benchmark', 'WARNING')
+
+    baseline: Optional[Dict] = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results: Dict[str, Dict] = {}
+    for scenario in _SCENARIOS:
+        if args.scenario and scenario.name not in args.scenario:
+            continue
+        results[scenario.name] = _run_scenario(scenario, args.frames)
+        _print_result(scenario.name, results[scenario.name])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'frames': args.frames,
+                'results': results,
+            }, f, indent=4)
+    exit_code = 0
+    if baseline is not None:
+        regressions = _compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        exit_code = 1 if regressions else 0
+    sys.exit(exit_code)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# synthetic device descriptors and event streams in the recording format,
+# see evdev_transformer.recording
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+import libevdev
+
+# sec, usec, type, code, value
+Record = Tuple[int, int, int, int, int]
+
+_START_TIME = 1_700_000_000_000_000
+
+def _code(name: str) -> Tuple[int, int]:
+    code = libevdev.evbit(name)
+    return code.type.value, code.value
+
+def _descriptor(
+    name: str,
+    product: int,
+    codes: List[str],
+    absinfo: Dict[str, Tuple[int, int, int]],
+    properties: List[str],
+) -> Dict:
+    evbits: Dict[int, List[int]] = {}
+    for code_name in codes + ['SYN_REPORT']:
+        type_, code = _code(code_name)
+        evbits.setdefault(type_, []).append(code)
+    return {
+        'type': 'SyntheticDevice',
+        'name': name,
+        'id': {'bustype': 3, 'vendor': 0x1209, 'product': product, 'version': 1},
+        'evbits': evbits,
+        'absinfo': {
+            _code(code_name)[1]: {
+                'minimum': minimum,
+                'maximum': maximum,
+                'fuzz': 0,
+                'flat': 0,
+                'resolution': resolution,
+                'value': 0,
+            }
+            for code_name, (minimum, maximum, resolution) in absinfo.items()
+        },
+        'rep_value': {0: 250, 1: 33} if any(c.startswith('KEY_') for c in codes) else {},
+        'properties': [libevdev.propbit(p).value for p in properties],
+    }
+
+class _StreamWriter:
+    def __init__(self, rate: float):
+        self._interval = round(1_000_000 / rate)
+        self._time = _START_TIME
+        self.records: List[Record] = []
+
+    def frame(self, *events: Tuple[str, int]):
+        sec, usec = divmod(self._time, 1_000_000)
+        for name, value in events:
+            self.records.append((sec, usec, *_code(name), value))
+        self.records.append((sec, usec, *_code('SYN_REPORT'), 0))
+        self._time += self._interval
+
+_KEYBOARD_TEXT = 'the quick brown fox jumps over the lazy dog '
+
+HOTKEY = ('KEY_F12', ['KEY_LEFTCTRL'])
+
+def keyboard(
+    frames: int,
+    rate: float = 20.0,
+    hotkey_interval: int = 0,
+) -> Tuple[Dict, List[Record]]:
+    keys = [f'KEY_{c.upper()}' if c != ' ' else 'KEY_SPACE' for c in _KEYBOARD_TEXT]
+    # includes keys that the benchmark transforms remap
+    keys += ['KEY_CAPSLOCK', 'KEY_LEFTSHIFT', 'KEY_RIGHTCTRL']
+    hotkey, modifiers = HOTKEY
+    descriptor = _descriptor(
+        'Synthetic Keyboard',
+        1,
+        sorted(set(keys) | {hotkey, *modifiers}) + ['MSC_SCAN'],
+        {},
+        [],
+    )
+    writer = _StreamWriter(rate)
+    for i in range(frames // 2):
+        if hotkey_interval and i % hotkey_interval == hotkey_interval - 1:
+            # switches the link when the hotkey is used as an activator
+            writer.frame(*((m, 1) for m in modifiers))
+            writer.frame((hotkey, 1))
+            writer.frame((hotkey, 0))
+            writer.frame(*((m, 0) for m in modifiers))
+            continue
+        key = keys[i % len(keys)]
+        scan_code = 0x70000 + _code(key)[1]
+        writer.frame(('MSC_SCAN', scan_code), (key, 1))
+        writer.frame(('MSC_SCAN', scan_code), (key, 0))
+    return descriptor, writer.records
+
+def mouse(frames: int, rate: float = 1000.0) -> Tuple[Dict, List[Record]]:
+    descriptor = _descriptor(
+        'Synthetic Mouse',
+        2,
+        [
+            'BTN_LEFT', 'BTN_RIGHT', 'BTN_MIDDLE',
+            'REL_X', 'REL_Y', 'REL_WHEEL', 'REL_WHEEL_HI_RES',
+            'MSC_TIMESTAMP',
+        ],
+        {},
+        [],
+    )
+    writer = _StreamWriter(rate)
+    for i in range(frames):
+        if i % 500 == 250:
+            writer.frame(('BTN_LEFT', 1))
+        elif i % 500 == 260:
+            writer.frame(('BTN_LEFT', 0))
+        elif i % 100 == 50:
+            writer.frame(('REL_WHEEL', -1), ('REL_WHEEL_HI_RES', -120))
+        else:
+            # circles, high rate mice mostly report one axis changes of 1
+            writer.frame(('REL_X', (i // 8) % 3 - 1), ('REL_Y', (i // 11) % 3 - 1))
+    return descriptor, writer.records
+
+def multitouch(frames: int, rate: float = 90.0) -> Tuple[Dict, List[Record]]:
+    descriptor = _descriptor(
+        'Synthetic Touchpad',
+        3,
+        [
+            'BTN_LEFT', 'BTN_TOUCH', 'BTN_TOOL_FINGER', 'BTN_TOOL_DOUBLETAP',
+            'ABS_X', 'ABS_Y',
+            'ABS_MT_SLOT', 'ABS_MT_TRACKING_ID', 'ABS_MT_POSITION_X', 'ABS_MT_POSITION_Y',
+            'MSC_TIMESTAMP',
+        ],
+        {
+            'ABS_X': (-3678, 3934, 38),
+            'ABS_Y': (-2478, 2587, 42),
+            'ABS_MT_SLOT': (0, 15, 0),
+            'ABS_MT_TRACKING_ID': (0, 65535, 0),
+            'ABS_MT_POSITION_X': (-3678, 3934, 38),
+            'ABS_MT_POSITION_Y': (-2478, 2587, 42),
+        },
+        ['INPUT_PROP_POINTER', 'INPUT_PROP_BUTTONPAD'],
+    )
+    writer = _StreamWriter(rate)
+    tracking_id = 0
+    i = 0
+    # alternating one finger pointer motion and two finger scroll gestures
+    while i < frames:
+        two_fingers = (tracking_id // 2) % 2 == 1
+        tracking_id += 1
+        writer.frame(
+            ('ABS_MT_SLOT', 0),
+            ('ABS_MT_TRACKING_ID', tracking_id),
+            ('ABS_MT_POSITION_X', 0),
+            ('ABS_MT_POSITION_Y', 0),
+            *([
+                ('ABS_MT_SLOT', 1),
+                ('ABS_MT_TRACKING_ID', tracking_id + 10000),
+                ('ABS_MT_POSITION_X', 800),
+                ('ABS_MT_POSITION_Y', 0),
+            ] if two_fingers else []),
+            ('BTN_TOUCH', 1),
+            ('BTN_TOOL_DOUBLETAP' if two_fingers else 'BTN_TOOL_FINGER', 1),
+            ('ABS_X', 0),
+            ('ABS_Y', 0),
+        )
+        i += 1
+        for step in range(1, 60):
+            position = step * 10
+            writer.frame(
+                ('ABS_MT_SLOT', 0),
+                ('ABS_MT_POSITION_X', position),
+                ('ABS_MT_POSITION_Y', position // 2),
+                *([
+                    ('ABS_MT_SLOT', 1),
+                    ('ABS_MT_POSITION_X', 800 + position),
+                    ('ABS_MT_POSITION_Y', position // 2),
+                ] if two_fingers else []),
+                ('ABS_X', position),
+                ('ABS_Y', position // 2),
+                ('MSC_TIMESTAMP', step * 11000),
+            )
+            i += 1
+        writer.frame(
+            ('ABS_MT_SLOT', 0),
+            ('ABS_MT_TRACKING_ID', -1),
+            *([
+                ('ABS_MT_SLOT', 1),
+                ('ABS_MT_TRACKING_ID', -1),
+            ] if two_fingers else []),
+            ('BTN_TOUCH', 0),
+            ('BTN_TOOL_DOUBLETAP' if two_fingers else 'BTN_TOOL_FINGER', 0),
+        )
+        i += 1
+    return descriptor, writer.records
@@ -0,0 +1,419 @@
+# python -m benchmarks.stress [--keyboards N] [--mice N] [--touchpads N] [--mouse-rate HZ]
+#     [--sources fake|uinput] [--destination hid|subprocess] [--duration S] [--interval S]
+#     [--reconnect-interval S] [--reconnect-mode remove|replace] [--output PATH]
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+import libevdev
+
+from evdev_transformer.config import ConfigManager
+from evdev_transformer.device import (
+    EvdevSourceDevice,
+    SourceDevice,
+    UinputDestinationDevice,
+)
+from evdev_transformer.hub import Hub
+from evdev_transformer import log
+
+from . import streams
+from .fake_devices import FakeSourceDevice
+
+_TRANSFORMS = {
+    'keyboard': [{'type': 'key_remap', 'properties': {'mapping': {'KEY_CAPSLOCK': 'KEY_ESC'}}}],
+    'mouse': [{'type': 'filter', 'properties': {'drop': ['EV_MSC']}}],
+    'touchpad': [{'type': 'touchpad', 'properties': {}}],
+}
+_DESTINATIONS = {
+    'hid': {'type': 'hid_gadget', 'properties': {'device': os.devnull}},
+    'subprocess': {'type': 'subprocess', 'properties': {'command': 'cat > /dev/null'}},
+}
+_HOTKEY = {
+    'type': 'hotkey',
+    'properties': {'hotkey': {'key': streams.HOTKEY[0], 'modifiers': streams.HOTKEY[1]}},
+}
+
+# growth after the warm up that is reported as a leak
+_RSS_MIB_PER_HOUR = 5.0
+_BLOCKS_PER_HOUR = 50000.0
+_LATENCY_DRIFT = 2.0
+
+class _SourceSpec:
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        group: int,
+        stream: Tuple[Dict, List[streams.Record]],
+    ):
+        self.name = name
+        self.kind = kind
+        self.group = group
+        self.descriptor, self.records = stream
+        # matched by the evdev_udev source of the generated config
+        self.identifier = {'EVDEV_TRANSFORMER_STRESS': name}
+        frames = sum(1 for record in self.records if record[2] == libevdev.EV_SYN.value)
+        first_sec, first_usec, *_ = self.records[0]
+        last_sec, last_usec, *_ = self.records[-1]
+        period = (last_sec - first_sec) + (last_usec - first_usec) / 1_000_000
+        self.frame_rate = (frames - 1) / period
+
+def _create_specs(args: argparse.Namespace) -> List[_SourceSpec]:
+    groups = max(1, args.keyboards)
+    specs = [
+        _SourceSpec(
+            f'stress keyboard {i}',
+            'keyboard',
+            i,
+            streams.keyboard(2000, hotkey_interval=args.hotkey_interval),
+        )
+        for i in range(args.keyboards)
+    ]
+    specs += [
+        _SourceSpec(
+            f'stress mouse {i}',
+            'mouse',
+            i % groups,
+            # ten seconds that are looped
+            streams.mouse(int(args.mouse_rate * 10), args.mouse_rate),
+        )
+        for i in range(args.mice)
+    ]
+    specs += [
+        _SourceSpec(f'stress touchpad {i}', 'touchpad', i % groups, streams.multitouch(900))
+        for i in range(args.touchpads)
+    ]
+    return specs
+
+def _create_config(specs: List[_SourceSpec], destination_type: str) -> Dict:
+    groups = sorted({s.group for s in specs})
+    return {
+        'config_version': 1,
+        'sources': [
+            {
+                'name': s.name,
+                'type': 'evdev_udev',
+                'transforms': _TRANSFORMS[s.kind],
+                'properties': {'udev': s.identifier},
+            }
+            for s in specs
+        ],
+        'source_groups': [
+            {'name': f'stress group {g}', 'sources': [s.name for s in specs if s.group == g]}
+            for g in groups
+        ],
+        # the keyboard hotkey of a group switches between its two links
+        'destinations': [
+            {'name': f'stress group {g} {side}', 'transforms': [], **_DESTINATIONS[destination_type]}
+            for g in groups
+            for side in ['a', 'b']
+        ],
+        'links': [
+            {'source_group': f'stress group {g}', 'destination': f'stress group {g} {side}', 'activators': [_HOTKEY]}
+            for g in groups
+            for side in ['a', 'b']
+        ],
+        'settings': {'latency_metrics': True},
+    }
+
+def _feed(source_device: SourceDevice, uinput_device: UinputDestinationDevice):
+    for events in source_device.events():
+        uinput_device.send_events(events)
+
+def _create_source_device(spec: _SourceSpec, source_type: str) -> SourceDevice:
+    fake_device = FakeSourceDevice.from_stream(
+        spec.descriptor,
+        spec.records,
+        speed=1.0,
+        identifier=spec.identifier,
+        loop=True,
+    )
+    if source_type == 'fake':
+        return fake_device
+    # a kernel device in between, as with real hardware
+    uinput_device = UinputDestinationDevice.create(fake_device)
+    for _ in range(100):
+        try:
+            device = libevdev.Device(open(uinput_device.devnode, 'rb'))
+            break
+        except (FileNotFoundError, PermissionError):
+            # udev may not have created the node yet
+            time.sleep(0.01)
+    else:
+        raise RuntimeError(f'cannot open {uinput_device.devnode}')
+    # the desktop session must not see the synthetic input
+    device.grab()
+    threading.Thread(target=_feed, args=(fake_device, uinput_device)).start()
+    return EvdevSourceDevice(device, spec.identifier)
+
+def _read_rss() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+class _Sampler:
+    def __init__(self, hub: Hub, expected_frame_rate: float):
+        self._hub = hub
+        self._expected_frame_rate = expected_frame_rate
+        self._start_time = time.monotonic()
+        self._last_time = self._start_time
+        self._last_cpu_time = self._get_cpu_time()
+        self._last_totals: Dict[str, int] = {}
+        # counters of replaced source devices, without keeping the devices alive
+        self._retired_totals: Dict[str, int] = {}
+        self.source_devices: List[SourceDevice] = []
+
+    def sample(self) -> Dict:
+        now = time.monotonic()
+        cpu_time = self._get_cpu_time()
+        elapsed = now - self._last_time
+        cpu_percent = (cpu_time - self._last_cpu_time) / elapsed * 100
+        self._last_time, self._last_cpu_time = now, cpu_time
+
+        totals = self._get_totals()
+        deltas = {name: value - self._last_totals.get(name, 0) for name, value in totals.items()}
+        self._last_totals = totals
+
+        latency = self._hub.get_latency_metrics()
+        self._hub.reset_latency_metrics()
+        hub = self._hub
+        with hub._lock:
+            container_sizes = {
+                'hub_source_devices': len(hub._source_devices),
+                'hub_device_pairs': len(hub._source_device_destination_device_pairs),
+                'hub_destination_devices': len(hub._link_destination_device_cache),
+            }
+        return {
+            'time': now - self._start_time,
+            'cpu_percent': cpu_percent,
+            'rss_mib': _read_rss() / 1024 / 1024,
+            'threads': threading.active_count(),
+            'allocated_blocks': sys.getallocatedblocks(),
+            **container_sizes,
+            'expected_frames_per_s': self._expected_frame_rate,
+            'frames_in_per_s': deltas['source_frames_in'] / elapsed,
+            'frames_sent_per_s': deltas['destination_frames_out'] / elapsed,
+            'frames_dropped': deltas['source_frames_dropped'],
+            'syn_dropped': deltas['source_syn_dropped'],
+            'dropped_reports': deltas['destination_dropped_reports'],
+            'queue_depth': totals['destination_queue_depth'],
+            # for synthetic sources the kernel timestamp is the intended
+            # replay time, so this is how far behind the hub is
+            'lag_p99_us': self._max_percentile(latency, 'kernel_to_handle', 'p99') / 1000,
+            'total_p99_us': self._max_percentile(latency, 'total', 'p99') / 1000,
+            'total_max_us': self._max_percentile(latency, 'total', 'max') / 1000,
+        }
+
+    def replace_source_device(self, old_device: SourceDevice, new_device: SourceDevice):
+        for name, value in self._get_source_totals([old_device]).items():
+            self._retired_totals[name] = self._retired_totals.get(name, 0) + value
+        self.source_devices[self.source_devices.index(old_device)] = new_device
+
+    def _get_source_totals(self, source_devices: List[SourceDevice]) -> Dict[str, int]:
+        totals = {
+            'source_frames_in': 0,
+            'source_frames_dropped': 0,
+            'source_syn_dropped': 0,
+        }
+        for source_device in source_devices:
+            stats = source_device.stats
+            totals['source_frames_in'] += stats['frames_in']
+            totals['source_frames_dropped'] += stats['frames_dropped']
+            totals['source_syn_dropped'] += stats.get('syn_dropped', 0)
+        return totals
+
+    def _get_totals(self) -> Dict[str, int]:
+        totals = {
+            **self._get_source_totals(self.source_devices),
+            'destination_frames_out': 0,
+            'destination_dropped_reports': 0,
+            'destination_queue_depth': 0,
+        }
+        for name, value in self._retired_totals.items():
+            totals[name] += value
+        with self._hub._lock:
+            destination_devices = [d for _, _, d in self._hub._link_destination_device_cache]
+        for destination_device in destination_devices:
+            stats = destination_device.stats
+            totals['destination_frames_out'] += stats['frames_out']
+            totals['destination_dropped_reports'] += stats.get('dropped_reports', 0)
+            totals['destination_queue_depth'] += stats.get('queue_depth', 0)
+        return totals
+
+    @staticmethod
+    def _get_cpu_time() -> float:
+        times = os.times()
+        return times.user + times.system
+
+    @staticmethod
+    def _max_percentile(latency: Dict[str, Dict], stage: str, key: str) -> int:
+        return max((stages[stage][key] for stages in latency.values() if stages[stage]['count']), default=0)
+
+def _slope_per_hour(samples: List[Dict], key: str) -> float:
+    # least squares fit over the samples
+    times = [s['time'] for s in samples]
+    values = [s[key] for s in samples]
+    mean_time = sum(times) / len(times)
+    mean_value = sum(values) / len(values)
+    variance = sum((t - mean_time) ** 2 for t in times)
+    if not variance:
+        return 0.0
+    covariance = sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values))
+    return covariance / variance * 3600
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+def _find_problems(samples: List[Dict], source_count: int) -> List[str]:
+    problems = []
+    if len(samples) < 3:
+        return problems
+    rss_slope = _slope_per_hour(samples, 'rss_mib')
+    if rss_slope > _RSS_MIB_PER_HOUR:
+        problems.append(f'RSS grows by {rss_slope:.1f} MiB/h')
+    blocks_slope = _slope_per_hour(samples, 'allocated_blocks')
+    if blocks_slope > _BLOCKS_PER_HOUR:
+        problems.append(f'allocated blocks grow by {blocks_slope:.0f}/h')
+    third = max(1, len(samples) // 3)
+    # replaced devices may briefly overlap with their forwarding threads
+    first_threads = max(s['threads'] for s in samples[:third])
+    last_threads = min(s['threads'] for s in samples[-third:])
+    if last_threads > first_threads:
+        problems.append(f'threads grew from {first_threads} to {last_threads}')
+    for key in ['hub_source_devices', 'hub_device_pairs']:
+        if max(s[key] for s in samples) > source_count:
+            problems.append(f'{key} reached {max(s[key] for s in samples)} for {source_count} sources')
+    # two destinations per group, created once per source and destination
+    destination_limit = 2 * source_count
+    if max(s['hub_destination_devices'] for s in samples) > destination_limit:
+        problems.append(f'hub_destination_devices exceeds {destination_limit}')
+    for key in ['lag_p99_us', 'total_p99_us']:
+        first, last = _median([s[key] for s in samples[:third]]), _median([s[key] for s in samples[-third:]])
+        if first and last > first * _LATENCY_DRIFT:
+            problems.append(f'{key} drifted from {first:.0f} to {last:.0f} us')
+    for key in ['syn_dropped', 'dropped_reports']:
+        total = sum(s[key] for s in samples)
+        if total:
+            problems.append(f'{total} {key}')
+    behind = _median([s['expected_frames_per_s'] - s['frames_in_per_s'] for s in samples[-third:]])
+    if behind > samples[-1]['expected_frames_per_s'] * 0.01:
+        problems.append(f'sources fall behind by {behind:.0f} frames/s')
+    return problems
+
+def _print_sample(sample: Dict):
+    print(
+        f'{sample["time"]:8.0f} s'
+        f' cpu {sample["cpu_percent"]:5.1f}%'
+        f' rss {sample["rss_mib"]:7.1f} MiB'
+        f' threads {sample["threads"]:4}'
+        f' blocks {sample["allocated_blocks"]:8}'
+        f' in {sample["frames_in_per_s"]:8.0f}/{sample["expected_frames_per_s"]:.0f} frames/s'
+        f' sent {sample["frames_sent_per_s"]:8.0f} frames/s'
+        f' lag p99 {sample["lag_p99_us"]:8.0f} us'
+        f' total p99 {sample["total_p99_us"]:6.0f} us'
+        f' drops {sample["syn_dropped"] + sample["dropped_reports"]}',
+        flush=True,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress and soak test of the hub with synthetic devices')
+    parser.add_argument('--keyboards', type=int, default=2,
+                        help='One source group with two hotkey switched links per keyboard')
+    parser.add_argument('--mice', type=int, default=4)
+    parser.add_argument('--touchpads', type=int, default=2)
+    parser.add_argument('--mouse-rate', type=float, default=8000.0)
+    parser.add_argument('--hotkey-interval', type=int, default=200,
+                        help='Key presses between link switching hotkeys, 0 to disable')
+    parser.add_argument('--sources', type=str, choices=['fake', 'uinput'], default='fake',
+                        help='In process fakes, or uinput devices read through evdev')
+    parser.add_argument('--destination', type=str, choices=sorted(_DESTINATIONS), default='hid')
+    parser.add_argument('--duration', type=float, default=3600.0)
+    parser.add_argument('--interval', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=60.0,
+                        help='Seconds that are excluded from the leak checks')
+    parser.add_argument('--reconnect-interval', type=float, default=0.0,
+                        help='Reconnect one of the sources this often, 0 to disable')
+    parser.add_argument('--reconnect-mode', type=str, choices=['remove', 'replace'], default='remove',
+                        help='replace adds the new device without removing the old one, '
+                             'like a missed udev remove event')
+    parser.add_argument('--output', type=str, help='Append the samples to a JSON lines file')
+    args = parser.parse_args()
+    if args.reconnect_interval and args.sources != 'fake':
+        parser.error('reconnecting is only supported with fake sources')
+    log.init('stress', 'WARNING')
+
+    runtime_dir = tempfile.mkdtemp(prefix='evdev-stress-')
+    # control and IPC sockets of the hub
+    os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+    specs = _create_specs(args)
+    config_path = os.path.join(runtime_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(_create_config(specs, args.destination), f, indent=4)
+
+    hub = Hub(ConfigManager(config_path))
+    hub.start()
+    expected_frame_rate = sum(s.frame_rate for s in specs)
+    sampler = _Sampler(hub, expected_frame_rate)
+    for spec in specs:
+        source_device = _create_source_device(spec, args.sources)
+        sampler.source_devices.append(source_device)
+        hub.add_source_device(source_device)
+    print(f'{len(specs)} sources, {expected_frame_rate:.0f} frames/s, runtime dir {runtime_dir}')
+
+    output = open(args.output, 'a') if args.output else None
+    samples = []
+    start_time = time.monotonic()
+    next_sample_time = start_time + args.interval
+    next_reconnect_time = start_time + args.reconnect_interval if args.reconnect_interval else None
+    reconnects = 0
+    try:
+        while time.monotonic() - start_time < args.duration:
+            if next_reconnect_time is not None and next_reconnect_time < next_sample_time:
+                time.sleep(max(0.0, next_reconnect_time - time.monotonic()))
+                i = reconnects % len(specs)
+                old_device = sampler.source_devices[i]
+                if args.reconnect_mode == 'remove':
+                    hub.remove_source_device(old_device)
+                new_device = _create_source_device(specs[i], args.sources)
+                sampler.replace_source_device(old_device, new_device)
+                hub.add_source_device(new_device)
+                reconnects += 1
+                next_reconnect_time += args.reconnect_interval
+                continue
+            time.sleep(max(0.0, next_sample_time - time.monotonic()))
+            next_sample_time += args.interval
+            sample = {**sampler.sample(), 'reconnects': reconnects}
+            _print_sample(sample)
+            if output is not None:
+                output.write(json.dumps(sample) + '\n')
+                output.flush()
+            if sample['time'] >= args.warmup:
+                samples.append(sample)
+    except KeyboardInterrupt:
+        pass
+
+    problems = _find_problems(samples, len(specs))
+    for problem in problems:
+        print(f'PROBLEM {problem}')
+    if samples:
+        print(
+            f'{len(samples)} samples after warm up,'
+            f' rss {_slope_per_hour(samples, "rss_mib"):+.1f} MiB/h,'
+            f' blocks {_slope_per_hour(samples, "allocated_blocks"):+.0f}/h,'
+            f' threads {samples[0]["threads"]} -> {samples[-1]["threads"]}'
+        )
+    sys.stdout.flush()
+    # the hub, HID writer and replay threads never exit
+    os._exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
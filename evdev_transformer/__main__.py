@@ -1,5 +1,6 @@
 import os
 import time
+import signal
 import argparse
 
 from .config import ConfigManager
@@ -18,6 +19,9 @@ parser.add_argument('config', type=str,
 parser.add_argument('--log', type=str, nargs='?',
                     help='Log level (CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET), '
                          'also available with the LOGLEVEL environment variable')
+parser.add_argument('--latency-metrics', action='store_true',
+                    help='Collect per link latency histograms, '
+                         'also available with the latency_metrics setting')
 args = parser.parse_args()
 
 # logging
@@ -26,5 +30,8 @@ log.init(NAME, log_level_name)
 
 config_path = os.path.expanduser(f'~/.config/evdev_transformer/{args.config}.json')
 config_manager = ConfigManager(config_path)
-hub = Hub(config_manager)
+hub = Hub(config_manager, latency_metrics=args.latency_metrics)
 hub.start()
+
+# dump the trace buffers of all devices
+signal.signal(signal.SIGUSR1, lambda signum, frame: hub.write_traces())
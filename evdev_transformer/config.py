@@ -26,6 +26,8 @@ class Transform:
         cls_ = {
             'key_remap': KeyRemapTransform,
             'script': ScriptTransform,
+            'filter': FilterTransform,
+            'touchpad': TouchpadTransform,
         }[data['type']]
         return cls_(data.get('properties', {}))
 
@@ -68,6 +70,51 @@ class ScriptTransform(Transform):
         super()._validate()
         assert isinstance(self._properties.get('filename'), str)
 
+class FilterTransform(Transform):
+    def to_dict(self) -> Dict:
+        d = super().to_dict()
+        d['type'] = 'filter'
+        return d
+
+    @property
+    def drop(self) -> List[str]:
+        # event types (EV_MSC) or codes (MSC_SCAN)
+        return self._properties.get('drop', [])
+
+    @property
+    def dedup_abs(self) -> bool:
+        return self._properties.get('dedup_abs', True)
+
+    def _validate(self):
+        super()._validate()
+        assert isinstance(self._properties.get('drop', []), list)
+        assert all(bool(libevdev.evbit(c)) for c in self._properties.get('drop', []))
+        assert isinstance(self._properties.get('dedup_abs', True), bool)
+
+class TouchpadTransform(Transform):
+    def to_dict(self) -> Dict:
+        d = super().to_dict()
+        d['type'] = 'touchpad'
+        return d
+
+    @property
+    def speed(self) -> float:
+        return self._properties.get('speed', 1.0)
+
+    @property
+    def scroll_speed(self) -> float:
+        return self._properties.get('scroll_speed', 1.0)
+
+    @property
+    def natural_scroll(self) -> bool:
+        return self._properties.get('natural_scroll', False)
+
+    def _validate(self):
+        super()._validate()
+        assert isinstance(self._properties.get('speed', 1.0), (int, float))
+        assert isinstance(self._properties.get('scroll_speed', 1.0), (int, float))
+        assert isinstance(self._properties.get('natural_scroll', False), bool)
+
 class Source:
     def __init__(
         self,
@@ -129,10 +176,25 @@ class EvdevUdevSource(Source):
     def identifier(self):
         return self._properties['udev']
 
+    @property
+    def event_mask(self) -> Dict:
+        # "auto": the kernel drops events that no transform, activator or
+        # destination consumes, "keep" lists extra event types or codes
+        return {
+            'mode': 'auto',
+            'keep': [],
+            **self._properties.get('event_mask', {}),
+        }
+
     def _validate(self):
         super()._validate()
         assert isinstance(self._properties.get('udev'), dict)
         assert all(isinstance(v, str) for v in self._properties['udev'].values())
+        event_mask = self._properties.get('event_mask', {})
+        assert isinstance(event_mask, dict)
+        assert event_mask.get('mode', 'auto') in {'auto', 'off'}
+        assert isinstance(event_mask.get('keep', []), list)
+        assert all(bool(libevdev.evbit(c)) for c in event_mask.get('keep', []))
 
 class EvdevUnixSocketSource(Source):
     def to_dict(self) -> Dict:
@@ -208,6 +270,11 @@ class Destination:
     def name(self) -> str:
         return self._name
 
+    @property
+    def transforms(self) -> List[Transform]:
+        # applied after the source transforms while linked to this destination
+        return self._transforms
+
     @classmethod
     def from_dict(cls, data) -> Destination:
         cls_ = {
@@ -229,9 +296,19 @@ class Destination:
             'properties': self._properties,
         }
 
+    @property
+    def resample(self) -> Optional[Dict]:
+        # {"max_rate": frames per second} for frames that only move absolute axes
+        return self._properties.get('resample')
+
     def _validate(self):
         assert isinstance(self._name, str)
         assert isinstance(self._properties, dict)
+        resample = self._properties.get('resample')
+        if resample is not None:
+            assert isinstance(resample, dict)
+            assert isinstance(resample.get('max_rate'), (int, float))
+            assert resample['max_rate'] > 0
 
     def __repr__(self):
         return f'{self.__class__.__name__}(name="{self._name}")'
@@ -252,9 +329,23 @@ class SubprocessDestination(Destination):
     def command(self) -> str:
         return self._properties['command']
 
+    @property
+    def ack(self) -> Optional[Dict]:
+        return self._properties.get('ack')
+
+    @property
+    def key_repeat(self) -> bool:
+        # the receiving hub synthesizes autorepeat from the REP_DELAY and
+        # REP_PERIOD of the descriptor, sources never forward repeats
+        return self._properties.get('key_repeat', False)
+
     def _validate(self):
         super()._validate()
         assert isinstance(self._properties.get('command'), str)
+        if 'ack' in self._properties:
+            assert isinstance(self._properties['ack'], dict)
+            assert all(isinstance(v, (int, float)) for v in self._properties['ack'].values())
+        assert isinstance(self._properties.get('key_repeat', False), bool)
 
 class HidGadgetDestination(Destination):
     def to_dict(self):
@@ -262,6 +353,26 @@ class HidGadgetDestination(Destination):
         d['type'] = 'hid_gadget'
         return d
 
+    @property
+    def device(self) -> str:
+        return self._properties.get('device', '/dev/hidg0')
+
+    @property
+    def poll_interval(self) -> float:
+        # USB polling interval of the gadget endpoint, 1 ms at high speed
+        return self._properties.get('poll_interval', 0.001)
+
+    @property
+    def keyboard_report(self) -> str:
+        # must match the report descriptor of the gadget
+        return self._properties.get('keyboard_report', 'boot')
+
+    def _validate(self):
+        super()._validate()
+        assert isinstance(self._properties.get('device', ''), str)
+        assert isinstance(self._properties.get('poll_interval', 0.001), (int, float))
+        assert self._properties.get('keyboard_report', 'boot') in {'boot', 'nkro'}
+
 class Activator:
     def __init__(self, properties: Dict):
         self._properties = properties
@@ -373,6 +484,68 @@ class Link:
     def __repr__(self):
         return f'Link(source_group="{self._source_group}" destination="{self._destination}")'
 
+class Settings:
+    def __init__(self, properties: Dict):
+        self._properties = properties
+        self._validate()
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> Settings:
+        return cls(data)
+
+    def to_dict(self) -> Dict:
+        return self._properties
+
+    @property
+    def latency_metrics(self) -> bool:
+        # per link latency histograms of the forwarded frames
+        return self._properties.get('latency_metrics', False)
+
+    @property
+    def trace_size(self) -> int:
+        # events kept per source and destination, tracing is disabled by
+        # default because every event is copied into the buffers
+        return self._properties.get('trace_size', 0)
+
+    @property
+    def transform_timing(self) -> Optional[Dict]:
+        # {"threshold_ms": slower events are logged, "bypass_after": number
+        # of slow events in a row before the transform is bypassed, 0 never},
+        # only transforms that do not remove codes, e.g. scripts, are
+        # bypassed. Also enables the transform_ns counter of the sources
+        return self._properties.get('transform_timing')
+
+    @property
+    def runtime(self) -> Optional[Dict]:
+        # {"scheduler": "normal", "fifo" or "nice", "priority": SCHED_FIFO
+        # priority, "nice": also the fallback for fifo, "cpus": [affinity],
+        # "lock_memory": mlockall, "freeze_gc": gc.freeze at startup}
+        return self._properties.get('runtime')
+
+    def _validate(self):
+        assert isinstance(self._properties, dict)
+        assert isinstance(self._properties.get('latency_metrics', False), bool)
+        assert isinstance(self.trace_size, int) and self.trace_size >= 0
+        transform_timing = self.transform_timing
+        if transform_timing is not None:
+            assert isinstance(transform_timing, dict)
+            assert isinstance(transform_timing.get('threshold_ms'), (int, float))
+            assert transform_timing['threshold_ms'] > 0
+            assert isinstance(transform_timing.get('bypass_after', 0), int)
+            assert transform_timing.get('bypass_after', 0) >= 0
+        runtime = self.runtime
+        if runtime is not None:
+            assert isinstance(runtime, dict)
+            assert runtime.get('scheduler', 'normal') in {'normal', 'fifo', 'nice'}
+            assert isinstance(runtime.get('priority', 10), int) and 1 <= runtime.get('priority', 10) <= 99
+            assert isinstance(runtime.get('nice', -10), int) and -20 <= runtime.get('nice', -10) <= 19
+            cpus = runtime.get('cpus')
+            if cpus is not None:
+                assert isinstance(cpus, list) and cpus
+                assert all(isinstance(c, int) and c >= 0 for c in cpus)
+            assert isinstance(runtime.get('lock_memory', False), bool)
+            assert isinstance(runtime.get('freeze_gc', False), bool)
+
 class Config:
     _newest_version = 1
 
@@ -383,12 +556,14 @@ class Config:
         source_groups: List[SourceGroup],
         destinations: List[Destination],
         links: List[Link],
+        settings: Settings,
     ):
         self._version = version
         self._sources = sources
         self._source_groups = source_groups
         self._destinations = destinations
         self._links = links
+        self._settings = settings
         self._validate()
 
     @property
@@ -411,6 +586,10 @@ class Config:
     def links(self) -> List[Link]:
         return self._links
 
+    @property
+    def settings(self) -> Settings:
+        return self._settings
+
     @classmethod
     def from_dict(cls, data: Dict) -> Config:
         return cls(
@@ -419,6 +598,7 @@ class Config:
             [SourceGroup.from_dict(s) for s in data['source_groups']],
             [Destination.from_dict(d) for d in data['destinations']],
             [Link.from_dict(l) for l in data['links']],
+            Settings.from_dict(data.get('settings', {})),
         )
 
     def to_dict(self) -> Dict:
@@ -428,6 +608,7 @@ class Config:
             'source_groups': [s.to_dict() for s in self._source_groups],
             'destinations': [d.to_dict() for d in self._destinations],
             'links': [l.to_dict() for l in self._links],
+            'settings': self._settings.to_dict(),
         }
 
     def _validate(self):
@@ -463,10 +644,18 @@ class ConfigManager:
         self._lock = threading.Lock()
         self._init_state()
 
+    @property
+    def sources(self) -> List[Source]:
+        return self._config.sources
+
     @property
     def source_groups(self) -> List[SourceGroup]:
         return self._config.source_groups
 
+    @property
+    def settings(self) -> Settings:
+        return self._config.settings
+
     def get_current_links(self) -> Iterable[Tuple[Link, List[Source], Destination]]:
         for link in self._current_links:
             source_group = [s for s in self._config.source_groups if s.name == link.source_group][0]
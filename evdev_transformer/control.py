@@ -0,0 +1,78 @@
+import socket
+import os
+import contextlib
+import shlex
+from typing import (
+    Callable,
+    Dict,
+)
+
+from . import log
+
+class ControlServer:
+    # scrapers may connect without sending a command
+    _COMMAND_TIMEOUT = 0.5
+    _MAX_COMMAND_LENGTH = 1024
+    _DEFAULT_COMMAND = 'metrics'
+
+    def __init__(self):
+        self._commands: Dict[str, Callable[..., str]] = {}
+        self._sock = self._get_socket()
+
+    def add_command(self, name: str, handler: Callable[..., str]):
+        # the words after the command name are passed as arguments
+        self._commands[name] = handler
+
+    def run(self):
+        # serves one connection at a time in the calling thread
+        while True:
+            conn, _ = self._sock.accept()
+            with conn:
+                try:
+                    self._handle_connection(conn)
+                except OSError as e:
+                    log.info(f'control connection closed: {e}')
+
+    def _get_socket(self) -> socket.socket:
+        # bash: "${XDG_RUNTIME_DIR:-/tmp}/evdev-control.sock"
+        base_path = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+        socket_path = os.path.join(base_path, 'evdev-control.sock')
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+        sock = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+        # restrict access to current user before binding
+        os.fchmod(sock.fileno(), 0o600)
+        sock.bind(socket_path)
+        sock.listen()
+        return sock
+
+    def _handle_connection(self, conn: socket.socket):
+        conn.settimeout(self._COMMAND_TIMEOUT)
+        data = b''
+        try:
+            while b'\n' not in data and len(data) < self._MAX_COMMAND_LENGTH:
+                chunk = conn.recv(self._MAX_COMMAND_LENGTH)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        response = self._run_command(data.split(b'\n')[0].decode('utf-8', 'replace'))
+        # still with the timeout, a client that does not read would block
+        # the other connections
+        conn.sendall(response.encode('utf-8'))
+
+    def _run_command(self, line: str) -> str:
+        try:
+            # names with spaces can be quoted
+            command, *args = shlex.split(line) or [self._DEFAULT_COMMAND]
+        except ValueError as e:
+            return f'invalid command: {e}\n'
+        handler = self._commands.get(command)
+        if handler is None:
+            return f'unknown command {command}\n'
+        try:
+            return handler(*args)
+        # OSError when writing traces or recordings
+        except (TypeError, ValueError, OSError) as e:
+            return f'{command} failed: {e}\n'
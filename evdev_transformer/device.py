@@ -7,13 +7,20 @@ from typing import (
     Optional,
     Callable,
     Tuple,
+    Union,
 )
+import errno
 import threading
+import queue
 import subprocess
 import json
 import socket
 import functools
 import time
+import hashlib
+import fcntl
+import struct
+import ctypes
 
 import libevdev
 
@@ -26,20 +33,94 @@ from .transform import (
 from .activator import (
     DeviceLinkActivator,
 )
+from .ipc import (
+    AckTracker,
+    IpcStream,
+)
+from .metrics import (
+    Counters,
+    LinkLatency,
+)
+from .recording import (
+    EventRecorder,
+    RecordingReader,
+)
+from .profiling import (
+    SourceProfile,
+    TransformStageTiming,
+    TransformTiming,
+)
+from .runtime import Runtime
+from .tracing import (
+    DESTINATION_OUT,
+    SOURCE_IN,
+    SOURCE_OUT,
+    TraceBuffer,
+)
+from .hid_gadget import (
+    EVDEV_BUTTON_TO_HID_BUTTON,
+    EVDEV_KEY_TO_HID_USAGE,
+    HidAbsolutePointerEncoder,
+    HidGadgetWriter,
+    HidMouseReportScheduler,
+    HidTouchpadEncoder,
+)
 from . import log
 
+# transforms, per code transform chains, see _get_transform_chain, and
+# timing by transform index
+_TransformDispatch = Tuple[List[EventTransform], Dict, Optional[List[TransformStageTiming]]]
+
 class SourceDevice:
+    _COUNTER_NAMES = [
+        'events_in',
+        'frames_in',
+        'events_out',
+        'frames_out',
+        'frames_dropped',
+        'activations',
+        'syn_dropped',
+        'reconnects',
+        'transform_ns',
+    ]
+    (
+        _EVENTS_IN,
+        _FRAMES_IN,
+        _EVENTS_OUT,
+        _FRAMES_OUT,
+        _FRAMES_DROPPED,
+        _ACTIVATIONS,
+        _SYN_DROPPED,
+        _RECONNECTS,
+        _TRANSFORM_NS,
+    ) = range(len(_COUNTER_NAMES))
+
     def __init__(self, device, identifier):
         self._device = device
         self._identifier = identifier
         self._activators: List[DeviceLinkActivator] = []
         self._transforms: List[EventTransform] = []
+        # replaced together with the transforms
+        self._transform_dispatch: _TransformDispatch = ([], {}, None)
+        self._transform_timing: Optional[TransformTiming] = None
+        # transforms of the link that was left, for _cleanup_released_device
+        self._released_transform_dispatch: _TransformDispatch = ([], {}, None)
+        # after transforms, for activators
         self._pressed_keys: Set[int] = set()
+        # before transforms, the state to reset on the destination
+        self._held_keys: Set[libevdev.EventCode] = set()
         self._abs_mt_tracking_ids_by_slot: Dict[int, int] = {}
         self._prev_slot: Optional[int] = None
         self._event_loop_stopped: bool = False
         self._buffer: List[libevdev.InputEvent] = []
         self._lock = threading.Lock()
+        self._latency: Optional[LinkLatency] = None
+        self._counters = Counters(self._COUNTER_NAMES)
+        # shard of the thread that forwards the events, see events() and attach()
+        self._shard = self._counters.shard()
+        self._trace: Optional[TraceBuffer] = None
+        self._recorder: Optional[EventRecorder] = None
+        self._profile: Optional[SourceProfile] = None
 
     def __repr__(self) -> str:
         return f'{type(self).__name__}(name="{self.name}", identifier={self._identifier})'
@@ -81,9 +162,97 @@ class SourceDevice:
             DeviceLinkActivator.create(activator, self.has_pressed_keys, activate)
             for activator, activate in activators
         ]
+        self._update_profile()
 
-    def set_transforms(self, transforms: List[EventTransform]):
+    def set_transforms(
+        self,
+        transforms: List[EventTransform],
+        timing: Optional[TransformTiming] = None,
+    ):
+        # timing also adds the time of all transforms to transform_ns
         self._transforms = transforms
+        self._transform_timing = timing
+        stages = timing.get_stages(transforms) if timing is not None else None
+        self._transform_dispatch = (transforms, {}, stages)
+        self._update_profile()
+
+    @property
+    def transform_timing(self) -> Optional[TransformTiming]:
+        return self._transform_timing
+
+    @property
+    def latency(self) -> Optional[LinkLatency]:
+        return self._latency
+
+    def set_latency(self, latency: Optional[LinkLatency]):
+        # latency of the frames forwarded over the current link
+        self._latency = latency
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self._counters.to_dict()
+
+    @property
+    def trace(self) -> Optional[TraceBuffer]:
+        return self._trace
+
+    def set_trace(self, trace: Optional[TraceBuffer]):
+        self._trace = trace
+
+    @property
+    def recorder(self) -> Optional[EventRecorder]:
+        return self._recorder
+
+    def set_recorder(self, recorder: Optional[EventRecorder]):
+        # records the events read from the device before transforms
+        self._recorder = recorder
+
+    @property
+    def profile(self) -> Optional[SourceProfile]:
+        return self._profile
+
+    def set_profiling(self, enabled: bool):
+        self._profile = SourceProfile(*self._get_stage_names()) if enabled else None
+
+    def _update_profile(self):
+        # restarted when the transforms or activators change, not when the
+        # hub sets equal ones again
+        profile = self._profile
+        if profile is None:
+            return
+        transform_names, activator_names = self._get_stage_names()
+        if transform_names != profile.transform_names or activator_names != profile.activator_names:
+            self._profile = SourceProfile(transform_names, activator_names)
+
+    def _get_stage_names(self) -> Tuple[List[str], List[str]]:
+        return (
+            [f'{i}:{t.name}' for i, t in enumerate(self._transforms)],
+            [f'{i}:{type(a).__name__}' for i, a in enumerate(self._activators)],
+        )
+
+    def serialize(self) -> Dict:
+        # same format as DestinationDevice, see DescriptorSourceDevice
+        return _serialize_device(
+            type(self).__name__,
+            self.name,
+            self.id,
+            self.evbits,
+            self.absinfo,
+            self.rep_value,
+            self.input_properties,
+        )
+
+    @property
+    def transform_stats(self) -> List[Tuple[str, Dict]]:
+        transforms, _, stages = self._transform_dispatch
+        stats = []
+        for i, transform in enumerate(transforms):
+            transform_stats = transform.stats
+            if stages is not None:
+                transform_stats = {**transform_stats, **stages[i].stats()}
+            if transform_stats:
+                stats.append((f'{i}:{transform.name}', transform_stats))
+        return stats
 
     def has_pressed_keys(self, keys: Iterable[libevdev.EventCode]) -> bool:
         if not isinstance(keys, set):
@@ -91,11 +260,22 @@ class SourceDevice:
         return len(keys) == len(self._pressed_keys & keys)
 
     def release(self):
+        # called before the transforms of the next link are set
+        if not self._event_loop_stopped:
+            self._released_transform_dispatch = self._transform_dispatch
         self._event_loop_stopped = True
 
+    def close(self):
+        return
+
+    def set_event_mask(self, event_mask: Optional[Dict[libevdev.EventType, Set[libevdev.EventCode]]]):
+        # codes that the source needs to deliver per event type, None for all
+        return
+
     def events(self) -> Iterable[List[libevdev.InputEvent]]:
         try:
             with self._lock:
+                self._shard = self._counters.shard()
                 self._grab_device()
                 yield from self._init_attached_device()
                 for events in self._events():
@@ -106,6 +286,24 @@ class SourceDevice:
         finally:
             self._event_loop_stopped = False
 
+    # push based alternative to events() for sources that are driven by an
+    # event loop: attach() when starting to forward to a destination,
+    # detach() when released is set
+
+    @property
+    def released(self) -> bool:
+        return self._event_loop_stopped
+
+    def attach(self) -> Iterable[List[libevdev.InputEvent]]:
+        self._shard = self._counters.shard()
+        self._event_loop_stopped = False
+        self._grab_device()
+        yield from self._init_attached_device()
+
+    def detach(self) -> Iterable[List[libevdev.InputEvent]]:
+        yield from self._cleanup_released_device()
+        self._event_loop_stopped = False
+
     def _release_device(self):
         raise NotImplementedError('Override me')
 
@@ -115,33 +313,131 @@ class SourceDevice:
     def _events(self):
         raise NotImplementedError('Override me')
 
-    def _transform_event(self, event: libevdev.InputEvent) -> Iterable[libevdev.InputEvent]:
+    def _transform_event(
+        self,
+        event: libevdev.InputEvent,
+        transform_dispatch: _TransformDispatch,
+    ) -> List[libevdev.InputEvent]:
         buffer = [event]
-        for transform in self._transforms:
+        transforms, dispatch, stages = transform_dispatch
+        chain = dispatch.get(event.code)
+        if chain is None:
+            chain = self._get_transform_chain(transforms, dispatch, event)
+        if not chain:
+            return buffer
+        profile = self._profile
+        timed = profile is not None or stages is not None
+        if timed:
+            start_time = stage_start_time = time.perf_counter_ns()
+        index = len(transforms) - len(chain)
+        for transform in chain:
+            if stages is not None and stages[index].bypassed:
+                index += 1
+                continue
             transformed_buffer = []
+            matched = False
             for intermediate_event in buffer:
                 if transform.matches_event(intermediate_event):
+                    matched = True
                     for transformed_event in transform.transform_event(intermediate_event):
                         transformed_buffer.append(transformed_event)
                 else:
                     transformed_buffer.append(intermediate_event)
+            if timed:
+                stage_end_time = time.perf_counter_ns()
+                stage_ns = stage_end_time - stage_start_time
+                if profile is not None:
+                    profile.add_transform_time(index, len(buffer), stage_ns)
+                # stages that only passed events through would reset the
+                # slow events in a row
+                if stages is not None and matched:
+                    stages[index].record(event, stage_ns)
+                stage_start_time = stage_end_time
+            index += 1
             buffer = transformed_buffer
-        yield from buffer
+        if timed:
+            self._shard[self._TRANSFORM_NS] += time.perf_counter_ns() - start_time
+        return buffer
+
+    @staticmethod
+    def _get_transform_chain(
+        transforms: List[EventTransform],
+        dispatch: Dict[libevdev.EventCode, Tuple[EventTransform, ...]],
+        event: libevdev.InputEvent,
+    ) -> Tuple[EventTransform, ...]:
+        # built lazily on the first event of each code, so later events of
+        # any code take one dict lookup however frequent they are. Transforms
+        # match by event code only, the ones before the first matching
+        # transform are skipped for all events with this code, and codes
+        # that no transform matches skip the loop. The chain keeps the
+        # configured order, chained transforms are not reordered by the
+        # observed frequencies as that would change their output
+        first = len(transforms)
+        for i, transform in enumerate(transforms):
+            if transform.matches_event(event):
+                first = i
+                break
+        chain = dispatch[event.code] = tuple(transforms[first:])
+        return chain
 
     def _handle_event(
         self,
         event: libevdev.InputEvent,
     ) -> Iterable[List[libevdev.InputEvent]]:
-        for transformed_event in self._transform_event(event):
-            for activator in self._activators:
-                if activator.matches_event(transformed_event):
-                    activator.activate()
-                    # TODO is this correct with multi touch protocol and EV_MSC
-                    self._buffer = []
-                    break
+        counters = self._shard
+        counters[self._EVENTS_IN] += 1
+        if self._trace is not None:
+            self._trace.record(SOURCE_IN, event)
+        if self._recorder is not None:
+            self._recorder.record(event)
+        type_ = event.type
+        if type_ == libevdev.EV_SYN:
+            # not SYN_DROPPED or the contact separators of SYN_MT_REPORT
+            if event.code == libevdev.EV_SYN.SYN_REPORT:
+                counters[self._FRAMES_IN] += 1
+                if self._latency is not None:
+                    self._latency.frame_handled(event.sec, event.usec)
+                self._prev_slot = None
+        elif type_ == libevdev.EV_KEY:
+            if event.value == 0:
+                self._held_keys.discard(event.code)
+            elif event.value == 1:
+                self._held_keys.add(event.code)
+        elif type_ == libevdev.EV_ABS:
+            self._track_mt_slots(event)
+        profile = self._profile
+        if profile is not None:
+            profile.count_event(event)
+        for transformed_event in self._transform_event(event, self._transform_dispatch):
+            if profile is not None:
+                activator = self._match_profiled_activator(transformed_event, profile)
+            else:
+                activator = None
+                for candidate in self._activators:
+                    if candidate.matches_event(transformed_event):
+                        activator = candidate
+                        break
+            if activator is not None:
+                counters[self._ACTIVATIONS] += 1
+                activator.activate()
+                # TODO is this correct with multi touch protocol and EV_MSC
+                self._buffer = []
             else:
                 yield from self._handle_event2(transformed_event)
 
+    def _match_profiled_activator(
+        self,
+        event: libevdev.InputEvent,
+        profile: SourceProfile,
+    ) -> Optional[DeviceLinkActivator]:
+        for i, activator in enumerate(self._activators):
+            start_time = time.perf_counter_ns()
+            matches = activator.matches_event(event)
+            profile.add_activator_time(i, time.perf_counter_ns() - start_time)
+            if matches:
+                return activator
+        return None
+
     def _handle_event2(
         self,
         event: libevdev.InputEvent,
@@ -156,66 +452,93 @@ class SourceDevice:
             # skip repeat
             elif event.value == 2:
                 return
-        elif event.type == libevdev.EV_ABS:
-            # https://www.kernel.org/doc/Documentation/input/multi-touch-protocol.txt
-            if event.code == libevdev.EV_ABS.ABS_MT_SLOT:
-                self._prev_slot = event.value
-            elif event.code == libevdev.EV_ABS.ABS_MT_TRACKING_ID:
-                if self._prev_slot is None:
-                    for slot in self._abs_mt_tracking_ids_by_slot:
-                        self._prev_slot = slot
-                        break
-                if self._prev_slot:
-                    if event.value == -1:
-                        try:
-                            del self._abs_mt_tracking_ids_by_slot[self._prev_slot]
-                        except KeyError:
-                            pass
-                    else:
-                        self._abs_mt_tracking_ids_by_slot[self._prev_slot] = event.value
         # handle buffer
         self._buffer.append(event)
         if event.matches(libevdev.EV_SYN.SYN_REPORT):
             # do nothing when SYN_REPORT is the only event
+            counters = self._shard
             if len(self._buffer) > 1:
+                counters[self._FRAMES_OUT] += 1
+                counters[self._EVENTS_OUT] += len(self._buffer)
+                if self._latency is not None:
+                    self._latency.frame_transformed()
+                if self._trace is not None:
+                    self._trace.record_frame(SOURCE_OUT, self._buffer)
                 yield self._buffer
+            else:
+                counters[self._FRAMES_DROPPED] += 1
             self._buffer = []
-            self._prev_slot = None
+
+    def _track_mt_slots(self, event: libevdev.InputEvent):
+        # https://www.kernel.org/doc/Documentation/input/multi-touch-protocol.txt
+        if event.code == libevdev.EV_ABS.ABS_MT_SLOT:
+            self._prev_slot = event.value
+        elif event.code == libevdev.EV_ABS.ABS_MT_TRACKING_ID:
+            if self._prev_slot is None:
+                for slot in self._abs_mt_tracking_ids_by_slot:
+                    self._prev_slot = slot
+                    break
+            if self._prev_slot is not None:
+                if event.value == -1:
+                    try:
+                        del self._abs_mt_tracking_ids_by_slot[self._prev_slot]
+                    except KeyError:
+                        pass
+                else:
+                    self._abs_mt_tracking_ids_by_slot[self._prev_slot] = event.value
+
+    def _handle_state_frame(
+        self,
+        events: List[libevdev.InputEvent],
+        transform_dispatch: _TransformDispatch,
+    ) -> Iterable[List[libevdev.InputEvent]]:
+        # frames that restore or reset the device state on the destination
+        # are transformed like read frames, activators do not see them
+        for event in events:
+            for transformed_event in self._transform_event(event, transform_dispatch):
+                yield from self._handle_event2(transformed_event)
 
     def _init_attached_device(self) -> Iterable[List[libevdev.InputEvent]]:
         # restore multi touch slots
         # TODO expiration?
         for slot, tracking_id in self._abs_mt_tracking_ids_by_slot.items():
-            yield [
+            yield from self._handle_state_frame([
                 libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_SLOT, slot),
                 libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_TRACKING_ID, tracking_id),
                 libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0),
-            ]
+            ], self._transform_dispatch)
 
     def _cleanup_released_device(self) -> Iterable[List[libevdev.InputEvent]]:
+        transform_dispatch = self._released_transform_dispatch
         # release keys
-        for code in self._pressed_keys:
-            yield [
+        for code in list(self._held_keys):
+            yield from self._handle_state_frame([
                 libevdev.InputEvent(code, 0),
                 libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0),
-            ]
+            ], transform_dispatch)
         # reset multi touch slots
         for slot, tracking_id in self._abs_mt_tracking_ids_by_slot.items():
-            yield [
+            yield from self._handle_state_frame([
                 libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_SLOT, slot),
                 libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_TRACKING_ID, -1),
                 libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0),
-            ]
+            ], transform_dispatch)
         if any(b == libevdev.EV_ABS.ABS_MT_TRACKING_ID for b in self.evbits.get(libevdev.EV_ABS, [])):
-            yield [
+            yield from self._handle_state_frame([
                 libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_TRACKING_ID, -1),
                 libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0),
-            ]
+            ], transform_dispatch)
         # reset internal state except for multi touch so that it can be initialized on reattach
         self._pressed_keys = set()
+        self._held_keys = set()
         self._release_device()
 
 class EvdevSourceDevice(SourceDevice):
+    def __init__(self, device, identifier):
+        super().__init__(device, identifier)
+        # the kernel passes all events until a mask is set
+        self._event_mask: Optional[Dict[libevdev.EventType, Set[libevdev.EventCode]]] = None
+
     @classmethod
     def from_udev(
         cls,
@@ -269,6 +592,56 @@ class EvdevSourceDevice(SourceDevice):
     def input_properties(self) -> List[libevdev.InputProperty]:
         return self._device.properties
 
+    # _IOW('E', 0x93, struct input_mask)
+    _EVIOCSMASK = 0x40104593
+
+    def set_event_mask(self, event_mask: Optional[Dict[libevdev.EventType, Set[libevdev.EventCode]]]):
+        # filter in the kernel so that unused events never wake up the reader
+        if event_mask == self._event_mask:
+            return
+        fd = self._device.fd.fileno()
+        for event_type, codes in self._device.evbits.items():
+            if event_type == libevdev.EV_SYN:
+                continue
+            code_count = len(event_type.codes)
+            # a set bit passes the code
+            if event_mask is None or event_type not in event_mask:
+                mask = bytearray(b'\xff' * ((code_count + 7) // 8))
+            else:
+                mask = bytearray((code_count + 7) // 8)
+                for code in event_mask[event_type]:
+                    mask[code.value >> 3] |= 1 << (code.value & 7)
+            buffer = ctypes.create_string_buffer(bytes(mask), len(mask))
+            try:
+                fcntl.ioctl(
+                    fd,
+                    self._EVIOCSMASK,
+                    struct.pack('IIQ', event_type.value, len(mask), ctypes.addressof(buffer)),
+                )
+            except OSError as e:
+                # EVIOCSMASK needs Linux 4.5
+                log.warning(f'cannot set event mask for {self}: {e}')
+                return
+        # only once every type is masked, a partially applied mask is retried
+        self._event_mask = event_mask
+        log.info(f'event mask for {self}: {self._format_event_mask(event_mask)}')
+
+    @staticmethod
+    def _format_event_mask(event_mask: Optional[Dict[libevdev.EventType, Set[libevdev.EventCode]]]) -> str:
+        if event_mask is None:
+            return 'all'
+        return ', '.join(
+            f'{t.name}: {len(c)}'
+            for t, c in event_mask.items()
+        )
+
+    def close(self):
+        # the forwarding thread stops reading with an error, see _events
+        try:
+            self._device.fd.close()
+        except OSError as e:
+            log.info(f'closing {self} failed: {e}')
+
     def _release_device(self):
         # TODO only release when forwarded to itself explicitly (unimplemented)
         # self._device.ungrab()
@@ -285,39 +658,52 @@ class EvdevSourceDevice(SourceDevice):
                 for event in self._device.events():
                     yield from self._handle_event(event)
             except libevdev.device.EventsDroppedException:
+                self._shard[self._SYN_DROPPED] += 1
                 for event in self._device.sync():
                     yield from self._handle_event(event)
                 continue
+            except OSError as e:
+                # ENODEV when the device was unplugged
+                if e.errno == errno.ENODEV or self._device.fd.closed:
+                    break
+                raise
+            except ValueError:
+                if self._device.fd.closed:
+                    break
+                raise
             break
 
-class UnixSocketSourceDevice(SourceDevice):
-    @classmethod
-    def from_ipc(
-        cls,
-        details: Dict,
-        events: Iterable[Dict],
-    ):
-        class _Device:
-            def __init__(self, details, events):
-                self.details = details
-                self._events = events
-            def events(self):
-                for events in self._events:
-                    # device descriptor was resent
-                    if 'events' not in events:
-                        continue
-                    for event in events['events']:
-                        yield libevdev.InputEvent(
-                            libevdev.evbit(event['type'], event['code']),
-                            event['value']
-                        )
-        device = _Device(details['data'], events)
-        identifier = {
-            'host': details['host'],
-            'vendor': details['vendor'],
-            'product': details['product'],
-        }
-        return cls(device, identifier)
+class DescriptorSourceDevice(SourceDevice):
+    # described by the serialized format of DestinationDevice in the details
+    # of the device object
+
+    @functools.cached_property
+    def _event_codes(self) -> List[List[Optional[libevdev.EventCode]]]:
+        # dense (type, code) -> EventCode table, built once per descriptor
+        event_codes: List[List[Optional[libevdev.EventCode]]] = [
+            [] for _ in range(max(t.value for t in libevdev.types) + 1)
+        ]
+        for type_, codes in self._device.details['evbits'].items():
+            table = event_codes[int(type_)]
+            for code in codes:
+                if code >= len(table):
+                    table.extend([None] * (code + 1 - len(table)))
+                table[code] = libevdev.evbit(int(type_), code)
+        return event_codes
+
+    def _lookup_event_code(self, type_: int, code: int) -> libevdev.EventCode:
+        # not part of the descriptor, e.g. codes added by transforms on the
+        # sending side
+        if not 0 <= type_ < len(self._event_codes) or code < 0:
+            raise ValueError(f'Invalid event type {type_} code {code}')
+        event_code = libevdev.evbit(type_, code)
+        if event_code is None:
+            raise ValueError(f'Unknown event type {type_} code {code}')
+        table = self._event_codes[type_]
+        if code >= len(table):
+            table.extend([None] * (code + 1 - len(table)))
+        table[code] = event_code
+        return event_code
 
     @property
     def name(self) -> str:
@@ -327,8 +713,7 @@ class UnixSocketSourceDevice(SourceDevice):
     def id(self) -> Dict[str, int]:
         return self._device.details['id']
 
-    @property
-    @functools.cache
+    @functools.cached_property
     def evbits(self) -> Dict[libevdev.EventType, List[libevdev.EventCode]]:
         return {
             libevdev.evbit(int(t)): [libevdev.evbit(int(t), c) for c in cs]
@@ -336,8 +721,7 @@ class UnixSocketSourceDevice(SourceDevice):
             in self._device.details['evbits'].items()
         }
 
-    @property
-    @functools.cache
+    @functools.cached_property
     def absinfo(self) -> Dict[libevdev.EventCode, libevdev.InputAbsInfo]:
         return {
             libevdev.evbit('EV_ABS', int(c)): libevdev.InputAbsInfo(**ai)
@@ -345,16 +729,14 @@ class UnixSocketSourceDevice(SourceDevice):
             in self._device.details['absinfo'].items()
         }
 
-    @property
-    @functools.cache
+    @functools.cached_property
     def rep_value(self) -> Dict[libevdev.EventCode, int]:
         return {
             libevdev.evbit('EV_REP', int(c)): v
             for c, v in self._device.details['rep_value'].items()
         }
 
-    @property
-    @functools.cache
+    @functools.cached_property
     def input_properties(self) -> List[libevdev.InputProperty]:
         return [libevdev.propbit(p) for p in self._device.details['properties']]
 
@@ -364,11 +746,394 @@ class UnixSocketSourceDevice(SourceDevice):
     def _grab_device(self):
         return
 
+class UnixSocketSourceDevice(DescriptorSourceDevice):
+    def __init__(self, device, identifier, key_repeat: bool, runtime: Optional[Runtime] = None):
+        super().__init__(device, identifier)
+        self._key_repeater: Optional[KeyRepeater] = None
+        if key_repeat:
+            self._key_repeater = KeyRepeater(
+                self.rep_value.get(libevdev.EV_REP.REP_DELAY, 250) / 1000,
+                self.rep_value.get(libevdev.EV_REP.REP_PERIOD, 33) / 1000,
+                runtime,
+                self.name,
+            )
+
+    @classmethod
+    def from_ipc(
+        cls,
+        details: Dict,
+        stream: IpcStream,
+        runtime: Optional[Runtime] = None,
+    ):
+        class _Device:
+            def __init__(self, details, descriptor_hash, stream):
+                self.details = details
+                self.descriptor_hash = descriptor_hash
+                self.stream = stream
+        device = _Device(details['data'], details.get('hash'), stream)
+        return cls(device, cls.get_identifier(details), details.get('key_repeat', False), runtime)
+
+    @staticmethod
+    def get_identifier(details: Dict) -> Dict:
+        return {
+            'host': details['host'],
+            'vendor': details['vendor'],
+            'product': details['product'],
+        }
+
+    @property
+    def descriptor_hash(self) -> Optional[str]:
+        return self._device.descriptor_hash
+
+    def rebind(self, stream: IpcStream):
+        self._shard[self._RECONNECTS] += 1
+        stale_stream = self._device.stream
+        self._device.stream = stream
+        if stale_stream is not None and stale_stream is not stream:
+            stale_stream.close()
+
+    def close(self):
+        if self._device.stream is not None:
+            self._device.stream.close()
+            self._device.stream = None
+        if self._key_repeater is not None:
+            self._key_repeater.close()
+
+    def set_key_repeat_sender(self, send_events: Optional[Callable[[List[libevdev.InputEvent]], None]]):
+        # repeats are not forwarded by the sending hub, they are generated
+        # here if the destination there asked for it
+        if self._key_repeater is not None:
+            self._key_repeater.set_sender(send_events)
+
+    def stop_key_repeat(self):
+        if self._key_repeater is not None:
+            self._key_repeater.stop()
+
+    def handle_message(self, message: Dict) -> Iterable[List[libevdev.InputEvent]]:
+        events = message['events']
+        # legacy format, one dict per event
+        if events and isinstance(events[0], dict):
+            events = [x for e in events for x in (e['type'], e['code'], e['value'])]
+        event_codes = self._event_codes
+        key_repeater = self._key_repeater
+        # flat list of type, code, value triples
+        events_iter = iter(events)
+        for type_, code, value in zip(events_iter, events_iter, events_iter):
+            try:
+                # negative indices would wrap around
+                event_code = event_codes[type_][code] if type_ >= 0 and code >= 0 else None
+            except IndexError:
+                event_code = None
+            if event_code is None:
+                try:
+                    event_code = self._lookup_event_code(type_, code)
+                except ValueError as e:
+                    log.warning(f'dropped event from {self}: {e}')
+                    continue
+            if key_repeater is None:
+                yield from self._handle_event(libevdev.InputEvent(event_code, value))
+                continue
+            for frame in self._handle_event(libevdev.InputEvent(event_code, value)):
+                key_repeater.handle_events(frame)
+                yield frame
+
+class ReplaySourceDevice(DescriptorSourceDevice):
+    def __init__(self, device: RecordingReader, identifier, speed: float):
+        super().__init__(device, identifier)
+        # 0 for as fast as possible
+        self._speed = speed
+        self._closed = False
+        self._replaying = False
+
+    @classmethod
+    def from_recording(cls, path: str, speed: float = 1.0) -> ReplaySourceDevice:
+        return cls(RecordingReader(path), {'recording': path}, speed)
+
+    def close(self):
+        # ends the replay like an unplugged device, the recording is closed
+        # when the replay stops
+        self._closed = True
+        if not self._replaying:
+            self._device.close()
+
     def _events(self):
-        for event in self._device.events():
-            yield from self._handle_event(event)
+        self._replaying = True
+        try:
+            yield from self._replay()
+        finally:
+            self._replaying = False
+            if self._closed:
+                self._device.close()
+
+    def _replay(self):
+        # timestamps are moved to the time of the replay so that they look
+        # like they were just read from the kernel
+        event_codes = self._event_codes
+        speed = self._speed
+        first_timestamp = None
+        start_monotonic = 0.0
+        start_timestamp = 0
+        for sec, usec, type_, code, value in self._device.records():
+            if self._closed:
+                return
+            timestamp = sec * 1_000_000 + usec
+            if first_timestamp is None:
+                first_timestamp = timestamp
+                start_monotonic = time.monotonic()
+                start_timestamp = time.time_ns() // 1000
+            offset = timestamp - first_timestamp
+            if speed > 0:
+                offset = int(offset / speed)
+                # absolute deadlines so that oversleeping does not accumulate
+                delay = start_monotonic + offset / 1_000_000 - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                # negative indices would wrap around
+                event_code = event_codes[type_][code] if type_ >= 0 and code >= 0 else None
+            except IndexError:
+                event_code = None
+            if event_code is None:
+                try:
+                    event_code = self._lookup_event_code(type_, code)
+                except ValueError as e:
+                    log.warning(f'dropped event from {self}: {e}')
+                    continue
+            replay_sec, replay_usec = divmod(start_timestamp + offset, 1_000_000)
+            yield from self._handle_event(libevdev.InputEvent(event_code, value, replay_sec, replay_usec))
+
+class KeyRepeater:
+    # like the kernel soft repeat, only the last pressed key repeats. Fed
+    # with the transformed frames of a source, so repeats use the codes that
+    # the destination receives
+    def __init__(
+        self,
+        delay: float,
+        period: float,
+        runtime: Optional[Runtime] = None,
+        name: str = '',
+    ):
+        self._delay = delay
+        self._period = max(period, 0.001)
+        self._runtime = runtime
+        self._name = name
+        self._condition = threading.Condition()
+        self._send_events: Optional[Callable[[List[libevdev.InputEvent]], None]] = None
+        self._code: Optional[libevdev.EventCode] = None
+        self._next_time = 0.0
+        self._closed = False
+        threading.Thread(target=self._run).start()
+
+    def set_sender(self, send_events: Optional[Callable[[List[libevdev.InputEvent]], None]]):
+        # must not block, repeats are sent while holding the condition
+        with self._condition:
+            self._send_events = send_events
+            self._code = None
+
+    def stop(self):
+        with self._condition:
+            self._code = None
+
+    def handle_events(self, events: List[libevdev.InputEvent]):
+        # before the frame is sent, so that no repeat follows a release
+        with self._condition:
+            for event in events:
+                if event.type != libevdev.EV_KEY:
+                    continue
+                if event.value == 1:
+                    self._code = event.code
+                    self._next_time = time.monotonic() + self._delay
+                elif event.value == 0 and event.code == self._code:
+                    self._code = None
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'key repeat {self._name}')
+        with self._condition:
+            while not self._closed:
+                if self._code is None or self._send_events is None:
+                    self._condition.wait()
+                    continue
+                delay = self._next_time - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._send_events([
+                    libevdev.InputEvent(self._code, 2),
+                    libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0),
+                ])
+                self._next_time += self._period
+                # skip missed periods instead of bursting after a stall
+                now = time.monotonic()
+                if self._next_time < now:
+                    self._next_time = now + self._period
+
+class AbsResampler:
+    # holds back frames that only update absolute axes and sends the latest
+    # value of each axis and multi touch slot at most max_rate times per
+    # second, frames with other events are sent immediately
+    def __init__(
+        self,
+        flush: Callable[[], None],
+        max_rate: float,
+        runtime: Optional[Runtime] = None,
+        name: str = '',
+    ):
+        self._flush = flush
+        self._interval = 1 / max_rate
+        self._runtime = runtime
+        self._name = name
+        self._condition = threading.Condition()
+        self._deadline: Optional[float] = None
+        self._last_send_time = 0.0
+        # slot selected by the last forwarded event, persists across frames
+        self._slot = 0
+        self._pending: Dict[libevdev.EventCode, int] = {}
+        self._pending_slots: Dict[int, Dict[libevdev.EventCode, int]] = {}
+        self._resampled_frames = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    @property
+    def resampled_frames(self) -> int:
+        return self._resampled_frames
+
+    def handle_events(self, events: List[libevdev.InputEvent]) -> Optional[List[libevdev.InputEvent]]:
+        # called with the destination send lock held, None when held back
+        now = time.monotonic()
+        if not self._can_hold(events) or now - self._last_send_time >= self._interval:
+            pending = self._take_pending()
+            self._update_slot(events)
+            self._last_send_time = now
+            return pending + events
+        for event in events:
+            if event.code == libevdev.EV_ABS.ABS_MT_SLOT:
+                self._slot = event.value
+            elif event.type == libevdev.EV_SYN:
+                continue
+            elif event.type == libevdev.EV_ABS and event.code.value > libevdev.EV_ABS.ABS_MT_SLOT.value:
+                self._pending_slots.setdefault(self._slot, {})[event.code] = event.value
+            else:
+                self._pending[event.code] = event.value
+        self._resampled_frames += 1
+        with self._condition:
+            if self._deadline is None:
+                self._deadline = self._last_send_time + self._interval
+                self._condition.notify()
+        return None
+
+    def close(self):
+        # without the destination send lock, the thread may be waiting for it
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def flush(self) -> Optional[List[libevdev.InputEvent]]:
+        # called with the destination send lock held
+        events = self._take_pending()
+        if not events:
+            return None
+        self._last_send_time = time.monotonic()
+        return events + [libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0)]
+
+    def _can_hold(self, events: List[libevdev.InputEvent]) -> bool:
+        # buttons, relative motion and contacts starting or ending pass
+        for event in events:
+            if event.type == libevdev.EV_ABS:
+                if event.code == libevdev.EV_ABS.ABS_MT_TRACKING_ID:
+                    return False
+            elif event.type not in {libevdev.EV_SYN, libevdev.EV_MSC}:
+                return False
+        return True
+
+    def _update_slot(self, events: List[libevdev.InputEvent]):
+        for event in events:
+            if event.code == libevdev.EV_ABS.ABS_MT_SLOT:
+                self._slot = event.value
+
+    def _take_pending(self) -> List[libevdev.InputEvent]:
+        events = [libevdev.InputEvent(c, v) for c, v in self._pending.items()]
+        if self._pending_slots:
+            for slot, values in self._pending_slots.items():
+                events.append(libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_SLOT, slot))
+                events += [libevdev.InputEvent(c, v) for c, v in values.items()]
+            # following frames may rely on the previously selected slot
+            if slot != self._slot:
+                events.append(libevdev.InputEvent(libevdev.EV_ABS.ABS_MT_SLOT, self._slot))
+        self._pending = {}
+        self._pending_slots = {}
+        with self._condition:
+            self._deadline = None
+        return events
+
+    def _run(self):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'resample {self._name}')
+        while True:
+            with self._condition:
+                while self._deadline is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                delay = self._deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._deadline = None
+            # sent without holding the condition, the destination send lock
+            # is held while calling handle_events
+            self._flush()
+
+class DestinationSender:
+    # sends the frames of the IPC event loop to a destination device from a
+    # separate thread, in order
+    def __init__(self, destination_device: DestinationDevice, runtime: Optional[Runtime] = None):
+        self._destination_device = destination_device
+        self._runtime = runtime
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        threading.Thread(target=self._run).start()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self._destination_device})'
+
+    def send_events(self, events: List[libevdev.InputEvent], latency: Optional[LinkLatency] = None):
+        # the latency of the frame is recorded once it was sent
+        frame = latency.take_frame() if latency is not None else None
+        self._queue.put((events, latency, frame))
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'send {self._destination_device.name}')
+        for events, latency, frame in iter(self._queue.get, None):
+            self._destination_device.send_events(events)
+            if frame is not None:
+                latency.record_frame(frame)
 
 class DestinationDevice:
+    _COUNTER_NAMES = [
+        'events_in',
+        'frames_in',
+        'events_out',
+        'frames_out',
+    ]
+    (
+        _EVENTS_IN,
+        _FRAMES_IN,
+        _EVENTS_OUT,
+        _FRAMES_OUT,
+    ) = range(len(_COUNTER_NAMES))
+
     def __init__(
         self,
         name: str,
@@ -378,6 +1143,7 @@ class DestinationDevice:
         rep_value: Dict[libevdev.EventCode, int],
         input_properties: List[libevdev.InputProperty],
         properties: Optional[Dict],
+        runtime: Optional[Runtime] = None,
     ):
         self._name = name
         self._id = id
@@ -386,6 +1152,8 @@ class DestinationDevice:
         self._rep_value = rep_value
         self._input_properties = input_properties
         self._properties = properties or {}
+        # for the threads that write to the device
+        self._runtime = runtime
         # if 'Apple' in name:
         #     # fake touchscreen
         #     self._input_properties = [libevdev.propbit('INPUT_PROP_DIRECT')]
@@ -398,6 +1166,17 @@ class DestinationDevice:
         #         libevdev.evbit('BTN_STYLUS2'),
         #     ]
         self._device = self._create_device()
+        self._send_lock = threading.Lock()
+        self._counters = Counters(self._COUNTER_NAMES)
+        self._trace: Optional[TraceBuffer] = None
+        self._resampler: Optional[AbsResampler] = None
+        if self._properties.get('resample') is not None:
+            self._resampler = AbsResampler(
+                self._send_resampled,
+                self._properties['resample']['max_rate'],
+                self._runtime,
+                self._name,
+            )
 
     def __repr__(self) -> str:
         return f'{type(self).__name__}(name="{self._name}")'
@@ -407,50 +1186,121 @@ class DestinationDevice:
         cls,
         source_device: SourceDevice,
         properties: Optional[Dict] = None,
+        transforms: Optional[List[EventTransform]] = None,
+        runtime: Optional[Runtime] = None,
     ) -> DestinationDevice:
+        evbits = source_device.evbits
+        absinfo = source_device.absinfo
+        input_properties = source_device.input_properties
+        if transforms:
+            # the destination device emits what the transforms produce
+            removed_codes = set()
+            output_codes = set()
+            removed_input_properties = set()
+            for transform in transforms:
+                removed_codes |= transform.removed_codes
+                output_codes -= transform.removed_codes
+                output_codes |= transform.output_codes
+                removed_input_properties |= transform.removed_input_properties
+            evbits = {
+                t: [c for c in codes if c not in removed_codes or c in output_codes]
+                for t, codes in evbits.items()
+            }
+            for code in output_codes:
+                if code.type == libevdev.EV_SYN:
+                    continue
+                codes = evbits.setdefault(code.type, [])
+                if code not in codes:
+                    codes.append(code)
+            evbits = {t: codes for t, codes in evbits.items() if codes}
+            absinfo = {c: a for c, a in absinfo.items() if c in evbits.get(libevdev.EV_ABS, [])}
+            input_properties = [p for p in input_properties if p not in removed_input_properties]
         return cls(
             source_device.name + ' (Virtual)',
             source_device.id,
-            source_device.evbits,
-            source_device.absinfo,
+            evbits,
+            absinfo,
             source_device.rep_value,
-            source_device.input_properties,
+            input_properties,
             properties,
+            runtime,
         )
 
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def consumed_event_types(self) -> Set[libevdev.EventType]:
+        # the device is emulated with every event type, including the scan
+        # codes and timestamps of EV_MSC that existing links forward
+        return set(self._evbits)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        stats = self._counters.to_dict()
+        if self._resampler is not None:
+            stats['resampled_frames'] = self._resampler.resampled_frames
+        return stats
+
+    @property
+    def trace(self) -> Optional[TraceBuffer]:
+        return self._trace
+
+    def set_trace(self, trace: Optional[TraceBuffer]):
+        self._trace = trace
+
+    def close(self):
+        if self._resampler is not None:
+            self._resampler.close()
+
     def send_events(self, events: List[libevdev.InputEvent]):
-        self._device.send_events(events)
+        counters = self._counters.shard()
+        counters[self._FRAMES_IN] += 1
+        counters[self._EVENTS_IN] += len(events)
+        if self._resampler is None:
+            self._device.send_events(events)
+            counters[self._FRAMES_OUT] += 1
+            counters[self._EVENTS_OUT] += len(events)
+            if self._trace is not None:
+                self._trace.record_frame(DESTINATION_OUT, events)
+            return
+        with self._send_lock:
+            resampled_events = self._resampler.handle_events(events)
+            if resampled_events is None:
+                return
+            events = resampled_events
+            self._device.send_events(events)
+            counters[self._FRAMES_OUT] += 1
+            counters[self._EVENTS_OUT] += len(events)
+            if self._trace is not None:
+                self._trace.record_frame(DESTINATION_OUT, events)
+
+    def _send_resampled(self):
+        assert self._resampler is not None
+        with self._send_lock:
+            events = self._resampler.flush()
+            if events is not None:
+                self._device.send_events(events)
+                counters = self._counters.shard()
+                counters[self._FRAMES_OUT] += 1
+                counters[self._EVENTS_OUT] += len(events)
+                if self._trace is not None:
+                    self._trace.record_frame(DESTINATION_OUT, events)
 
     def _create_device(self):
         raise NotImplementedError('Override me')
 
     def _serialize(self) -> Dict:
-        return {
-            'type': type(self).__name__,
-            'name': self._name,
-            'id': self._id,
-            'evbits': {
-                t.value: [sc.value for sc in c]
-                for t, c
-                in self._evbits.items()
-            },
-            'absinfo': {
-                c.value: {
-                    'minimum': ai.minimum,
-                    'maximum': ai.maximum,
-                    'fuzz': ai.fuzz,
-                    'flat': ai.flat,
-                    'resolution': ai.resolution,
-                    'value': ai.value,
-                }
-                for c, ai in self._absinfo.items()
-            },
-            'rep_value': {
-                c.value: v
-                for c, v in self._rep_value.items()
-            },
-            'properties': [p.value for p in self._input_properties],
-        }
+        return _serialize_device(
+            type(self).__name__,
+            self._name,
+            self._id,
+            self._evbits,
+            self._absinfo,
+            self._rep_value,
+            self._input_properties,
+        )
 
 class UinputDestinationDevice(DestinationDevice):
     def _create_device(self) -> libevdev.device.UinputDevice:
@@ -477,43 +1327,190 @@ class UinputDestinationDevice(DestinationDevice):
         time.sleep(0.5)
         return uinput_device
 
+    @property
+    def devnode(self) -> str:
+        return self._device.devnode
+
 class SubprocessDestinationDevice(DestinationDevice):
     # TODO watchdog
     def _create_device(self):
         class _SubprocessDevice:
-            def __init__(self, command: str, details: Dict):
+            def __init__(
+                self,
+                command: str,
+                details: Dict,
+                ack: Optional[Dict],
+                key_repeat: bool,
+                runtime: Optional[Runtime],
+                name: str,
+            ):
                 self._command = command
+                self._runtime = runtime
+                self._name = name
+                self._key_repeat = key_repeat
+                self._ack_tracker = None
+                if ack is not None:
+                    self._ack_tracker = AckTracker(
+                        ack.get('interval', 0.1),
+                        ack.get('max_queue_delay', 0.02),
+                    )
                 self._handle = self._create_handle()
-                self._details = details
+                # as decoded by the receiver, which verifies the hash, the
+                # integer keys become strings and sort differently
+                self._details = json.loads(json.dumps(details))
+                self._details_hash = hashlib.sha256(
+                    json.dumps(self._details, sort_keys=True).encode('utf-8')
+                ).hexdigest()
                 self._host = socket.gethostname()
                 self._details_sent = False
+                # the receiver caches descriptors by hash, so after the first
+                # full descriptor reconnects only need to send the hash
+                self._full_details_sent = False
+                # one dict per event until the receiver confirms that it
+                # reads flat type, code, value triples
+                self._flat_events = False
+                # relative motion merged while the link is congested, sent
+                # with the next frame or at the latest after max_queue_delay
+                self._pending_rel: Dict[Tuple[int, int], int] = {}
+                self._last_send_time = 0.0
+                self._coalesced_frames = 0
+                self._reconnects = 0
+                # held while sending, the flush thread sends as well
+                self._send_lock = threading.Lock()
+                self._flush_condition = threading.Condition()
+                self._flush_deadline: Optional[float] = None
+                self._closed = False
+                self._flush_thread: Optional[threading.Thread] = None
+                if self._ack_tracker is not None:
+                    self._flush_thread = threading.Thread(target=self._run_flush)
+                    self._flush_thread.start()
+            @property
+            def reconnects(self) -> int:
+                return self._reconnects
+            @property
+            def link_stats(self) -> Optional[Dict]:
+                if self._ack_tracker is None:
+                    return None
+                return {
+                    **self._ack_tracker.to_dict(),
+                    'coalesced_frames': self._coalesced_frames,
+                }
             def send_events(self, events: List[libevdev.InputEvent]):
-                if not self._details_sent:
-                    self._send_data(self._get_details_data())
-                    self._details_sent = True
-                self._send_data(json.dumps({
-                    'events': [
-                        {'type': e.type.value, 'code': e.code.value, 'value': e.value}
-                        for e in events
-                    ]
-                }).encode('utf-8'))
+                serialized = [(e.type.value, e.code.value, e.value) for e in events]
+                with self._send_lock:
+                    # a sender may still hold frames for a dropped destination
+                    if self._closed:
+                        return
+                    if not self._details_sent:
+                        self._send_data(self._get_details_data())
+                        self._details_sent = True
+                        self._full_details_sent = True
+                    if self._ack_tracker is not None and self._coalesce(serialized):
+                        return
+                    self._send_frame(serialized)
+            def _coalesce(self, serialized: List[Tuple[int, int, int]]) -> bool:
+                ack_tracker = self._ack_tracker
+                assert ack_tracker is not None
+                if not all(t in {libevdev.EV_REL.value, libevdev.EV_SYN.value} for t, _, _ in serialized):
+                    if self._pending_rel:
+                        self._send_pending_rel()
+                    return False
+                for t, c, v in serialized:
+                    if t == libevdev.EV_REL.value:
+                        self._pending_rel[(t, c)] = self._pending_rel.get((t, c), 0) + v
+                if (
+                    ack_tracker.congested
+                    and time.monotonic() - self._last_send_time < ack_tracker.max_queue_delay
+                ):
+                    self._coalesced_frames += 1
+                    with self._flush_condition:
+                        if self._flush_deadline is None:
+                            self._flush_deadline = self._last_send_time + ack_tracker.max_queue_delay
+                            self._flush_condition.notify()
+                else:
+                    self._send_pending_rel()
+                return True
+            def _send_pending_rel(self):
+                serialized = [(t, c, v) for (t, c), v in self._pending_rel.items()]
+                serialized.append((libevdev.EV_SYN.value, libevdev.EV_SYN.SYN_REPORT.value, 0))
+                self._pending_rel = {}
+                with self._flush_condition:
+                    self._flush_deadline = None
+                self._send_frame(serialized)
+            def _run_flush(self):
+                # motion merged before the user stopped moving would
+                # otherwise wait for the next frame
+                if self._runtime is not None:
+                    self._runtime.apply_thread(f'flush {self._name}')
+                while True:
+                    with self._flush_condition:
+                        while self._flush_deadline is None and not self._closed:
+                            self._flush_condition.wait()
+                        if self._closed:
+                            return
+                        delay = self._flush_deadline - time.monotonic()
+                        if delay > 0:
+                            self._flush_condition.wait(delay)
+                            continue
+                        self._flush_deadline = None
+                    with self._send_lock:
+                        if self._pending_rel and not self._closed:
+                            self._send_pending_rel()
+            def close(self):
+                with self._send_lock:
+                    self._closed = True
+                with self._flush_condition:
+                    self._flush_condition.notify()
+                if self._flush_thread is not None:
+                    self._flush_thread.join()
+                # the receiver exits at the end of its input, the output
+                # reader threads at the end of its output
+                if self._handle.stdin is not None:
+                    try:
+                        self._handle.stdin.close()
+                    except OSError:
+                        pass
+                try:
+                    self._handle.wait(1)
+                except subprocess.TimeoutExpired:
+                    self._handle.terminate()
+                    self._handle.wait()
+            def _send_frame(self, serialized: List[Tuple[int, int, int]]):
+                if self._flat_events:
+                    frame: Dict = {'events': [x for event in serialized for x in event]}
+                else:
+                    frame = {'events': [{'type': t, 'code': c, 'value': v} for t, c, v in serialized]}
+                if self._ack_tracker is not None:
+                    frame['seq'] = self._ack_tracker.next_seq()
+                    self._last_send_time = time.monotonic()
+                self._send_data(json.dumps(frame).encode('utf-8'))
             def _get_details_data(self) -> bytes:
-                return json.dumps({
+                details: Dict = {
                     'host': self._host,
                     'vendor': self._details['id']['vendor'],
                     'product': self._details['id']['product'],
-                    'data': self._details,
-                }).encode('utf-8')
+                    'hash': self._details_hash,
+                    'event_formats': ['flat'],
+                }
+                if not self._full_details_sent:
+                    details['data'] = self._details
+                if self._ack_tracker is not None:
+                    details['ack'] = {'interval': self._ack_tracker.interval}
+                if self._key_repeat:
+                    details['key_repeat'] = True
+                return json.dumps(details).encode('utf-8')
             def _send_data(self, data: bytes):
                 try:
                     self._send_data_raw(data)
                 except (BrokenPipeError, AttributeError):
                     self._details_sent = False
+                    self._reconnects += 1
                     log.info('Created new handle')
                     self._handle = self._create_handle()
                     try:
                         self._send_data_raw(self._get_details_data())
                         self._details_sent = True
+                        self._full_details_sent = True
                         self._send_data_raw(data)
                     except:
                         pass
@@ -524,7 +1521,10 @@ class SubprocessDestinationDevice(DestinationDevice):
                 self._handle.stdin.flush()
 
             def _create_handle(self) -> subprocess.Popen:
-                # TODO two-way communication? ACK etc
+                if self._ack_tracker is not None:
+                    self._ack_tracker.reset()
+                # the new receiver may be an older version
+                self._flat_events = False
                 handle = subprocess.Popen(
                     self._command,
                     stdin=subprocess.PIPE,
@@ -532,217 +1532,123 @@ class SubprocessDestinationDevice(DestinationDevice):
                     stderr=subprocess.PIPE,
                     shell=True
                 )
-                def _log_stdout(stream):
+                def _read_stdout(stream):
                     for line in iter(stream.readline, b''):
+                        if line.startswith(b'{'):
+                            try:
+                                self._handle_message(json.loads(line))
+                                continue
+                            except (ValueError, KeyError, TypeError):
+                                pass
                         log.info('_SubprocessDevice.STDOUT: ' + line.decode('utf-8', 'ignore'))
                 def _log_stderr(stream):
                     for line in iter(stream.readline, b''):
                         log.error('_SubprocessDevice.STDERR: ' + line.decode('utf-8', 'ignore'))
-                threading.Thread(target=_log_stdout, args=(handle.stdout,)).start()
+                threading.Thread(target=_read_stdout, args=(handle.stdout,)).start()
                 threading.Thread(target=_log_stderr, args=(handle.stderr,)).start()
                 return handle
-        return _SubprocessDevice(self._properties['command'], self._serialize())
+            def _handle_message(self, data: Dict):
+                if 'ack' in data:
+                    if self._ack_tracker is not None:
+                        self._ack_tracker.handle_ack(data['ack'], data['time'])
+                elif 'event_format' in data:
+                    self._flat_events = data['event_format'] == 'flat'
+                elif data.get('resend_details'):
+                    # receiver does not have the descriptor cached
+                    log.info('Resending device details')
+                    self._full_details_sent = False
+                    self._details_sent = False
+                else:
+                    raise KeyError(data)
+        return _SubprocessDevice(
+            self._properties['command'],
+            self._serialize(),
+            self._properties.get('ack'),
+            self._properties.get('key_repeat', False),
+            self._runtime,
+            self._name,
+        )
+
+    @property
+    def link_stats(self) -> Optional[Dict]:
+        return self._device.link_stats
+
+    def close(self):
+        super().close()
+        self._device.close()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            **super().stats,
+            'reconnects': self._device.reconnects,
+        }
 
 class HidGadgetDestinationDevice(DestinationDevice):
     # TODO
     # https://github.com/siikamiika/hid-emu
     # https://www.kernel.org/doc/Documentation/usb/gadget_hid.txt
-    def _create_device(self):
-        # TODO mouse
-        evdev_key_to_hid_code = {
-            libevdev.evbit(k): v for k, v in
-            [
-                ('KEY_A',                0x04),
-                ('KEY_B',                0x05),
-                ('KEY_C',                0x06),
-                ('KEY_D',                0x07),
-                ('KEY_E',                0x08),
-                ('KEY_F',                0x09),
-                ('KEY_G',                0x0a),
-                ('KEY_H',                0x0b),
-                ('KEY_I',                0x0c),
-                ('KEY_J',                0x0d),
-                ('KEY_K',                0x0e),
-                ('KEY_L',                0x0f),
-                ('KEY_M',                0x10),
-                ('KEY_N',                0x11),
-                ('KEY_O',                0x12),
-                ('KEY_P',                0x13),
-                ('KEY_Q',                0x14),
-                ('KEY_R',                0x15),
-                ('KEY_S',                0x16),
-                ('KEY_T',                0x17),
-                ('KEY_U',                0x18),
-                ('KEY_V',                0x19),
-                ('KEY_W',                0x1a),
-                ('KEY_X',                0x1b),
-                ('KEY_Y',                0x1c),
-                ('KEY_Z',                0x1d),
-                ('KEY_1',                0x1e),
-                ('KEY_2',                0x1f),
-                ('KEY_3',                0x20),
-                ('KEY_4',                0x21),
-                ('KEY_5',                0x22),
-                ('KEY_6',                0x23),
-                ('KEY_7',                0x24),
-                ('KEY_8',                0x25),
-                ('KEY_9',                0x26),
-                ('KEY_0',                0x27),
-                ('KEY_ENTER',            0x28),
-                ('KEY_ESC',              0x29),
-                ('KEY_BACKSPACE',        0x2a),
-                ('KEY_TAB',              0x2b),
-                ('KEY_SPACE',            0x2c),
-                ('KEY_MINUS',            0x2d),
-                ('KEY_EQUAL',            0x2e),
-                ('KEY_LEFTBRACE',        0x2f),
-                ('KEY_RIGHTBRACE',       0x30),
-                ('KEY_BACKSLASH',        0x31),
-                ('KEY_BACKSLASH',        0x32),
-                ('KEY_SEMICOLON',        0x33),
-                ('KEY_APOSTROPHE',       0x34),
-                ('KEY_GRAVE',            0x35),
-                ('KEY_COMMA',            0x36),
-                ('KEY_DOT',              0x37),
-                ('KEY_SLASH',            0x38),
-                ('KEY_CAPSLOCK',         0x39),
-                ('KEY_F1',               0x3a),
-                ('KEY_F2',               0x3b),
-                ('KEY_F3',               0x3c),
-                ('KEY_F4',               0x3d),
-                ('KEY_F5',               0x3e),
-                ('KEY_F6',               0x3f),
-                ('KEY_F7',               0x40),
-                ('KEY_F8',               0x41),
-                ('KEY_F9',               0x42),
-                ('KEY_F10',              0x43),
-                ('KEY_F11',              0x44),
-                ('KEY_F12',              0x45),
-                ('KEY_SYSRQ',            0x46),
-                ('KEY_SCROLLLOCK',       0x47),
-                ('KEY_PAUSE',            0x48),
-                ('KEY_INSERT',           0x49),
-                ('KEY_HOME',             0x4a),
-                ('KEY_PAGEUP',           0x4b),
-                ('KEY_DELETE',           0x4c),
-                ('KEY_END',              0x4d),
-                ('KEY_PAGEDOWN',         0x4e),
-                ('KEY_RIGHT',            0x4f),
-                ('KEY_LEFT',             0x50),
-                ('KEY_DOWN',             0x51),
-                ('KEY_UP',               0x52),
-                ('KEY_NUMLOCK',          0x53),
-                ('KEY_KPSLASH',          0x54),
-                ('KEY_KPASTERISK',       0x55),
-                ('KEY_KPMINUS',          0x56),
-                ('KEY_KPPLUS',           0x57),
-                ('KEY_KPENTER',          0x58),
-                ('KEY_KP1',              0x59),
-                ('KEY_KP2',              0x5a),
-                ('KEY_KP3',              0x5b),
-                ('KEY_KP4',              0x5c),
-                ('KEY_KP5',              0x5d),
-                ('KEY_KP6',              0x5e),
-                ('KEY_KP7',              0x5f),
-                ('KEY_KP8',              0x60),
-                ('KEY_KP9',              0x61),
-                ('KEY_KP0',              0x62),
-                ('KEY_KPDOT',            0x63),
-                ('KEY_102ND',            0x64),
-                ('KEY_COMPOSE',          0x65),
-                ('KEY_POWER',            0x66),
-                ('KEY_KPEQUAL',          0x67),
-                ('KEY_F13',              0x68),
-                ('KEY_F14',              0x69),
-                ('KEY_F15',              0x6a),
-                ('KEY_F16',              0x6b),
-                ('KEY_F17',              0x6c),
-                ('KEY_F18',              0x6d),
-                ('KEY_F19',              0x6e),
-                ('KEY_F20',              0x6f),
-                ('KEY_F21',              0x70),
-                ('KEY_F22',              0x71),
-                ('KEY_F23',              0x72),
-                ('KEY_F24',              0x73),
-                ('KEY_OPEN',             0x74),
-                ('KEY_HELP',             0x75),
-                ('KEY_PROPS',            0x76),
-                ('KEY_FRONT',            0x77),
-                ('KEY_STOP',             0x78),
-                ('KEY_AGAIN',            0x79),
-                ('KEY_UNDO',             0x7a),
-                ('KEY_CUT',              0x7b),
-                ('KEY_COPY',             0x7c),
-                ('KEY_PASTE',            0x7d),
-                ('KEY_FIND',             0x7e),
-                ('KEY_MUTE',             0x7f),
-                ('KEY_VOLUMEUP',         0x80),
-                ('KEY_VOLUMEDOWN',       0x81),
-                ('KEY_KPCOMMA',          0x85),
-                ('KEY_RO',               0x87),
-                ('KEY_KATAKANAHIRAGANA', 0x88),
-                ('KEY_YEN',              0x89),
-                ('KEY_HENKAN',           0x8a),
-                ('KEY_MUHENKAN',         0x8b),
-                ('KEY_KPJPCOMMA',        0x8c),
-                ('KEY_HANGEUL',          0x90),
-                ('KEY_HANJA',            0x91),
-                ('KEY_KATAKANA',         0x92),
-                ('KEY_HIRAGANA',         0x93),
-                ('KEY_ZENKAKUHANKAKU',   0x94),
-                ('KEY_KPLEFTPAREN',      0xb6),
-                ('KEY_KPRIGHTPAREN',     0xb7),
-                ('KEY_LEFTCTRL',         0xe0),
-                ('KEY_LEFTSHIFT',        0xe1),
-                ('KEY_LEFTALT',          0xe2),
-                ('KEY_LEFTMETA',         0xe3),
-                ('KEY_RIGHTCTRL',        0xe4),
-                ('KEY_RIGHTSHIFT',       0xe5),
-                ('KEY_RIGHTALT',         0xe6),
-                ('KEY_RIGHTMETA',        0xe7),
-                ('KEY_PLAYPAUSE',        0xe8),
-                ('KEY_STOPCD',           0xe9),
-                ('KEY_PREVIOUSSONG',     0xea),
-                ('KEY_NEXTSONG',         0xeb),
-                ('KEY_EJECTCD',          0xec),
-                ('KEY_VOLUMEUP',         0xed),
-                ('KEY_VOLUMEDOWN',       0xee),
-                ('KEY_MUTE',             0xef),
-                ('KEY_WWW',              0xf0),
-                ('KEY_BACK',             0xf1),
-                ('KEY_FORWARD',          0xf2),
-                ('KEY_STOP',             0xf3),
-                ('KEY_FIND',             0xf4),
-                ('KEY_SCROLLUP',         0xf5),
-                ('KEY_SCROLLDOWN',       0xf6),
-                ('KEY_EDIT',             0xf7),
-                ('KEY_SLEEP',            0xf8),
-                ('KEY_COFFEE',           0xf9),
-                ('KEY_REFRESH',          0xfa),
-                ('KEY_CALC',             0xfb),
-            ]
-        }
-        evdev_button_to_hid_code = {
-            libevdev.evbit(k): v for k, v in
-            [
-                ('BTN_LEFT',   0b00001),
-                ('BTN_RIGHT',  0b00010),
-                ('BTN_MIDDLE', 0b00100),
-                ('BTN_SIDE',   0b01000),
-                ('BTN_EXTRA',  0b10000),
-            ]
+    @property
+    def consumed_event_types(self) -> Set[libevdev.EventType]:
+        return {libevdev.EV_KEY, libevdev.EV_REL, libevdev.EV_ABS}
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            **super().stats,
+            'queue_depth': self._device.writer.queue_depth,
+            'dropped_reports': self._device.writer.dropped_reports,
         }
+
+    def close(self):
+        super().close()
+        self._device.close()
+
+    def _create_device(self):
+        _EV_KEY = libevdev.EV_KEY.value
+        _EV_REL = libevdev.EV_REL.value
+        _REL_X = libevdev.EV_REL.REL_X.value
+        _REL_Y = libevdev.EV_REL.REL_Y.value
+        _REL_WHEEL = libevdev.EV_REL.REL_WHEEL.value
+        _REL_HWHEEL = libevdev.EV_REL.REL_HWHEEL.value
+        _EV_ABS = libevdev.EV_ABS.value
+        absinfo = {c.value: (ai.minimum, ai.maximum) for c, ai in self._absinfo.items()}
         class _HidGadgetDevice:
             _REPORT_ID_KEY = 0x01
             _REPORT_ID_MOUSE = 0x02
+            _REPORT_ID_NKRO_KEY = 0x03
+            _REPORT_ID_POINTER = 0x04
+            _REPORT_ID_TOUCHPAD = 0x05
             _HID_MODIFIER_BEGIN = 0xe0 # left control
             _HID_MODIFIER_END = 0xe7 # right meta
-            def __init__(self):
+            _HID_ERROR_ROLL_OVER = 0x01
+            _BOOT_KEY_COUNT = 6
+            def __init__(
+                self,
+                path: str,
+                poll_interval: float,
+                keyboard_report: str,
+                runtime: Optional[Runtime],
+            ):
+                self._writer = HidGadgetWriter(path, runtime)
                 # key
-                self._key_report = bytearray(8)
-                self._modifier_byte = memoryview(self._key_report)[0:1]
-                # byte 1 unused
-                self._key_bytes = memoryview(self._key_report)[2:]
+                self._nkro = keyboard_report == 'nkro'
+                if self._nkro:
+                    # report[0] modifiers
+                    # report[1:33] one bit per usage 0x00-0xff, the bits of
+                    # the modifier usages are constant padding
+                    self._key_report_id = self._REPORT_ID_NKRO_KEY
+                    self._key_report = bytearray(33)
+                    self._modifier_byte = memoryview(self._key_report)[0:1]
+                    self._key_bytes = memoryview(self._key_report)[1:]
+                else:
+                    self._key_report_id = self._REPORT_ID_KEY
+                    self._key_report = bytearray(8)
+                    self._modifier_byte = memoryview(self._key_report)[0:1]
+                    # byte 1 unused
+                    self._key_bytes = memoryview(self._key_report)[2:]
+                # pressed keys in boot mode, may be more than fit the report
+                self._boot_keys: List[int] = []
 
                 # mouse
                 # report[0] buttons
@@ -750,77 +1656,176 @@ class HidGadgetDestinationDevice(DestinationDevice):
                 # report[2] rel y
                 # report[3] wheel
                 # report[4] hwheel
-                self._mouse_report = bytearray(5)
+                self._mouse_buttons = 0
+                self._mouse_scheduler = HidMouseReportScheduler(
+                    self._REPORT_ID_MOUSE,
+                    self._send_report,
+                    poll_interval,
+                    runtime,
+                    path,
+                )
+
+                # absolute pointer or touchpad depending on the source
+                self._absolute: Optional[Union[HidAbsolutePointerEncoder, HidTouchpadEncoder]] = None
+                if {
+                    libevdev.EV_ABS.ABS_MT_SLOT.value,
+                    libevdev.EV_ABS.ABS_MT_POSITION_X.value,
+                    libevdev.EV_ABS.ABS_MT_POSITION_Y.value,
+                } <= absinfo.keys():
+                    self._absolute = HidTouchpadEncoder(
+                        self._REPORT_ID_TOUCHPAD,
+                        self._send_report,
+                        absinfo,
+                        runtime,
+                        path,
+                    )
+                elif {libevdev.EV_ABS.ABS_X.value, libevdev.EV_ABS.ABS_Y.value} <= absinfo.keys():
+                    self._absolute = HidAbsolutePointerEncoder(
+                        self._REPORT_ID_POINTER,
+                        self._send_report,
+                        absinfo,
+                    )
+            @property
+            def writer(self) -> HidGadgetWriter:
+                return self._writer
+            def close(self):
+                self._mouse_scheduler.close()
+                if isinstance(self._absolute, HidTouchpadEncoder):
+                    self._absolute.close()
+                self._writer.close()
             def send_events(self, events: List[libevdev.InputEvent]):
-                key_event = None
+                # every event of the frame goes into one report per type
                 rel_x_val = 0
                 rel_y_val = 0
                 rel_wheel_val = 0
                 rel_hwheel_val = 0
-                for event in events:
-                    if event.type == libevdev.EV_KEY:
-                        key_event = event
-                    elif event.type == libevdev.EV_REL:
-                        if event.code == libevdev.EV_REL.REL_X:
-                            rel_x_val = event.value
-                        elif event.code == libevdev.EV_REL.REL_Y:
-                            rel_y_val = event.value
-                        elif event.code in {libevdev.EV_REL.REL_WHEEL, libevdev.EV_REL.REL_WHEEL_HI_RES}:
-                            rel_wheel_val = event.value
-                        elif event.code in {libevdev.EV_REL.REL_HWHEEL, libevdev.EV_REL.REL_HWHEEL_HI_RES}:
-                            rel_hwheel_val = event.value
                 keys_changed = False
                 mouse_changed = False
-                if key_event:
-                    if libevdev.EV_KEY.BTN_LEFT <= key_event.code <= libevdev.EV_KEY.BTN_EXTRA:
-                        hid_code = evdev_button_to_hid_code.get(key_event.code)
-                        if hid_code is not None:
-                            if key_event.value == 1:
-                                self._mouse_report[0] |= hid_code
-                            elif key_event.value == 0:
-                                self._mouse_report[0] &= ~hid_code
-                            mouse_changed = True
-                    else:
-                        hid_code = evdev_key_to_hid_code.get(key_event.code)
-                        if hid_code is not None:
-                            if key_event.value == 1:
+                for event in events:
+                    type_ = event.type.value
+                    if type_ == _EV_KEY:
+                        value = event.value
+                        # ignore autorepeat, the host repeats keys itself
+                        if value == 2:
+                            continue
+                        code = event.code.value
+                        if self._absolute is not None and self._absolute.handle_button(code, value):
+                            continue
+                        hid_code = EVDEV_KEY_TO_HID_USAGE[code]
+                        if hid_code:
+                            if value:
                                 self._add_keycode_to_report(hid_code)
-                            elif key_event.value == 0:
+                            else:
                                 self._remove_keycode_from_report(hid_code)
                             keys_changed = True
+                            continue
+                        hid_button = EVDEV_BUTTON_TO_HID_BUTTON[code]
+                        if hid_button:
+                            if value:
+                                self._mouse_buttons |= hid_button
+                            else:
+                                self._mouse_buttons &= ~hid_button
+                            mouse_changed = True
+                    elif type_ == _EV_REL:
+                        # the high resolution wheel codes duplicate REL_WHEEL
+                        # and REL_HWHEEL in 1/120 units
+                        code = event.code.value
+                        if code == _REL_X:
+                            rel_x_val += event.value
+                        elif code == _REL_Y:
+                            rel_y_val += event.value
+                        elif code == _REL_WHEEL:
+                            rel_wheel_val += event.value
+                        elif code == _REL_HWHEEL:
+                            rel_hwheel_val += event.value
+                    elif type_ == _EV_ABS:
+                        if self._absolute is not None:
+                            self._absolute.handle_abs(event.code.value, event.value)
                 if rel_x_val or rel_y_val or rel_wheel_val or rel_hwheel_val:
-                    self._mouse_report[1] = rel_x_val & 0xff
-                    self._mouse_report[2] = rel_y_val & 0xff
-                    self._mouse_report[3] = rel_wheel_val & 0xff
-                    self._mouse_report[4] = rel_hwheel_val & 0xff
                     mouse_changed = True
                 if keys_changed:
-                    self._send_report(bytes([self._REPORT_ID_KEY]) + self._key_report)
+                    self._send_report(bytes([self._key_report_id]) + self._key_report)
+                if self._absolute is not None:
+                    self._absolute.flush()
                 if mouse_changed:
-                    self._send_report(bytes([self._REPORT_ID_MOUSE]) + self._mouse_report)
-                    # reset relative event bits
-                    for i in range(1, 5):
-                        self._mouse_report[i] = 0
+                    # reports are emitted at most once per USB polling interval
+                    self._mouse_scheduler.update(
+                        self._mouse_buttons,
+                        rel_x_val,
+                        rel_y_val,
+                        rel_wheel_val,
+                        rel_hwheel_val,
+                    )
             def _add_keycode_to_report(self, code):
                 if self._HID_MODIFIER_BEGIN <= code <= self._HID_MODIFIER_END:
                     self._modifier_byte[0] |= 1 << (code - self._HID_MODIFIER_BEGIN)
                     return
-                for i in range(6):
-                    if self._key_bytes[i] == code:
-                        return
-                for i in range(6):
-                    if self._key_bytes[i] == 0:
-                        self._key_bytes[i] = code
-                        return
-                # TODO too many keys pressed
+                if self._nkro:
+                    self._key_bytes[code >> 3] |= 1 << (code & 7)
+                    return
+                if code not in self._boot_keys:
+                    self._boot_keys.append(code)
+                    self._update_boot_key_bytes()
             def _remove_keycode_from_report(self, code):
                 if self._HID_MODIFIER_BEGIN <= code <= self._HID_MODIFIER_END:
                     self._modifier_byte[0] &= ~(1 << (code - self._HID_MODIFIER_BEGIN))
                     return
-                for i in range(6):
-                    if self._key_bytes[i] == code:
-                        self._key_bytes[i] = 0
+                if self._nkro:
+                    self._key_bytes[code >> 3] &= ~(1 << (code & 7))
+                    return
+                if code in self._boot_keys:
+                    self._boot_keys.remove(code)
+                    self._update_boot_key_bytes()
+            def _update_boot_key_bytes(self):
+                keys = self._boot_keys
+                if len(keys) > self._BOOT_KEY_COUNT:
+                    # too many keys pressed, the host keeps the previously
+                    # reported keys until the keys fit the report again
+                    self._key_bytes[:] = bytes([self._HID_ERROR_ROLL_OVER]) * self._BOOT_KEY_COUNT
+                else:
+                    self._key_bytes[:] = bytes(keys) + bytes(self._BOOT_KEY_COUNT - len(keys))
             def _send_report(self, report):
-                with open('/dev/hidg0', 'wb') as f:
-                    f.write(report)
-        return _HidGadgetDevice()
+                self._writer.write(report)
+        return _HidGadgetDevice(
+            self._properties.get('device', '/dev/hidg0'),
+            self._properties.get('poll_interval', 0.001),
+            self._properties.get('keyboard_report', 'boot'),
+            self._runtime,
+        )
+
+def _serialize_device(
+    type_name: str,
+    name: str,
+    id: Dict[str, int],
+    evbits: Dict[libevdev.EventType, List[libevdev.EventCode]],
+    absinfo: Dict[libevdev.EventCode, libevdev.InputAbsInfo],
+    rep_value: Dict[libevdev.EventCode, int],
+    input_properties: List[libevdev.InputProperty],
+) -> Dict:
+    # descriptor format of DescriptorSourceDevice
+    return {
+        'type': type_name,
+        'name': name,
+        'id': id,
+        'evbits': {
+            t.value: [sc.value for sc in c]
+            for t, c
+            in evbits.items()
+        },
+        'absinfo': {
+            c.value: {
+                'minimum': ai.minimum,
+                'maximum': ai.maximum,
+                'fuzz': ai.fuzz,
+                'flat': ai.flat,
+                'resolution': ai.resolution,
+                'value': ai.value,
+            }
+            for c, ai in absinfo.items()
+        },
+        'rep_value': {
+            c.value: v
+            for c, v in rep_value.items()
+        },
+        'properties': [p.value for p in input_properties],
+    }
@@ -0,0 +1,625 @@
+import os
+import errno
+import select
+import threading
+import collections
+import time
+import array
+import struct
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import libevdev
+
+from .runtime import Runtime
+from . import log
+
+# highest EV_KEY code, linux/input-event-codes.h
+_KEY_MAX = 0x2ff
+
+_EVDEV_KEY_NAME_TO_HID_USAGE = [
+    # later entries override earlier ones
+    ('KEY_A',                0x04),
+    ('KEY_B',                0x05),
+    ('KEY_C',                0x06),
+    ('KEY_D',                0x07),
+    ('KEY_E',                0x08),
+    ('KEY_F',                0x09),
+    ('KEY_G',                0x0a),
+    ('KEY_H',                0x0b),
+    ('KEY_I',                0x0c),
+    ('KEY_J',                0x0d),
+    ('KEY_K',                0x0e),
+    ('KEY_L',                0x0f),
+    ('KEY_M',                0x10),
+    ('KEY_N',                0x11),
+    ('KEY_O',                0x12),
+    ('KEY_P',                0x13),
+    ('KEY_Q',                0x14),
+    ('KEY_R',                0x15),
+    ('KEY_S',                0x16),
+    ('KEY_T',                0x17),
+    ('KEY_U',                0x18),
+    ('KEY_V',                0x19),
+    ('KEY_W',                0x1a),
+    ('KEY_X',                0x1b),
+    ('KEY_Y',                0x1c),
+    ('KEY_Z',                0x1d),
+    ('KEY_1',                0x1e),
+    ('KEY_2',                0x1f),
+    ('KEY_3',                0x20),
+    ('KEY_4',                0x21),
+    ('KEY_5',                0x22),
+    ('KEY_6',                0x23),
+    ('KEY_7',                0x24),
+    ('KEY_8',                0x25),
+    ('KEY_9',                0x26),
+    ('KEY_0',                0x27),
+    ('KEY_ENTER',            0x28),
+    ('KEY_ESC',              0x29),
+    ('KEY_BACKSPACE',        0x2a),
+    ('KEY_TAB',              0x2b),
+    ('KEY_SPACE',            0x2c),
+    ('KEY_MINUS',            0x2d),
+    ('KEY_EQUAL',            0x2e),
+    ('KEY_LEFTBRACE',        0x2f),
+    ('KEY_RIGHTBRACE',       0x30),
+    ('KEY_BACKSLASH',        0x31),
+    ('KEY_BACKSLASH',        0x32),
+    ('KEY_SEMICOLON',        0x33),
+    ('KEY_APOSTROPHE',       0x34),
+    ('KEY_GRAVE',            0x35),
+    ('KEY_COMMA',            0x36),
+    ('KEY_DOT',              0x37),
+    ('KEY_SLASH',            0x38),
+    ('KEY_CAPSLOCK',         0x39),
+    ('KEY_F1',               0x3a),
+    ('KEY_F2',               0x3b),
+    ('KEY_F3',               0x3c),
+    ('KEY_F4',               0x3d),
+    ('KEY_F5',               0x3e),
+    ('KEY_F6',               0x3f),
+    ('KEY_F7',               0x40),
+    ('KEY_F8',               0x41),
+    ('KEY_F9',               0x42),
+    ('KEY_F10',              0x43),
+    ('KEY_F11',              0x44),
+    ('KEY_F12',              0x45),
+    ('KEY_SYSRQ',            0x46),
+    ('KEY_SCROLLLOCK',       0x47),
+    ('KEY_PAUSE',            0x48),
+    ('KEY_INSERT',           0x49),
+    ('KEY_HOME',             0x4a),
+    ('KEY_PAGEUP',           0x4b),
+    ('KEY_DELETE',           0x4c),
+    ('KEY_END',              0x4d),
+    ('KEY_PAGEDOWN',         0x4e),
+    ('KEY_RIGHT',            0x4f),
+    ('KEY_LEFT',             0x50),
+    ('KEY_DOWN',             0x51),
+    ('KEY_UP',               0x52),
+    ('KEY_NUMLOCK',          0x53),
+    ('KEY_KPSLASH',          0x54),
+    ('KEY_KPASTERISK',       0x55),
+    ('KEY_KPMINUS',          0x56),
+    ('KEY_KPPLUS',           0x57),
+    ('KEY_KPENTER',          0x58),
+    ('KEY_KP1',              0x59),
+    ('KEY_KP2',              0x5a),
+    ('KEY_KP3',              0x5b),
+    ('KEY_KP4',              0x5c),
+    ('KEY_KP5',              0x5d),
+    ('KEY_KP6',              0x5e),
+    ('KEY_KP7',              0x5f),
+    ('KEY_KP8',              0x60),
+    ('KEY_KP9',              0x61),
+    ('KEY_KP0',              0x62),
+    ('KEY_KPDOT',            0x63),
+    ('KEY_102ND',            0x64),
+    ('KEY_COMPOSE',          0x65),
+    ('KEY_POWER',            0x66),
+    ('KEY_KPEQUAL',          0x67),
+    ('KEY_F13',              0x68),
+    ('KEY_F14',              0x69),
+    ('KEY_F15',              0x6a),
+    ('KEY_F16',              0x6b),
+    ('KEY_F17',              0x6c),
+    ('KEY_F18',              0x6d),
+    ('KEY_F19',              0x6e),
+    ('KEY_F20',              0x6f),
+    ('KEY_F21',              0x70),
+    ('KEY_F22',              0x71),
+    ('KEY_F23',              0x72),
+    ('KEY_F24',              0x73),
+    ('KEY_OPEN',             0x74),
+    ('KEY_HELP',             0x75),
+    ('KEY_PROPS',            0x76),
+    ('KEY_FRONT',            0x77),
+    ('KEY_STOP',             0x78),
+    ('KEY_AGAIN',            0x79),
+    ('KEY_UNDO',             0x7a),
+    ('KEY_CUT',              0x7b),
+    ('KEY_COPY',             0x7c),
+    ('KEY_PASTE',            0x7d),
+    ('KEY_FIND',             0x7e),
+    ('KEY_MUTE',             0x7f),
+    ('KEY_VOLUMEUP',         0x80),
+    ('KEY_VOLUMEDOWN',       0x81),
+    ('KEY_KPCOMMA',          0x85),
+    ('KEY_RO',               0x87),
+    ('KEY_KATAKANAHIRAGANA', 0x88),
+    ('KEY_YEN',              0x89),
+    ('KEY_HENKAN',           0x8a),
+    ('KEY_MUHENKAN',         0x8b),
+    ('KEY_KPJPCOMMA',        0x8c),
+    ('KEY_HANGEUL',          0x90),
+    ('KEY_HANJA',            0x91),
+    ('KEY_KATAKANA',         0x92),
+    ('KEY_HIRAGANA',         0x93),
+    ('KEY_ZENKAKUHANKAKU',   0x94),
+    ('KEY_KPLEFTPAREN',      0xb6),
+    ('KEY_KPRIGHTPAREN',     0xb7),
+    ('KEY_LEFTCTRL',         0xe0),
+    ('KEY_LEFTSHIFT',        0xe1),
+    ('KEY_LEFTALT',          0xe2),
+    ('KEY_LEFTMETA',         0xe3),
+    ('KEY_RIGHTCTRL',        0xe4),
+    ('KEY_RIGHTSHIFT',       0xe5),
+    ('KEY_RIGHTALT',         0xe6),
+    ('KEY_RIGHTMETA',        0xe7),
+    ('KEY_PLAYPAUSE',        0xe8),
+    ('KEY_STOPCD',           0xe9),
+    ('KEY_PREVIOUSSONG',     0xea),
+    ('KEY_NEXTSONG',         0xeb),
+    ('KEY_EJECTCD',          0xec),
+    ('KEY_VOLUMEUP',         0xed),
+    ('KEY_VOLUMEDOWN',       0xee),
+    ('KEY_MUTE',             0xef),
+    ('KEY_WWW',              0xf0),
+    ('KEY_BACK',             0xf1),
+    ('KEY_FORWARD',          0xf2),
+    ('KEY_STOP',             0xf3),
+    ('KEY_FIND',             0xf4),
+    ('KEY_SCROLLUP',         0xf5),
+    ('KEY_SCROLLDOWN',       0xf6),
+    ('KEY_EDIT',             0xf7),
+    ('KEY_SLEEP',            0xf8),
+    ('KEY_COFFEE',           0xf9),
+    ('KEY_REFRESH',          0xfa),
+    ('KEY_CALC',             0xfb),
+]
+
+_EVDEV_BUTTON_NAME_TO_HID_BUTTON = [
+    ('BTN_LEFT',   0b00001),
+    ('BTN_RIGHT',  0b00010),
+    ('BTN_MIDDLE', 0b00100),
+    ('BTN_SIDE',   0b01000),
+    ('BTN_EXTRA',  0b10000),
+]
+
+def _build_table(names_to_values) -> array.array:
+    # dense EV_KEY code -> value table, 0 when unmapped
+    table = array.array('B', bytes(_KEY_MAX + 1))
+    for name, value in names_to_values:
+        table[libevdev.evbit(name).value] = value
+    return table
+
+EVDEV_KEY_TO_HID_USAGE = _build_table(_EVDEV_KEY_NAME_TO_HID_USAGE)
+EVDEV_BUTTON_TO_HID_BUTTON = _build_table(_EVDEV_BUTTON_NAME_TO_HID_BUTTON)
+
+class HidGadgetWriter:
+    # reports waiting for the endpoint, the oldest are dropped when full
+    _MAX_QUEUED_REPORTS = 64
+
+    def __init__(self, path: str, runtime: Optional[Runtime] = None):
+        self._path = path
+        self._runtime = runtime
+        self._fd: Optional[int] = None
+        self._queue: Deque[bytes] = collections.deque(maxlen=self._MAX_QUEUED_REPORTS)
+        self._condition = threading.Condition()
+        self._available = True
+        self._dropped_reports = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._flush_queue)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def dropped_reports(self) -> int:
+        return self._dropped_reports
+
+    def write(self, report: bytes):
+        with self._condition:
+            if self._closed:
+                return
+            # keep the order of reports
+            if self._queue:
+                self._enqueue(report)
+                return
+            fd = self._get_fd()
+            if fd is None:
+                self._dropped_reports += 1
+                return
+            try:
+                os.write(fd, report)
+            except BlockingIOError:
+                self._enqueue(report)
+            except OSError as e:
+                self._handle_error(e)
+                self._dropped_reports += 1
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        with self._condition:
+            self._queue.clear()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _enqueue(self, report: bytes):
+        if len(self._queue) == self._queue.maxlen:
+            self._dropped_reports += 1
+        self._queue.append(report)
+        self._condition.notify()
+
+    def _get_fd(self) -> Optional[int]:
+        if self._fd is None:
+            try:
+                # the gadget endpoint only exists while the USB host has the
+                # device configured, reopen lazily after disconnects
+                self._fd = os.open(self._path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                self._set_available(False, e)
+                return None
+            self._set_available(True)
+        return self._fd
+
+    def _handle_error(self, e: OSError):
+        # ESHUTDOWN when the host disconnects, EPIPE for a FIFO without reader
+        self._set_available(False, e)
+        self._queue.clear()
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def _set_available(self, available: bool, e: Optional[OSError] = None):
+        if available != self._available:
+            self._available = available
+            if available:
+                log.info(f'HID gadget {self._path} available')
+            else:
+                log.warning(f'HID gadget {self._path} unavailable: {errno.errorcode.get(e.errno, e) if e else None}')
+
+    def _flush_queue(self):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'hid writer {self._path}')
+        poll = select.poll()
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                fd = self._fd
+            if fd is None:
+                with self._condition:
+                    self._queue.clear()
+                continue
+            try:
+                poll.register(fd, select.POLLOUT)
+            except (OSError, ValueError):
+                # closed concurrently
+                continue
+            try:
+                poll.poll(100)
+            finally:
+                poll.unregister(fd)
+            with self._condition:
+                while self._queue and self._fd is not None:
+                    try:
+                        os.write(self._fd, self._queue[0])
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        self._handle_error(e)
+                        break
+                    self._queue.popleft()
+
+class HidMouseReportScheduler:
+    # logical range of the relative axes in the report descriptor
+    _MIN_VALUE = -127
+    _MAX_VALUE = 127
+
+    def __init__(
+        self,
+        report_id: int,
+        send_report: Callable[[bytes], None],
+        interval: float,
+        runtime: Optional[Runtime] = None,
+        name: str = '',
+    ):
+        self._report_id = report_id
+        self._send_report = send_report
+        self._interval = interval
+        self._runtime = runtime
+        self._name = name
+        self._condition = threading.Condition()
+        self._buttons = 0
+        # accumulated motion that has not been reported yet
+        self._x = 0
+        self._y = 0
+        self._wheel = 0
+        self._hwheel = 0
+        self._last_report_time = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def update(self, buttons: int, x: int, y: int, wheel: int, hwheel: int):
+        with self._condition:
+            buttons_changed = buttons != self._buttons
+            self._buttons = buttons
+            self._x += x
+            self._y += y
+            self._wheel += wheel
+            self._hwheel += hwheel
+            now = time.monotonic()
+            # button changes are never delayed so that short clicks are not lost
+            if buttons_changed or now - self._last_report_time >= self._interval:
+                self._emit(now)
+            # also for the remainder of clamped motion
+            self._condition.notify()
+
+    def close(self):
+        # motion that has not been reported yet is dropped
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _has_motion(self) -> bool:
+        return bool(self._x or self._y or self._wheel or self._hwheel)
+
+    def _take(self, value: int) -> int:
+        return max(self._MIN_VALUE, min(self._MAX_VALUE, value))
+
+    def _emit(self, now: float):
+        # clamp to the report range and carry the remainder to the next report
+        x = self._take(self._x)
+        y = self._take(self._y)
+        wheel = self._take(self._wheel)
+        hwheel = self._take(self._hwheel)
+        self._x -= x
+        self._y -= y
+        self._wheel -= wheel
+        self._hwheel -= hwheel
+        self._last_report_time = now
+        self._send_report(bytes([
+            self._report_id,
+            self._buttons,
+            x & 0xff,
+            y & 0xff,
+            wheel & 0xff,
+            hwheel & 0xff,
+        ]))
+
+    def _run(self):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'hid mouse {self._name}')
+        with self._condition:
+            while not self._closed:
+                if not self._has_motion():
+                    self._condition.wait()
+                    continue
+                delay = self._last_report_time + self._interval - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._emit(time.monotonic())
+
+class HidAbsoluteAxis:
+    # logical maximum of the absolute axes in the report descriptor
+    LOGICAL_MAXIMUM = 0x7fff
+
+    def __init__(self, minimum: int, maximum: int):
+        # affine map from the evdev range to 0..LOGICAL_MAXIMUM
+        self._scale = self.LOGICAL_MAXIMUM / max(maximum - minimum, 1)
+        self._offset = -minimum * self._scale
+
+    def scale(self, value: int) -> int:
+        return max(0, min(self.LOGICAL_MAXIMUM, int(value * self._scale + self._offset)))
+
+class HidAbsolutePointerEncoder:
+    _ABS_X = libevdev.EV_ABS.ABS_X.value
+    _ABS_Y = libevdev.EV_ABS.ABS_Y.value
+    # BTN_TOUCH is the tip of touchscreens and tablets, reported as the
+    # primary button
+    _BUTTONS = {
+        libevdev.EV_KEY.BTN_TOUCH.value: 0b00001,
+        **{libevdev.evbit(name).value: bit for name, bit in _EVDEV_BUTTON_NAME_TO_HID_BUTTON},
+    }
+
+    def __init__(
+        self,
+        report_id: int,
+        send_report: Callable[[bytes], None],
+        absinfo: Dict[int, Tuple[int, int]],
+    ):
+        self._report_id = report_id
+        self._send_report = send_report
+        self._x_axis = HidAbsoluteAxis(*absinfo[self._ABS_X])
+        self._y_axis = HidAbsoluteAxis(*absinfo[self._ABS_Y])
+        # report[0] buttons
+        # report[1:3] x
+        # report[3:5] y
+        self._report = bytearray(5)
+        self._changed = False
+
+    def handle_button(self, code: int, value: int) -> bool:
+        bit = self._BUTTONS.get(code)
+        if bit is None:
+            return False
+        if value:
+            self._report[0] |= bit
+        else:
+            self._report[0] &= ~bit
+        self._changed = True
+        return True
+
+    def handle_abs(self, code: int, value: int):
+        if code == self._ABS_X:
+            struct.pack_into('<H', self._report, 1, self._x_axis.scale(value))
+            self._changed = True
+        elif code == self._ABS_Y:
+            struct.pack_into('<H', self._report, 3, self._y_axis.scale(value))
+            self._changed = True
+
+    def flush(self):
+        if self._changed:
+            self._changed = False
+            self._send_report(bytes([self._report_id]) + self._report)
+
+class HidTouchpadEncoder:
+    # hybrid mode: contacts of one frame are split over several reports and
+    # the contact count is only set in the first one
+    CONTACTS_PER_REPORT = 2
+    MAX_CONTACTS = 16
+    # the Linux host releases contacts that have not been reported for 100 ms
+    _KEEPALIVE_INTERVAL = 0.05
+    _CONTACT_SIZE = 6
+
+    _ABS_MT_SLOT = libevdev.EV_ABS.ABS_MT_SLOT.value
+    _ABS_MT_TRACKING_ID = libevdev.EV_ABS.ABS_MT_TRACKING_ID.value
+    _ABS_MT_POSITION_X = libevdev.EV_ABS.ABS_MT_POSITION_X.value
+    _ABS_MT_POSITION_Y = libevdev.EV_ABS.ABS_MT_POSITION_Y.value
+    _BTN_LEFT = libevdev.EV_KEY.BTN_LEFT.value
+
+    def __init__(
+        self,
+        report_id: int,
+        send_report: Callable[[bytes], None],
+        absinfo: Dict[int, Tuple[int, int]],
+        runtime: Optional[Runtime] = None,
+        name: str = '',
+    ):
+        self._report_id = report_id
+        self._send_report = send_report
+        self._runtime = runtime
+        self._name = name
+        self._x_axis = HidAbsoluteAxis(*absinfo[self._ABS_MT_POSITION_X])
+        self._y_axis = HidAbsoluteAxis(*absinfo[self._ABS_MT_POSITION_Y])
+        slot_minimum, slot_maximum = absinfo[self._ABS_MT_SLOT]
+        self._slot_count = min(slot_maximum - slot_minimum + 1, self.MAX_CONTACTS)
+        self._condition = threading.Condition()
+        # per slot state, the slot number is used as the contact id
+        self._slot = 0
+        self._active = [False] * self._slot_count
+        self._x = [0] * self._slot_count
+        self._y = [0] * self._slot_count
+        self._changed = [False] * self._slot_count
+        self._buttons = 0
+        self._buttons_changed = False
+        self._last_report_time = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._keepalive)
+        self._thread.start()
+
+    def handle_button(self, code: int, value: int) -> bool:
+        # clickpad button, touch and tool buttons are implied by the contacts
+        if code != self._BTN_LEFT:
+            return False
+        with self._condition:
+            self._buttons = 1 if value else 0
+            self._buttons_changed = True
+        return True
+
+    def handle_abs(self, code: int, value: int):
+        with self._condition:
+            if code == self._ABS_MT_SLOT:
+                self._slot = value
+                return
+            slot = self._slot
+            if not 0 <= slot < self._slot_count:
+                return
+            if code == self._ABS_MT_TRACKING_ID:
+                self._active[slot] = value >= 0
+                self._changed[slot] = True
+            elif code == self._ABS_MT_POSITION_X:
+                self._x[slot] = self._x_axis.scale(value)
+                self._changed[slot] = True
+            elif code == self._ABS_MT_POSITION_Y:
+                self._y[slot] = self._y_axis.scale(value)
+                self._changed[slot] = True
+
+    def flush(self):
+        with self._condition:
+            slots = [slot for slot in range(self._slot_count) if self._changed[slot]]
+            if slots or self._buttons_changed:
+                self._emit(slots)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _emit(self, slots: List[int]):
+        # only the contacts that changed since the previous frame
+        for slot in slots:
+            self._changed[slot] = False
+        self._buttons_changed = False
+        self._last_report_time = time.monotonic()
+        contact_count = len(slots)
+        for i in range(0, max(contact_count, 1), self.CONTACTS_PER_REPORT):
+            # report[0] report id
+            # report[1:13] contacts: tip switch, contact id, x, y
+            # report[13] contact count
+            # report[14] buttons
+            report = bytearray(3 + self.CONTACTS_PER_REPORT * self._CONTACT_SIZE)
+            report[0] = self._report_id
+            offset = 1
+            for slot in slots[i:i + self.CONTACTS_PER_REPORT]:
+                struct.pack_into(
+                    '<BBHH',
+                    report,
+                    offset,
+                    1 if self._active[slot] else 0,
+                    slot,
+                    self._x[slot],
+                    self._y[slot],
+                )
+                offset += self._CONTACT_SIZE
+            report[-2] = contact_count if i == 0 else 0
+            report[-1] = self._buttons
+            self._send_report(bytes(report))
+
+    def _keepalive(self):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'hid touchpad {self._name}')
+        with self._condition:
+            while not self._closed:
+                if not any(self._active):
+                    self._condition.wait()
+                    continue
+                delay = self._last_report_time + self._KEEPALIVE_INTERVAL - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                # resend stationary contacts
+                self._emit([slot for slot in range(self._slot_count) if self._active[slot]])
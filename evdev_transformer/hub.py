@@ -1,11 +1,20 @@
 import threading
+import os
+import asyncio
+import time
 from typing import (
     List,
     Dict,
+    Set,
     Tuple,
-    Iterable,
+    Optional,
+    Union,
+    AsyncIterator,
 )
 import functools
+import json
+
+import libevdev
 
 from .config import (
     ConfigManager,
@@ -18,9 +27,11 @@ from .config import (
     SubprocessDestination,
     HidGadgetDestination,
     Link,
+    HotkeyActivator,
 )
 from .system_events import InputDeviceMonitor
 from .device import (
+    DestinationSender,
     SourceDevice,
     EvdevSourceDevice,
     UnixSocketSourceDevice,
@@ -32,24 +43,234 @@ from .device import (
 from .transform import (
     EventTransform,
 )
-from .ipc import IpcManager
+from .ipc import (
+    IpcManager,
+    IpcStream,
+)
+from .metrics import (
+    LinkLatency,
+    Sample,
+    flatten_samples,
+    format_samples,
+)
+from .control import ControlServer
+from .recording import EventRecorder
+from .profiling import (
+    TransformTiming,
+    format_profile,
+)
+from .runtime import Runtime
+from .tracing import (
+    TraceBuffer,
+    format_traces,
+)
 from . import log
 
 class Hub:
-    def __init__(self, config_manager: ConfigManager):
+    _LATENCY_REPORT_INTERVAL = 60.0
+
+    def __init__(self, config_manager: ConfigManager, latency_metrics: bool = False):
         self._config_manager = config_manager
+        self._latency_metrics = latency_metrics or config_manager.settings.latency_metrics
+        self._link_latencies: Dict[Tuple[str, str], LinkLatency] = {}
+        self._trace_size = config_manager.settings.trace_size
+        runtime_settings = config_manager.settings.runtime
+        self._runtime = Runtime(runtime_settings) if runtime_settings is not None else None
         self._device_monitor = InputDeviceMonitor()
         self._ipc_manager = IpcManager()
+        self._control_server = ControlServer()
+        self._control_server.add_command('metrics', self.get_metrics)
+        self._control_server.add_command('trace', self.get_traces)
+        self._control_server.add_command('record', self.start_recording)
+        self._control_server.add_command('record-stop', self.stop_recording)
+        self._control_server.add_command('profile', self.start_profiling)
+        self._control_server.add_command('profile-stop', self.stop_profiling)
+        self._control_server.add_command('timing-reset', self.reset_transform_timing)
+        self._control_server.add_command('runtime', self.get_runtime_settings)
         self._source_devices: List[SourceDevice] = []
         self._link_destination_device_cache: List[Tuple[str, str, DestinationDevice]] = []
         self._activated_links: Dict[str, str] = {}
         self._source_device_destination_device_pairs: List[Tuple[SourceDevice, DestinationDevice]] = []
+        # copy of the pairs that the IPC event loop reads without the lock
+        self._paired_destination_devices: Dict[SourceDevice, DestinationDevice] = {}
+        # only used by the IPC event loop
+        self._destination_senders: Dict[DestinationDevice, DestinationSender] = {}
         self._lock = threading.Lock()
+        self._links_updated = threading.Condition(self._lock)
 
     def start(self):
+        if self._runtime is not None:
+            self._runtime.apply_process()
         threading.Thread(target=self._monitor_devices).start()
         threading.Thread(target=self._monitor_config).start()
         threading.Thread(target=self._handle_ipc).start()
+        threading.Thread(target=self._control_server.run).start()
+        if self._latency_metrics:
+            threading.Thread(target=self._report_latency).start()
+
+    def add_source_device(self, source_device: SourceDevice):
+        # devices that are not discovered through udev or IPC, e.g. synthetic
+        # devices of the stress test
+        with self._lock:
+            self._source_devices.append(source_device)
+        threading.Thread(target=self._forward_events, args=(source_device,)).start()
+        self._update_links()
+
+    def remove_source_device(self, source_device: SourceDevice):
+        self._remove_source_device(source_device)
+
+    def get_latency_metrics(self) -> Dict[str, Dict]:
+        with self._lock:
+            link_latencies = list(self._link_latencies.items())
+        return {
+            f'{source_name} -> {destination_name}': latency.to_dict()
+            for (source_name, destination_name), latency in link_latencies
+        }
+
+    def reset_latency_metrics(self):
+        with self._lock:
+            link_latencies = list(self._link_latencies.values())
+        for latency in link_latencies:
+            latency.reset()
+
+    def get_metrics(self) -> str:
+        with self._lock:
+            source_devices = list(self._source_devices)
+            destination_devices = list(self._link_destination_device_cache)
+            link_latencies = list(self._link_latencies.items())
+        samples: List[Sample] = []
+        for source_device in source_devices:
+            labels = {
+                'source': source_device.name,
+                'identifier': json.dumps(source_device.identifier, sort_keys=True),
+            }
+            samples += flatten_samples('evdev_source', labels, source_device.stats)
+            for transform_name, stats in source_device.transform_stats:
+                samples += flatten_samples('evdev_transform', {**labels, 'transform': transform_name}, stats)
+            profile = source_device.profile
+            if profile is not None:
+                for event_code, count in profile.event_counts():
+                    samples.append((
+                        'evdev_profile_events',
+                        {**labels, 'type': event_code.type.name, 'code': event_code.name},
+                        count,
+                    ))
+                for stage, times in [('transform', profile.transform_times()), ('activator', profile.activator_times())]:
+                    for stage_name, events, ns in times:
+                        stage_labels = {**labels, stage: stage_name}
+                        samples.append((f'evdev_profile_{stage}_events', stage_labels, events))
+                        samples.append((f'evdev_profile_{stage}_ns', stage_labels, ns))
+        for source_name, destination_name, destination_device in destination_devices:
+            labels = {'source': source_name, 'destination': destination_name}
+            samples += flatten_samples('evdev_destination', labels, destination_device.stats)
+            if isinstance(destination_device, SubprocessDestinationDevice):
+                link_stats = destination_device.link_stats
+                if link_stats is not None:
+                    samples += flatten_samples('evdev_link', labels, link_stats)
+        for (source_name, destination_name), latency in link_latencies:
+            labels = {'source': source_name, 'destination': destination_name}
+            samples += flatten_samples('evdev_latency_ns', labels, latency.to_dict())
+        samples.append(('evdev_log_dropped_records', {}, log.dropped_records()))
+        return format_samples(samples)
+
+    def get_traces(self) -> str:
+        if not self._trace_size:
+            return 'tracing is disabled, see the trace_size setting\n'
+        with self._lock:
+            devices: List[Union[SourceDevice, DestinationDevice]] = [
+                *self._source_devices,
+                *(d for _, _, d in self._link_destination_device_cache),
+            ]
+        return format_traces(d.trace for d in devices if d.trace is not None)
+
+    def write_traces(self) -> str:
+        base_path = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+        path = os.path.join(base_path, f'evdev-trace-{time.strftime("%Y%m%d-%H%M%S")}.txt')
+        with open(path, 'w') as f:
+            f.write(self.get_traces())
+        log.info(f'wrote traces to {path}')
+        return path
+
+    def start_recording(self, source_name: str, path: str) -> str:
+        source_device = self._get_source_device(source_name)
+        if source_device.recorder is not None:
+            raise ValueError(f'already recording {source_name} to {source_device.recorder}')
+        source_device.set_recorder(EventRecorder(path, source_device.serialize()))
+        log.info(f'recording {source_device} to {path}')
+        return f'recording {source_name} to {path}\n'
+
+    def stop_recording(self, source_name: str) -> str:
+        source_device = self._get_source_device(source_name)
+        recorder = source_device.recorder
+        if recorder is None:
+            raise ValueError(f'not recording {source_name}')
+        source_device.set_recorder(None)
+        recorder.close()
+        log.info(f'stopped recording {source_device}')
+        return f'recorded {recorder.recorded_events} events\n'
+
+    def get_runtime_settings(self) -> str:
+        if self._runtime is None:
+            return 'runtime settings are not enabled\n'
+        return json.dumps(self._runtime.effective, indent=4) + '\n'
+
+    def start_profiling(self, source_name: str) -> str:
+        # shows the results so far when already profiling
+        source_device = self._get_source_device(source_name)
+        profile = source_device.profile
+        if profile is not None:
+            return format_profile(source_name, profile)
+        source_device.set_profiling(True)
+        log.info(f'profiling {source_device}')
+        return f'profiling {source_name}\n'
+
+    def stop_profiling(self, source_name: str) -> str:
+        source_device = self._get_source_device(source_name)
+        profile = source_device.profile
+        if profile is None:
+            raise ValueError(f'not profiling {source_name}')
+        source_device.set_profiling(False)
+        log.info(f'stopped profiling {source_device}')
+        self._reset_transform_timing(source_device)
+        return format_profile(source_name, profile)
+
+    def reset_transform_timing(self, source_name: str) -> str:
+        source_device = self._get_source_device(source_name)
+        if source_device.transform_timing is None:
+            raise ValueError('transform timing is not enabled')
+        self._reset_transform_timing(source_device)
+        return f'reset transform timing of {source_name}\n'
+
+    def _reset_transform_timing(self, source_device: SourceDevice):
+        # bypassed transforms run again
+        timing = source_device.transform_timing
+        if timing is not None:
+            timing.reset()
+            log.info(f'reset transform timing of {source_device}')
+
+    def _get_source_device(self, source_name: str) -> SourceDevice:
+        with self._lock:
+            for source in self._config_manager.sources:
+                if source.name != source_name:
+                    continue
+                for source_device in self._source_devices:
+                    if source_device.identifier == source.identifier:
+                        return source_device
+        raise ValueError(f'source {source_name} is not connected')
+
+    def _report_latency(self):
+        while True:
+            time.sleep(self._LATENCY_REPORT_INTERVAL)
+            for link, metrics in self.get_latency_metrics().items():
+                log.info(f'latency {link}: {metrics}')
+
+    def _get_link_latency(self, source_name: str, destination_name: str) -> Optional[LinkLatency]:
+        if not self._latency_metrics:
+            return None
+        key = (source_name, destination_name)
+        if key not in self._link_latencies:
+            self._link_latencies[key] = LinkLatency()
+        return self._link_latencies[key]
 
     def _update_links(self):
         with self._lock:
@@ -84,25 +305,126 @@ class Hub:
                         )
                         for a in link.activators
                     ])
-                    matching_devices[-1].set_transforms([EventTransform.from_config(t) for t in source.transforms])
+                    transforms = [
+                        EventTransform.from_config(t, matching_devices[-1].absinfo)
+                        for t in source.transforms + destination.transforms
+                    ]
+                    matching_devices[-1].set_transforms(
+                        transforms,
+                        self._get_transform_timing(matching_devices[-1]),
+                    )
+                    matching_devices[-1].set_latency(self._get_link_latency(source.name, destination.name))
+                    if matching_devices[-1].trace is None and self._trace_size:
+                        matching_devices[-1].set_trace(TraceBuffer(source.name, self._trace_size))
                     # activate current link and clean up old
                     if source.name not in self._activated_links:
                         self._activated_links[source.name] = destination.name
-                        destination_device = self._get_destination_device(source, destination, matching_devices[-1])
+                        destination_device = self._get_destination_device(
+                            source,
+                            destination,
+                            matching_devices[-1],
+                            transforms,
+                        )
                         for src, dst in self._source_device_destination_device_pairs:
                             if src is matching_devices[-1]:
                                 self._source_device_destination_device_pairs.remove((src, dst))
                                 break
                         self._source_device_destination_device_pairs.append((matching_devices[-1], destination_device))
-            for key in self._activated_links:
+                    for src, dst in self._source_device_destination_device_pairs:
+                        if src is matching_devices[-1]:
+                            matching_devices[-1].set_event_mask(
+                                self._get_event_mask(source, link, transforms, src, dst)
+                            )
+                            break
+            for key in list(self._activated_links):
                 if key not in seen_sources:
                     del self._activated_links[key]
+            self._paired_destination_devices = dict(self._source_device_destination_device_pairs)
+            self._links_updated.notify_all()
+
+    def _get_transform_timing(self, source_device: SourceDevice) -> Optional[TransformTiming]:
+        transform_timing = self._config_manager.settings.transform_timing
+        if transform_timing is None:
+            return None
+        threshold_ns = int(transform_timing['threshold_ms'] * 1_000_000)
+        bypass_after = transform_timing.get('bypass_after', 0)
+        # reused across link updates and switches unless the settings changed
+        timing = source_device.transform_timing
+        if timing is None or (timing.threshold_ns, timing.bypass_after) != (threshold_ns, bypass_after):
+            timing = TransformTiming(threshold_ns, bypass_after)
+        return timing
+
+    def _get_event_mask(
+        self,
+        source: Source,
+        link: Link,
+        transforms: List[EventTransform],
+        source_device: SourceDevice,
+        destination_device: DestinationDevice,
+    ) -> Optional[Dict[libevdev.EventType, Set[libevdev.EventCode]]]:
+        if not isinstance(source, EvdevUdevSource) or source.event_mask['mode'] == 'off':
+            return None
+        event_types = set(destination_device.consumed_event_types)
+        codes: Set[libevdev.EventCode] = set()
+        for transform in transforms:
+            codes |= transform.input_codes
+        for activator in link.activators:
+            if not isinstance(activator, HotkeyActivator):
+                # unknown input codes
+                return None
+            codes |= {activator.key, *activator.modifiers}
+        for name in source.event_mask['keep']:
+            bit = libevdev.evbit(name)
+            if isinstance(bit, libevdev.EventType):
+                event_types.add(bit)
+            else:
+                codes.add(bit)
+        return {
+            event_type: set(event_codes) if event_type in event_types else {c for c in event_codes if c in codes}
+            for event_type, event_codes in source_device.evbits.items()
+            if event_type != libevdev.EV_SYN
+        }
+
+    def _remove_source_device(
+        self,
+        source_device: SourceDevice,
+        invalidate_destination_devices: bool = False,
+    ):
+        dropped_destination_devices = []
+        with self._lock:
+            if source_device in self._source_devices:
+                self._source_devices.remove(source_device)
+            self._source_device_destination_device_pairs = [
+                (src, dst) for src, dst in self._source_device_destination_device_pairs
+                if src is not source_device
+            ]
+            self._paired_destination_devices = dict(self._source_device_destination_device_pairs)
+            if invalidate_destination_devices:
+                source_names = {
+                    s.name for s in self._config_manager.sources
+                    if s.identifier == source_device.identifier
+                }
+                dropped_destination_devices = [
+                    d for source_name, _, d in self._link_destination_device_cache
+                    if source_name in source_names
+                ]
+                self._link_destination_device_cache = [
+                    entry for entry in self._link_destination_device_cache
+                    if entry[0] not in source_names
+                ]
+        source_device.close()
+        # joins the threads of the devices, outside of the lock
+        for destination_device in dropped_destination_devices:
+            log.debug(f'closing destination device {destination_device}')
+            destination_device.close()
+        self._update_links()
 
     def _get_destination_device(
         self,
         source: Source,
         destination: Destination,
         source_device: SourceDevice,
+        transforms: List[EventTransform],
     ) -> DestinationDevice:
         for source_name, destination_name, destination_device in self._link_destination_device_cache:
             # TODO invalidate cache when updating matching config
@@ -110,28 +432,71 @@ class Hub:
                 log.debug(f'loaded destination device from cache {destination_device}')
                 return destination_device
         if isinstance(destination, UinputDestination):
-            destination_device = UinputDestinationDevice.create(source_device)
+            destination_device = UinputDestinationDevice.create(source_device, {
+                'resample': destination.resample,
+            }, transforms, self._runtime)
         elif isinstance(destination, SubprocessDestination):
-            destination_device = SubprocessDestinationDevice.create(source_device, {'command': destination.command})
+            destination_device = SubprocessDestinationDevice.create(source_device, {
+                'command': destination.command,
+                'ack': destination.ack,
+                'key_repeat': destination.key_repeat,
+                'resample': destination.resample,
+            }, transforms, self._runtime)
         elif isinstance(destination, HidGadgetDestination):
-            destination_device = HidGadgetDestinationDevice.create(source_device)
+            destination_device = HidGadgetDestinationDevice.create(source_device, {
+                'device': destination.device,
+                'poll_interval': destination.poll_interval,
+                'keyboard_report': destination.keyboard_report,
+                'resample': destination.resample,
+            }, transforms, self._runtime)
         else:
             raise NotImplementedError(f'Destination {destination} not implemented')
+        if self._trace_size:
+            destination_device.set_trace(TraceBuffer(f'{source.name} -> {destination.name}', self._trace_size))
         self._link_destination_device_cache.append((source.name, destination.name, destination_device))
         log.debug(f'created destination device {destination_device}')
         return destination_device
 
+    def _get_destination_sender(self, source_device: SourceDevice) -> Optional[DestinationSender]:
+        # on the IPC event loop, which must not wait for the lock that is
+        # held while creating destination devices
+        destination_device = self._paired_destination_devices.get(source_device)
+        if destination_device is None:
+            return None
+        sender = self._destination_senders.get(destination_device)
+        if sender is None:
+            sender = DestinationSender(destination_device, self._runtime)
+            self._destination_senders[destination_device] = sender
+        return sender
+
+    def _get_cached_destination_devices(self) -> Set[DestinationDevice]:
+        with self._lock:
+            return {d for _, _, d in self._link_destination_device_cache}
+
+    def _close_stale_destination_senders(self, destination_devices: Set[DestinationDevice]):
+        # on the IPC event loop, after destination devices were invalidated
+        for destination_device in list(self._destination_senders):
+            if destination_device not in destination_devices:
+                self._destination_senders.pop(destination_device).close()
+
     def _forward_events(self, source_device: SourceDevice):
+        if self._runtime is not None:
+            self._runtime.apply_thread(f'forward {source_device.name}')
         while True:
             destination_device = None
             with self._lock:
-                for src, dst in self._source_device_destination_device_pairs:
-                    if src is source_device:
-                        destination_device = dst
-                        break
+                while destination_device is None:
+                    if source_device not in self._source_devices:
+                        log.info(f'stop forwarding removed device {source_device}')
+                        return
+                    for src, dst in self._source_device_destination_device_pairs:
+                        if src is source_device:
+                            destination_device = dst
+                            break
+                    else:
+                        self._links_updated.wait()
             if destination_device is not None:
                 log.info(f'forward {source_device} {destination_device}')
-                # TODO transforms
                 events_iter = iter(source_device.events())
                 try:
                     first_events = next(events_iter)
@@ -139,22 +504,21 @@ class Hub:
                 except StopIteration:
                     break
                 for events in events_iter:
-                    log.debug(f'forward events {events} from {source_device} to {destination_device}')
+                    log.debug('forward events %s from %s to %s', events, source_device, destination_device)
                     destination_device.send_events(events)
+                    latency = source_device.latency
+                    if latency is not None:
+                        latency.frame_sent()
 
     def _monitor_devices(self):
         for action, udev_device, rule in self._device_monitor.events():
             log.info(f'{action} {udev_device} {rule}')
             if action == 'add':
-                source_device = EvdevSourceDevice.from_udev(udev_device, rule)
-                threading.Thread(target=self._forward_events, args=(source_device,)).start()
-                self._source_devices.append(source_device)
-                self._update_links()
+                self.add_source_device(EvdevSourceDevice.from_udev(udev_device, rule))
             elif action == 'remove':
                 for source_device in self._source_devices:
                     if source_device.identifier == rule:
-                        self._source_devices.remove(source_device)
-                        self._update_links()
+                        self._remove_source_device(source_device)
                         break
 
     def _monitor_config(self):
@@ -179,16 +543,98 @@ class Hub:
                     self._update_links()
 
     def _handle_ipc(self):
-        # TODO thread safe
-        def _handle_events(events: Iterable[Dict]):
-            events_iter = iter(events)
-            first_event = next(events_iter)
-            # TODO filter based on config
-            source_device = UnixSocketSourceDevice.from_ipc(first_event, events_iter)
-            # TODO stop existing thread
-            threading.Thread(target=self._forward_events, args=(source_device,)).start()
+        if self._runtime is not None:
+            self._runtime.apply_thread('ipc')
+        self._ipc_manager.run(self._handle_ipc_streams)
+
+    async def _handle_ipc_streams(self):
+        # all peers are served by the IPC event loop in a single thread
+        tasks: Set[asyncio.Task] = set()
+        async for stream in self._ipc_manager.streams():
+            task = asyncio.create_task(self._handle_ipc_stream(stream))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(self._log_ipc_task_error)
+
+    @staticmethod
+    def _log_ipc_task_error(task: asyncio.Task):
+        # otherwise a failing peer disappears without a trace
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f'ipc stream failed: {task.exception()!r}')
+
+    async def _handle_ipc_stream(self, stream: IpcStream):
+        messages = stream.__aiter__()
+        try:
+            details = await messages.__anext__()
+        except StopAsyncIteration:
+            return
+        loop = asyncio.get_running_loop()
+        # TODO filter based on config
+        identifier = UnixSocketSourceDevice.get_identifier(details)
+        with self._lock:
+            existing_devices = [
+                d for d in self._source_devices
+                if isinstance(d, UnixSocketSourceDevice) and d.identifier == identifier
+            ]
+        source_device = None
+        for existing_device in existing_devices:
+            if (
+                details.get('hash') is not None
+                and existing_device.descriptor_hash == details['hash']
+            ):
+                # reconnect, resume on the existing source device
+                existing_device.rebind(stream)
+                source_device = existing_device
+                log.info(f'ipc source device reconnected {source_device}')
+                break
+            log.info(f'ipc source device descriptor changed {existing_device}')
+            # creating destination devices blocks, keep the event loop running
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self._remove_source_device,
+                    existing_device,
+                    invalidate_destination_devices=True,
+                ),
+            )
+            self._close_stale_destination_senders(
+                await loop.run_in_executor(None, self._get_cached_destination_devices)
+            )
+        if source_device is None:
+            source_device = UnixSocketSourceDevice.from_ipc(details, stream, self._runtime)
             log.info(f'new ipc source device available {source_device}')
-            self._source_devices.append(source_device)
-            self._update_links()
-        for events in self._ipc_manager.events():
-            threading.Thread(target=_handle_events, args=(events,)).start()
+            with self._lock:
+                self._source_devices.append(source_device)
+            await loop.run_in_executor(None, self._update_links)
+        await self._forward_ipc_events(source_device, messages)
+
+    async def _forward_ipc_events(
+        self,
+        source_device: UnixSocketSourceDevice,
+        messages: AsyncIterator[Dict],
+    ):
+        # frames are handed to a sender thread per destination device,
+        # writing to the device would block all peers
+        sender = None
+        async for message in messages:
+            # device descriptor was resent
+            if 'events' not in message:
+                continue
+            if sender is not None and source_device.released:
+                source_device.set_key_repeat_sender(None)
+                for events in source_device.detach():
+                    sender.send_events(events)
+                sender = None
+            if sender is None:
+                sender = self._get_destination_sender(source_device)
+                if sender is None:
+                    continue
+                log.info(f'forward {source_device} {sender}')
+                for events in source_device.attach():
+                    sender.send_events(events)
+                source_device.set_key_repeat_sender(sender.send_events)
+            for events in source_device.handle_message(message):
+                sender.send_events(events, source_device.latency)
+        # the release of a held key may never arrive, a reconnected stream
+        # may already forward to the sender
+        source_device.stop_key_repeat()
@@ -1,29 +1,247 @@
 import socket
 import os
 import contextlib
-import queue
 import threading
+import collections
+import time
+import asyncio
+import hashlib
 from typing import (
-    Iterable,
-    TextIO,
+    AsyncIterator,
+    Awaitable,
+    Callable,
     Dict,
+    Deque,
+    Tuple,
+    Optional,
 )
 import json
 
+from . import log
+
+class DescriptorCache:
+    _MAX_SIZE = 256
+
+    def __init__(self):
+        self._descriptors: collections.OrderedDict[str, Dict] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, descriptor_hash: str) -> Optional[Dict]:
+        with self._lock:
+            descriptor = self._descriptors.get(descriptor_hash)
+            if descriptor is not None:
+                self._descriptors.move_to_end(descriptor_hash)
+            return descriptor
+
+    def put(self, descriptor_hash: str, descriptor: Dict):
+        with self._lock:
+            self._descriptors[descriptor_hash] = descriptor
+            self._descriptors.move_to_end(descriptor_hash)
+            while len(self._descriptors) > self._MAX_SIZE:
+                self._descriptors.popitem(last=False)
+
+class IpcStream:
+    # guard against a peer that never sends a newline
+    _MAX_LINE_LENGTH = 1 << 20
+    _READ_SIZE = 1 << 16
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        descriptor_cache: DescriptorCache,
+    ):
+        self._reader = reader
+        self._writer = writer
+        self._loop = asyncio.get_running_loop()
+        self._descriptor_cache = descriptor_cache
+        self._awaiting_descriptor = False
+        self._ack_interval: Optional[float] = None
+        self._last_ack_time = 0.0
+
+    def __aiter__(self) -> AsyncIterator[Dict]:
+        return self._messages()
+
+    def close(self):
+        # may be called from other threads, the reader sees end of stream
+        self._loop.call_soon_threadsafe(self._writer.close)
+
+    async def _messages(self) -> AsyncIterator[Dict]:
+        # parse every complete line of each read so that bursts of frames
+        # only take one wakeup
+        pending = b''
+        try:
+            while True:
+                chunk = await self._reader.read(self._READ_SIZE)
+                if not chunk:
+                    break
+                *lines, pending = (pending + chunk).split(b'\n')
+                if len(pending) > self._MAX_LINE_LENGTH:
+                    raise ValueError('Line too long')
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    if not isinstance(data, dict):
+                        raise ValueError(f'Invalid message {line[:100]!r}')
+                    if not self._resolve_descriptor(data):
+                        continue
+                    self._handle_ack_request(data)
+                    self._handle_event_formats(data)
+                    yield data
+        except ConnectionError as e:
+            log.info(f'ipc stream closed: {e}')
+        except ValueError as e:
+            log.warning(f'ipc stream closed after an invalid message: {e}')
+        finally:
+            self._writer.close()
+
+    def _resolve_descriptor(self, data: Dict) -> bool:
+        if 'hash' in data:
+            if 'data' in data:
+                # canonical form of the sender, a descriptor cached under a
+                # wrong hash would be used for other devices
+                descriptor_hash = hashlib.sha256(
+                    json.dumps(data['data'], sort_keys=True).encode('utf-8')
+                ).hexdigest()
+                if descriptor_hash != data['hash']:
+                    raise ValueError(f'Descriptor hash mismatch {data["hash"]!r}')
+                self._descriptor_cache.put(data['hash'], data['data'])
+            else:
+                descriptor = self._descriptor_cache.get(data['hash'])
+                if descriptor is None:
+                    self._awaiting_descriptor = True
+                    self._send_message({'resend_details': True})
+                    return False
+                data['data'] = descriptor
+            self._awaiting_descriptor = False
+        # events for an unknown device
+        return not self._awaiting_descriptor
+
+    def _handle_ack_request(self, data: Dict):
+        # device descriptor, acknowledge immediately so that the sender
+        # knows that the protocol is supported
+        if 'data' in data:
+            if data.get('ack') is not None:
+                self._ack_interval = data['ack']['interval']
+                self._send_ack(0)
+        elif self._ack_interval is not None and 'seq' in data:
+            if time.monotonic() - self._last_ack_time >= self._ack_interval:
+                self._send_ack(data['seq'])
+
+    def _handle_event_formats(self, data: Dict):
+        # senders that do not get a reply keep sending one dict per event
+        if 'data' in data and 'flat' in data.get('event_formats', []):
+            self._send_message({'event_format': 'flat'})
+
+    def _send_ack(self, seq: int):
+        self._last_ack_time = time.monotonic()
+        if not self._send_message({'ack': seq, 'time': time.time()}):
+            self._ack_interval = None
+
+    def _send_message(self, data: Dict) -> bool:
+        if self._writer.is_closing():
+            return False
+        self._writer.write(json.dumps(data).encode('utf-8') + b'\n')
+        return True
+
+class AckTracker:
+    # upper bound for frames waiting for an acknowledgement when the peer
+    # stops responding
+    _MAX_UNACKED = 4096
+
+    def __init__(self, interval: float, max_queue_delay: float):
+        self._interval = interval
+        self._max_queue_delay = max_queue_delay
+        self._lock = threading.Lock()
+        # (seq, monotonic send time, wall clock send time)
+        self._unacked: Deque[Tuple[int, float, float]] = collections.deque()
+        self._seq = 0
+        self._acked_seq = 0
+        self._supported = False
+        self._rtt: Optional[float] = None
+        self._min_rtt: Optional[float] = None
+        self._one_way_latency: Optional[float] = None
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    @property
+    def max_queue_delay(self) -> float:
+        return self._max_queue_delay
+
+    @property
+    def congested(self) -> bool:
+        # delay based: RTT growing above the observed minimum means that
+        # frames are queueing somewhere between the hubs
+        rtt, min_rtt = self._rtt, self._min_rtt
+        if not self._supported or rtt is None or min_rtt is None:
+            return False
+        return rtt - min_rtt > self._max_queue_delay
+
+    def next_seq(self) -> int:
+        with self._lock:
+            self._seq += 1
+            self._unacked.append((self._seq, time.monotonic(), time.time()))
+            if len(self._unacked) > self._MAX_UNACKED:
+                self._unacked.popleft()
+            return self._seq
+
+    def handle_ack(self, seq: int, receive_time: float):
+        now = time.monotonic()
+        with self._lock:
+            self._supported = True
+            entry = None
+            while self._unacked and self._unacked[0][0] <= seq:
+                entry = self._unacked.popleft()
+            if entry is None or entry[0] != seq:
+                return
+            _, sent_monotonic, sent_time = entry
+            self._acked_seq = seq
+            self._rtt = now - sent_monotonic
+            if self._min_rtt is None or self._rtt < self._min_rtt:
+                self._min_rtt = self._rtt
+            # only meaningful when the clocks of both hosts are synchronized
+            self._one_way_latency = receive_time - sent_time
+
+    def reset(self):
+        with self._lock:
+            self._unacked.clear()
+            self._acked_seq = self._seq
+            self._supported = False
+            self._rtt = None
+            self._min_rtt = None
+            self._one_way_latency = None
+
+    def to_dict(self) -> Dict:
+        return {
+            'supported': self._supported,
+            'seq': self._seq,
+            'acked_seq': self._acked_seq,
+            'in_flight': self._seq - self._acked_seq,
+            'rtt': self._rtt,
+            'min_rtt': self._min_rtt,
+            'one_way_latency': self._one_way_latency,
+            'congested': self.congested,
+        }
+
 class IpcManager:
+    _BACKLOG = 128
+
     def __init__(self):
-        self._queue: queue.Queue[TextIO] = queue.Queue()
+        self._descriptor_cache = DescriptorCache()
         self._sock = self._get_socket()
-        threading.Thread(target=self._handle_socket).start()
+        self._streams: Optional[asyncio.Queue[IpcStream]] = None
 
-    def events(self) -> Iterable[Iterable[Dict]]:
-        def _events(stream: TextIO):
-            for line in stream:
-                data = json.loads(line)
-                assert isinstance(data, dict)
-                yield data
-        for stream in iter(self._queue.get, None):
-            yield _events(stream)
+    def run(self, main: Callable[[], Awaitable]):
+        # runs the event loop serving all peers in the calling thread
+        asyncio.run(self._run(main))
+
+    async def streams(self) -> AsyncIterator[IpcStream]:
+        assert self._streams is not None
+        while True:
+            yield await self._streams.get()
 
     def _get_socket(self) -> socket.socket:
         # bash: "${XDG_RUNTIME_DIR:-/tmp}/evdev-ipc.sock"
@@ -36,10 +254,19 @@ class IpcManager:
         # restrict access to current user before binding
         os.fchmod(sock.fileno(), 0o600)
         sock.bind(socket_path)
-        sock.listen(1)
+        sock.listen(self._BACKLOG)
         return sock
 
-    def _handle_socket(self):
-        while True:
-            conn, _ = self._sock.accept()
-            self._queue.put(conn.makefile())
+    async def _run(self, main: Callable[[], Awaitable]):
+        self._streams = asyncio.Queue()
+        server = await asyncio.start_unix_server(
+            self._handle_connection,
+            sock=self._sock,
+            backlog=self._BACKLOG,
+        )
+        async with server:
+            await main()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        assert self._streams is not None
+        await self._streams.put(IpcStream(reader, writer, self._descriptor_cache))
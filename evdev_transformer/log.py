@@ -1,41 +1,89 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
 _FORMAT = '{asctime} {name}.{levelname} {filename}:{lineno} ({funcName}) [{threadName}]: {message}'
+# records waiting for the writer thread, newer records are dropped when full
+_QUEUE_SIZE = 10000
 _LOGGER = None
+_LISTENER = None
+_HANDLER = None
+# effective level cached so that disabled calls are a single comparison,
+# everything passes until initialized so that _log can raise
+_LEVEL = logging.NOTSET
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # prepare of the base class formats the message with its arguments when
+    # queued, the caller may change them before the writer thread runs
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped_records = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
 
 def init(logger_name, log_level_name):
-    global _LOGGER
+    global _LOGGER, _LISTENER, _HANDLER
     if _LOGGER is not None:
         raise Exception('Logger is already initialized')
     _LOGGER = logging.getLogger(logger_name)
-    log_level = logging.getLevelName(log_level_name.upper())
-    assert isinstance(log_level, int)
-    _LOGGER.setLevel(log_level)
+    set_level(log_level_name)
 
+    # stdout is written by a separate thread so that a slow terminal or a
+    # full pipe never blocks the input threads
     handler = logging.StreamHandler(stream=sys.stdout)
     formatter = logging.Formatter(fmt=_FORMAT, style='{')
     handler.setFormatter(formatter)
-    _LOGGER.addHandler(handler)
+    queue_: queue.Queue = queue.Queue(_QUEUE_SIZE)
+    _HANDLER = _QueueHandler(queue_)
+    _LOGGER.addHandler(_HANDLER)
+    _LISTENER = logging.handlers.QueueListener(queue_, handler)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
 
-def _log(level, *args, **kwargs):
+def set_level(log_level_name):
+    global _LEVEL
     if _LOGGER is None:
         raise Exception('Logger not initialized')
-    # call _LOGGER.debug(...) etc. and fix stack level to get the correct caller
-    # outside of this log module
-    getattr(_LOGGER, level)(*args, **kwargs, stacklevel=3)
+    log_level = logging.getLevelName(log_level_name.upper())
+    assert isinstance(log_level, int)
+    _LOGGER.setLevel(log_level)
+    _LEVEL = _LOGGER.getEffectiveLevel()
+
+def dropped_records() -> int:
+    # records dropped because the writer thread fell behind
+    return _HANDLER.dropped_records if _HANDLER is not None else 0
+
+def _log(level, msg, args, kwargs):
+    if _LOGGER is None:
+        raise Exception('Logger not initialized')
+    # fix stack level to get the correct caller outside of this log module
+    _LOGGER.log(level, msg, *args, **kwargs, stacklevel=3)
+
+# use %-style arguments instead of f-strings in hot paths, they are only
+# formatted when the level is enabled
 
-def debug(*args, **kwargs):
-    _log('debug', *args, **kwargs)
+def debug(msg, *args, **kwargs):
+    if _LEVEL <= logging.DEBUG:
+        _log(logging.DEBUG, msg, args, kwargs)
 
-def info(*args, **kwargs):
-    _log('info', *args, **kwargs)
+def info(msg, *args, **kwargs):
+    if _LEVEL <= logging.INFO:
+        _log(logging.INFO, msg, args, kwargs)
 
-def warning(*args, **kwargs):
-    _log('warning', *args, **kwargs)
+def warning(msg, *args, **kwargs):
+    if _LEVEL <= logging.WARNING:
+        _log(logging.WARNING, msg, args, kwargs)
 
-def error(*args, **kwargs):
-    _log('error', *args, **kwargs)
+def error(msg, *args, **kwargs):
+    if _LEVEL <= logging.ERROR:
+        _log(logging.ERROR, msg, args, kwargs)
 
-def critical(*args, **kwargs):
-    _log('critical', *args, **kwargs)
+def critical(msg, *args, **kwargs):
+    if _LEVEL <= logging.CRITICAL:
+        _log(logging.CRITICAL, msg, args, kwargs)
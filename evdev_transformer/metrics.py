@@ -0,0 +1,205 @@
+import array
+import threading
+import time
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+class LatencyHistogram:
+    # HDR style buckets: values below 8 are exact, above that every power
+    # of two is split into 8 linear sub-buckets (12.5% relative error)
+    _SUB_BUCKET_BITS = 3
+    _SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+    # up to 2**48 ns, about 78 hours
+    _BUCKETS = _SUB_BUCKETS * 46
+
+    def __init__(self):
+        self._counts = array.array('Q', bytes(8 * self._BUCKETS))
+        self._count = 0
+        self._max = 0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def max(self) -> int:
+        return self._max
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        if value < self._SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - self._SUB_BUCKET_BITS - 1
+            index = (shift + 1) * self._SUB_BUCKETS + (value >> shift) - self._SUB_BUCKETS
+            if index >= self._BUCKETS:
+                index = self._BUCKETS - 1
+        self._counts[index] += 1
+        self._count += 1
+        if value > self._max:
+            self._max = value
+
+    def percentile(self, percentile: float) -> int:
+        if self._count == 0:
+            return 0
+        target = max(1, round(self._count * percentile / 100))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return min(self._get_bucket_middle(index), self._max)
+        return self._max
+
+    def reset(self):
+        self._counts = array.array('Q', bytes(8 * self._BUCKETS))
+        self._count = 0
+        self._max = 0
+
+    def to_dict(self, percentiles: Tuple[float, ...] = (50, 90, 99, 99.9)) -> Dict:
+        return {
+            'count': self._count,
+            'max': self._max,
+            **{f'p{p:g}': self.percentile(p) for p in percentiles},
+        }
+
+    def _get_bucket_middle(self, index: int) -> int:
+        if index < self._SUB_BUCKETS:
+            return index
+        shift = index // self._SUB_BUCKETS - 1
+        lower = (self._SUB_BUCKETS + index % self._SUB_BUCKETS) << shift
+        return lower + (1 << shift) // 2
+
+class LinkLatency:
+    # stages of a frame, all timestamps are CLOCK_REALTIME nanoseconds like
+    # the kernel event timestamps
+    STAGES = [
+        'kernel_to_handle',
+        'handle_to_transformed',
+        'transformed_to_sent',
+        'total',
+    ]
+
+    def __init__(self):
+        self._histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self._kernel_to_handle = self._histograms['kernel_to_handle']
+        self._handle_to_transformed = self._histograms['handle_to_transformed']
+        self._transformed_to_sent = self._histograms['transformed_to_sent']
+        self._total = self._histograms['total']
+        self._kernel_time: Optional[int] = None
+        self._handle_time: Optional[int] = None
+        self._transformed_time: Optional[int] = None
+
+    @property
+    def histograms(self) -> Dict[str, LatencyHistogram]:
+        return self._histograms
+
+    def frame_handled(self, sec: int, usec: int):
+        # events received over IPC carry no kernel timestamp
+        self._kernel_time = sec * 1_000_000_000 + usec * 1_000 if sec else None
+        self._handle_time = time.time_ns()
+
+    def frame_transformed(self):
+        self._transformed_time = time.time_ns()
+
+    def frame_sent(self):
+        frame = self.take_frame()
+        if frame is not None:
+            self.record_frame(frame)
+
+    def take_frame(self) -> Optional[Tuple[Optional[int], int, int]]:
+        # timestamps of the last transformed frame, recorded with
+        # record_frame once it was sent by another thread
+        handle_time = self._handle_time
+        transformed_time = self._transformed_time
+        if handle_time is None or transformed_time is None:
+            return None
+        self._handle_time = None
+        self._transformed_time = None
+        return self._kernel_time, handle_time, transformed_time
+
+    def record_frame(self, frame: Tuple[Optional[int], int, int]):
+        sent_time = time.time_ns()
+        kernel_time, handle_time, transformed_time = frame
+        if kernel_time is not None:
+            self._kernel_to_handle.record(handle_time - kernel_time)
+            self._total.record(sent_time - kernel_time)
+        else:
+            self._total.record(sent_time - handle_time)
+        self._handle_to_transformed.record(transformed_time - handle_time)
+        self._transformed_to_sent.record(sent_time - transformed_time)
+
+    def reset(self):
+        for histogram in self._histograms.values():
+            histogram.reset()
+
+    def to_dict(self) -> Dict:
+        return {stage: h.to_dict() for stage, h in self._histograms.items()}
+
+class Counters:
+    # one array per thread so that the hot path increments without locking,
+    # the shards are only summed when read
+    def __init__(self, names: Iterable[str]):
+        self._names = list(names)
+        self._local = threading.local()
+        self._shards: List[array.array] = []
+        self._lock = threading.Lock()
+
+    def shard(self) -> array.array:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = array.array('Q', bytes(8 * len(self._names)))
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            shards = list(self._shards)
+        totals = [0] * len(self._names)
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return dict(zip(self._names, totals))
+
+# (name, labels, value)
+Sample = Tuple[str, Dict[str, str], Union[int, float]]
+
+def flatten_samples(
+    prefix: str,
+    labels: Dict[str, str],
+    values: Dict,
+) -> Iterable[Sample]:
+    for key, value in values.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict):
+            yield from flatten_samples(name, labels, value)
+        elif isinstance(value, bool):
+            yield name, labels, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, labels, value
+
+def format_samples(samples: Iterable[Sample]) -> str:
+    # prometheus text exposition format
+    lines = []
+    for name, labels, value in samples:
+        if labels:
+            formatted_labels = ','.join(
+                f'{k}="{_escape_label_value(v)}"'
+                for k, v in labels.items()
+            )
+            lines.append(f'{name}{{{formatted_labels}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+    return ''.join(f'{line}\n' for line in lines)
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
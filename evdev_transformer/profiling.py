@@ -0,0 +1,203 @@
+import array
+import time
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import libevdev
+
+from .transform import EventTransform
+from .metrics import LatencyHistogram
+from . import log
+
+class SourceProfile:
+    # event counts by type and code in one preallocated array, time spent in
+    # each transform and activator. Updated by the forwarding thread of the
+    # source without locking.
+    # EV_CNT and KEY_CNT, linux/input-event-codes.h
+    _TYPE_COUNT = 0x20
+    _CODE_COUNT = 0x300
+
+    def __init__(self, transform_names: List[str], activator_names: List[str]):
+        self._event_counts = array.array('Q', bytes(8 * self._TYPE_COUNT * self._CODE_COUNT))
+        self._transform_names = transform_names
+        self._transform_events = array.array('Q', bytes(8 * len(transform_names)))
+        self._transform_ns = array.array('Q', bytes(8 * len(transform_names)))
+        self._activator_names = activator_names
+        self._activator_events = array.array('Q', bytes(8 * len(activator_names)))
+        self._activator_ns = array.array('Q', bytes(8 * len(activator_names)))
+        self._start_time = time.monotonic()
+
+    @property
+    def duration(self) -> float:
+        return time.monotonic() - self._start_time
+
+    @property
+    def transform_names(self) -> List[str]:
+        return self._transform_names
+
+    @property
+    def activator_names(self) -> List[str]:
+        return self._activator_names
+
+    def count_event(self, event: libevdev.InputEvent):
+        self._event_counts[event.type.value * self._CODE_COUNT + event.code.value] += 1
+
+    def add_transform_time(self, index: int, events: int, ns: int):
+        # the forwarding thread may still use the previous transforms after
+        # the profile was restarted for new ones
+        if index < len(self._transform_ns):
+            self._transform_events[index] += events
+            self._transform_ns[index] += ns
+
+    def add_activator_time(self, index: int, ns: int):
+        if index < len(self._activator_ns):
+            self._activator_events[index] += 1
+            self._activator_ns[index] += ns
+
+    def event_counts(self) -> List[Tuple[libevdev.EventCode, int]]:
+        # most frequent first
+        counts = []
+        for i, count in enumerate(self._event_counts):
+            if not count:
+                continue
+            type_, code = divmod(i, self._CODE_COUNT)
+            event_code = libevdev.evbit(type_, code)
+            if event_code is not None:
+                counts.append((event_code, count))
+        counts.sort(key=lambda c: c[1], reverse=True)
+        return counts
+
+    def transform_times(self) -> Iterable[Tuple[str, int, int]]:
+        # name, events, ns
+        return zip(self._transform_names, self._transform_events, self._transform_ns)
+
+    def activator_times(self) -> Iterable[Tuple[str, int, int]]:
+        return zip(self._activator_names, self._activator_events, self._activator_ns)
+
+class TransformStageTiming:
+    # time of the transform at one position of the chain of a source, logs
+    # the events that take longer than the threshold and bypasses the
+    # transform when they keep doing so. Transforms that remove codes are
+    # never bypassed, the destination device does not have the codes they
+    # would let through. Updated by the forwarding thread of the source
+    # without locking.
+    _LOG_INTERVAL = 60.0
+
+    def __init__(self, name: str, threshold_ns: int, bypass_after: int):
+        self._name = name
+        self._threshold_ns = threshold_ns
+        self._bypass_after = bypass_after
+        self._bypassable = True
+        self._histogram = LatencyHistogram()
+        self._slow_events = 0
+        self._consecutive_slow_events = 0
+        self._bypassed = False
+        self._last_log_time: Optional[float] = None
+        self._last_logged_slow_events = 0
+
+    @property
+    def bypassed(self) -> bool:
+        return self._bypassed
+
+    def set_bypassable(self, bypassable: bool):
+        self._bypassable = bypassable
+        if not bypassable:
+            self._bypassed = False
+
+    def stats(self) -> Dict:
+        return {
+            'slow_events': self._slow_events,
+            'bypassed': self._bypassed,
+            'latency_ns': self._histogram.to_dict(),
+        }
+
+    def record(self, event: libevdev.InputEvent, ns: int):
+        self._histogram.record(ns)
+        if ns > self._threshold_ns:
+            self._handle_slow_event(event, ns)
+        else:
+            self._consecutive_slow_events = 0
+
+    def reset(self):
+        self._histogram.reset()
+        self._slow_events = 0
+        self._consecutive_slow_events = 0
+        self._bypassed = False
+        self._last_log_time = None
+        self._last_logged_slow_events = 0
+
+    def _handle_slow_event(self, event: libevdev.InputEvent, ns: int):
+        self._slow_events += 1
+        self._consecutive_slow_events += 1
+        now = time.monotonic()
+        if self._last_log_time is None or now - self._last_log_time >= self._LOG_INTERVAL:
+            log.warning(
+                f'{self._name} took {ns / 1e6:.3f} ms for {event.code.name}, '
+                f'{self._slow_events - self._last_logged_slow_events} events over '
+                f'{self._threshold_ns / 1e6:.3f} ms since the last report'
+            )
+            self._last_log_time = now
+            self._last_logged_slow_events = self._slow_events
+        if self._bypass_after and self._consecutive_slow_events == self._bypass_after:
+            if self._bypassable:
+                self._bypassed = True
+                log.warning(
+                    f'bypassing {self._name} after {self._bypass_after} events over '
+                    f'{self._threshold_ns / 1e6:.3f} ms in a row'
+                )
+            else:
+                log.warning(f'not bypassing {self._name}, it removes codes from the destination device')
+
+class TransformTiming:
+    # transform timing of one source device, kept across link updates and
+    # link switches so that slow transforms stay bypassed. Only reset by the
+    # profile-stop and timing-reset commands.
+    def __init__(self, threshold_ns: int, bypass_after: int):
+        self._threshold_ns = threshold_ns
+        self._bypass_after = bypass_after
+        self._stages: Dict[str, TransformStageTiming] = {}
+
+    @property
+    def threshold_ns(self) -> int:
+        return self._threshold_ns
+
+    @property
+    def bypass_after(self) -> int:
+        return self._bypass_after
+
+    def get_stages(self, transforms: List[EventTransform]) -> List[TransformStageTiming]:
+        # by transform index, the same position and transform type share
+        # the timing with previous transform lists
+        stages = []
+        for i, transform in enumerate(transforms):
+            key = f'{i}:{transform.name}'
+            stage = self._stages.get(key)
+            if stage is None:
+                stage = self._stages[key] = TransformStageTiming(
+                    transform.name,
+                    self._threshold_ns,
+                    self._bypass_after,
+                )
+            stage.set_bypassable(not transform.removed_codes)
+            stages.append(stage)
+        return stages
+
+    def reset(self):
+        for stage in self._stages.values():
+            stage.reset()
+
+def format_profile(name: str, profile: SourceProfile) -> str:
+    lines = [f'{name}: {profile.duration:.1f} s\n', 'events:\n']
+    for event_code, count in profile.event_counts():
+        lines.append(f'  {event_code.type.name} {event_code.name} {count}\n')
+    for title, times in [('transforms', profile.transform_times()), ('activators', profile.activator_times())]:
+        lines.append(f'{title}:\n')
+        for stage_name, events, ns in times:
+            per_event = ns / events if events else 0.0
+            lines.append(f'  {stage_name} {events} events {ns / 1e6:.3f} ms {per_event:.0f} ns/event\n')
+    return ''.join(lines)
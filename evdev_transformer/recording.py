@@ -0,0 +1,152 @@
+import json
+import mmap
+import struct
+import time
+from typing import (
+    Dict,
+    Iterable,
+    Tuple,
+)
+
+import libevdev
+
+# file: magic, descriptor length, JSON descriptor, records until the end
+MAGIC = b'EVDREC\x00\x01'
+_DESCRIPTOR_LENGTH = struct.Struct('<I')
+# struct input_event on 64 bit: sec, usec, type, code, value
+RECORD = struct.Struct('<qqHHi')
+
+class EventRecorder:
+    def __init__(self, path: str, descriptor: Dict):
+        self._path = path
+        self._file = open(path, 'wb')
+        data = json.dumps(descriptor).encode('utf-8')
+        self._file.write(MAGIC + _DESCRIPTOR_LENGTH.pack(len(data)) + data)
+        self._recorded_events = 0
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(path="{self._path}")'
+
+    @property
+    def recorded_events(self) -> int:
+        return self._recorded_events
+
+    def record(self, event: libevdev.InputEvent):
+        sec, usec = event.sec, event.usec
+        # events received over IPC carry no kernel timestamp
+        if not sec:
+            sec, usec = divmod(time.time_ns() // 1000, 1_000_000)
+        try:
+            self._file.write(RECORD.pack(sec, usec, event.type.value, event.code.value, event.value))
+        except ValueError:
+            # closed while the source was still handling an event
+            return
+        self._recorded_events += 1
+
+    def close(self):
+        self._file.close()
+
+class RecordingReader:
+    def __init__(self, path: str):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not an event recording')
+        offset = len(MAGIC)
+        (descriptor_length,) = _DESCRIPTOR_LENGTH.unpack_from(self._mmap, offset)
+        offset += _DESCRIPTOR_LENGTH.size
+        self._details = json.loads(self._mmap[offset:offset + descriptor_length])
+        self._records_offset = offset + descriptor_length
+        # a recording that was not closed cleanly may end with a partial record
+        self._record_count = (len(self._mmap) - self._records_offset) // RECORD.size
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(path="{self._path}")'
+
+    def __len__(self) -> int:
+        return self._record_count
+
+    @property
+    def details(self) -> Dict:
+        return self._details
+
+    def records(self) -> Iterable[Tuple[int, int, int, int, int]]:
+        end = self._records_offset + self._record_count * RECORD.size
+        yield from RECORD.iter_unpack(memoryview(self._mmap)[self._records_offset:end])
+
+    def close(self):
+        self._mmap.close()
+
+def _main():
+    import argparse
+    import collections
+
+    from .device import (
+        EvdevSourceDevice,
+        ReplaySourceDevice,
+    )
+    from . import log
+
+    parser = argparse.ArgumentParser(description='Record and replay evdev events')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help='Record events of an evdev device')
+    record_parser.add_argument('device', type=str, help='/dev/input/eventN')
+    record_parser.add_argument('output', type=str)
+    record_parser.add_argument('--count', type=int, help='Stop after this many events')
+    info_parser = subparsers.add_parser('info', help='Summarize a recording')
+    info_parser.add_argument('recording', type=str)
+    replay_parser = subparsers.add_parser('replay', help='Replay a recording and print the frames')
+    replay_parser.add_argument('recording', type=str)
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help='Replay speed factor, 0 for as fast as possible')
+    args = parser.parse_args()
+    log.init('evdev_recording', 'WARNING')
+
+    if args.command == 'record':
+        # not grabbed, the device keeps working while recording
+        source_device = EvdevSourceDevice(libevdev.Device(open(args.device, 'rb')), {'DEVNAME': args.device})
+        recorder = EventRecorder(args.output, source_device.serialize())
+        source_device.set_recorder(recorder)
+        try:
+            for _ in source_device.events():
+                if args.count is not None and recorder.recorded_events >= args.count:
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+        print(f'recorded {recorder.recorded_events} events to {args.output}')
+    elif args.command == 'info':
+        reader = RecordingReader(args.recording)
+        counts: collections.Counter = collections.Counter()
+        first_time = last_time = None
+        for sec, usec, type_, code, _ in reader.records():
+            timestamp = sec * 1_000_000 + usec
+            if first_time is None:
+                first_time = timestamp
+            last_time = timestamp
+            counts[(type_, code)] += 1
+        duration = (last_time - first_time) / 1_000_000 if first_time is not None else 0.0
+        print(f'device: {reader.details["name"]} {reader.details["id"]}')
+        print(f'events: {len(reader)}, duration: {duration:.3f} s')
+        for (type_, code), count in counts.most_common():
+            event_code = libevdev.evbit(type_, code)
+            print(f'{event_code.name if event_code is not None else (type_, code)}: {count}')
+        reader.close()
+    elif args.command == 'replay':
+        source_device = ReplaySourceDevice.from_recording(args.recording, args.speed)
+        lags = []
+        for events in source_device.events():
+            # event timestamps are the intended replay times
+            lags.append(time.time() - (events[-1].sec + events[-1].usec / 1_000_000))
+            print(' '.join(f'{e.code.name}:{e.value}' for e in events))
+        if lags and args.speed > 0:
+            lags.sort()
+            print(
+                f'frames: {len(lags)}, lag median: {lags[len(lags) // 2] * 1000:.3f} ms, '
+                f'max: {lags[-1] * 1000:.3f} ms'
+            )
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,125 @@
+import os
+import gc
+import ctypes
+import resource
+import threading
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+from . import log
+
+class Runtime:
+    # opt-in scheduling, CPU affinity and memory settings for low latency
+    # forwarding. Everything that fails for lack of permissions is skipped
+    # with a warning, the effective settings are read back from the kernel.
+    # linux/mman.h
+    _MCL_CURRENT = 1
+    _MCL_FUTURE = 2
+    # every page of new thread stacks is locked with MCL_FUTURE
+    _LOCKED_THREAD_STACK_SIZE = 1024 * 1024
+
+    def __init__(self, settings: Dict):
+        self._scheduler = settings.get('scheduler', 'normal')
+        self._priority = settings.get('priority', 10)
+        self._nice = settings.get('nice', -10)
+        self._cpus = settings.get('cpus')
+        self._lock_memory = settings.get('lock_memory', False)
+        self._freeze_gc = settings.get('freeze_gc', False)
+        self._lock = threading.Lock()
+        self._process: Dict = {}
+        self._threads: Dict[str, Tuple[threading.Thread, Dict]] = {}
+
+    @property
+    def effective(self) -> Dict:
+        with self._lock:
+            return {
+                'process': dict(self._process),
+                'threads': {
+                    name: dict(effective)
+                    for name, (thread, effective) in self._threads.items()
+                    if thread.is_alive()
+                },
+            }
+
+    def apply_process(self):
+        # before starting threads, the stack size only applies to new threads
+        memory_locked = 'none'
+        if self._lock_memory:
+            memory_locked = self._lock_process_memory()
+        frozen_objects = 0
+        if self._freeze_gc:
+            # objects that exist at startup are never scanned again, so the
+            # collections that interrupt forwarding only see new objects
+            gc.collect()
+            gc.freeze()
+            frozen_objects = gc.get_freeze_count()
+        with self._lock:
+            self._process = {
+                'memory_locked': memory_locked,
+                'gc_frozen_objects': frozen_objects,
+            }
+        log.info(f'runtime process settings: {self._process}')
+
+    def apply_thread(self, name: str):
+        # for the calling thread only
+        thread_id = threading.get_native_id()
+        if self._scheduler == 'fifo':
+            try:
+                os.sched_setscheduler(thread_id, os.SCHED_FIFO, os.sched_param(self._priority))
+            except OSError as e:
+                # needs CAP_SYS_NICE or RLIMIT_RTPRIO, nice is the fallback
+                log.warning(f'cannot use SCHED_FIFO for {name}: {e}')
+                self._set_nice(thread_id, name)
+        elif self._scheduler == 'nice':
+            self._set_nice(thread_id, name)
+        if self._cpus is not None:
+            try:
+                os.sched_setaffinity(thread_id, self._cpus)
+            except OSError as e:
+                log.warning(f'cannot pin {name} to CPUs {self._cpus}: {e}')
+        effective = self._get_thread_settings(thread_id)
+        with self._lock:
+            self._threads[name] = (threading.current_thread(), effective)
+        log.info(f'runtime settings of {name}: {effective}')
+
+    def _set_nice(self, thread_id: int, name: str):
+        try:
+            os.setpriority(os.PRIO_PROCESS, thread_id, self._nice)
+        except OSError as e:
+            # negative values need CAP_SYS_NICE or RLIMIT_NICE
+            log.warning(f'cannot set nice {self._nice} for {name}: {e}')
+
+    def _lock_process_memory(self) -> str:
+        flags = self._MCL_CURRENT
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+        # with a limit, allocations beyond it would fail with MCL_FUTURE
+        if soft_limit == resource.RLIM_INFINITY or os.geteuid() == 0:
+            flags |= self._MCL_FUTURE
+            threading.stack_size(self._LOCKED_THREAD_STACK_SIZE)
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(flags) != 0:
+            errno = ctypes.get_errno()
+            threading.stack_size(0)
+            log.warning(f'cannot lock memory: {os.strerror(errno)}, limit {soft_limit}')
+            return 'none'
+        return 'all' if flags & self._MCL_FUTURE else 'current'
+
+    @staticmethod
+    def _get_thread_settings(thread_id: int) -> Dict:
+        scheduler = {
+            os.SCHED_OTHER: 'normal',
+            os.SCHED_FIFO: 'fifo',
+            os.SCHED_RR: 'rr',
+            os.SCHED_BATCH: 'batch',
+            os.SCHED_IDLE: 'idle',
+        }.get(os.sched_getscheduler(thread_id), 'unknown')
+        cpus: List[int] = sorted(os.sched_getaffinity(thread_id))
+        return {
+            'scheduler': scheduler,
+            'priority': os.sched_getparam(thread_id).sched_priority,
+            'nice': os.getpriority(os.PRIO_PROCESS, thread_id),
+            'cpus': cpus,
+        }
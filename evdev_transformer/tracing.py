@@ -0,0 +1,94 @@
+import array
+import time
+from typing import (
+    Iterable,
+    List,
+    Tuple,
+)
+
+import libevdev
+
+STAGES = [
+    'source_in',
+    'source_out',
+    'destination_out',
+]
+(
+    SOURCE_IN,
+    SOURCE_OUT,
+    DESTINATION_OUT,
+) = range(len(STAGES))
+
+class TraceBuffer:
+    # last events passing a device, preallocated columns so that recording
+    # does not allocate. Not locked, a dump that races with recording may
+    # contain a few mixed up entries.
+    def __init__(self, name: str, size: int):
+        assert size > 0
+        self._name = name
+        self._size = size
+        self._timestamps = array.array('q', bytes(8 * size))
+        self._stages = array.array('B', bytes(size))
+        self._types = array.array('H', bytes(2 * size))
+        self._codes = array.array('H', bytes(2 * size))
+        self._values = array.array('i', bytes(4 * size))
+        self._next = 0
+        self._count = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def record(self, stage: int, event: libevdev.InputEvent):
+        self._record(time.time_ns(), stage, event)
+
+    def record_frame(self, stage: int, events: List[libevdev.InputEvent]):
+        timestamp = time.time_ns()
+        for event in events:
+            self._record(timestamp, stage, event)
+
+    def _record(self, timestamp: int, stage: int, event: libevdev.InputEvent):
+        i = self._next
+        self._timestamps[i] = timestamp
+        self._stages[i] = stage
+        self._types[i] = event.type.value
+        self._codes[i] = event.code.value
+        self._values[i] = event.value
+        i += 1
+        self._next = 0 if i == self._size else i
+        self._count += 1
+
+    def entries(self) -> Iterable[Tuple[int, int, int, int, int]]:
+        # oldest first
+        count = min(self._count, self._size)
+        start = (self._next - count) % self._size
+        for j in range(count):
+            i = (start + j) % self._size
+            yield (
+                self._timestamps[i],
+                self._stages[i],
+                self._types[i],
+                self._codes[i],
+                self._values[i],
+            )
+
+def format_traces(buffers: Iterable[TraceBuffer]) -> str:
+    # entries of all buffers merged by time, keeping the order of the events
+    # of a frame
+    entries = sorted(
+        (
+            (timestamp, buffer_index, entry_index),
+            (buffer.name, stage, type_, code, value),
+        )
+        for buffer_index, buffer in enumerate(buffers)
+        for entry_index, (timestamp, stage, type_, code, value) in enumerate(buffer.entries())
+    )
+    lines = []
+    for (timestamp, _, _), (name, stage, type_, code, value) in entries:
+        event_code = libevdev.evbit(type_, code)
+        code_name = event_code.name if event_code is not None else str(code)
+        lines.append(
+            f'{timestamp // 1_000_000_000}.{timestamp % 1_000_000_000:09d} '
+            f'[{name}] {STAGES[stage]} {code_name} {value}\n'
+        )
+    return ''.join(lines)
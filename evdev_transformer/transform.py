@@ -1,5 +1,8 @@
 from __future__ import annotations
 from typing import (
+    Dict,
+    List,
+    Optional,
     Set,
     Tuple,
     Callable,
@@ -7,6 +10,7 @@ from typing import (
 )
 import os
 import pydoc
+import time
 
 import libevdev
 
@@ -14,6 +18,8 @@ from .config import (
     Transform,
     KeyRemapTransform,
     ScriptTransform,
+    FilterTransform,
+    TouchpadTransform,
 )
 from . import log
 
@@ -21,7 +27,7 @@ class EventTransform:
     def __init__(
         self,
         input_codes: Set[libevdev.EventCode],
-        # TODO use output_codes to extend destination device codes
+        # added to the destination device codes
         output_codes: Set[libevdev.EventCode],
         transform_event_fn: Callable[[libevdev.InputEvent], Iterable[libevdev.InputEvent]],
     ):
@@ -29,16 +35,45 @@ class EventTransform:
         self._output_codes = output_codes
         self._transform_event_fn = transform_event_fn
 
+    @property
+    def input_codes(self) -> Set[libevdev.EventCode]:
+        return self._input_codes
+
     @property
     def output_codes(self) -> Set[libevdev.EventCode]:
         return self._output_codes
 
+    @property
+    def removed_codes(self) -> Set[libevdev.EventCode]:
+        # codes that never reach the destination device
+        return set()
+
+    @property
+    def removed_input_properties(self) -> Set[libevdev.InputProperty]:
+        return set()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {}
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
     @classmethod
-    def from_config(cls, transform_config: Transform) -> EventTransform:
+    def from_config(
+        cls,
+        transform_config: Transform,
+        absinfo: Dict[libevdev.EventCode, libevdev.InputAbsInfo],
+    ) -> EventTransform:
         if isinstance(transform_config, KeyRemapTransform):
             return KeyRemapEventTransform.from_config(transform_config)
         elif isinstance(transform_config, ScriptTransform):
             return ScriptEventTransform.from_config(transform_config)
+        elif isinstance(transform_config, FilterTransform):
+            return FilterEventTransform.from_config(transform_config)
+        elif isinstance(transform_config, TouchpadTransform):
+            return TouchpadEventTransform.from_config(transform_config, absinfo)
         raise NotImplementedError
 
     def matches_event(self, event: libevdev.InputEvent) -> bool:
@@ -70,3 +105,300 @@ class ScriptEventTransform(EventTransform):
         script = pydoc.importfile(script_path)
         res: Tuple[Set, Set, Callable] = script.run(log)
         return cls(*res)
+
+class FilterEventTransform(EventTransform):
+    # sizeof(struct input_event) on 64 bit, what the kernel would have
+    # copied to the reader and uinput, not the size of IPC frames
+    _EVENT_SIZE = 24
+    _LOG_INTERVAL = 60.0
+    # ABS_CNT, linux/input-event-codes.h
+    _ABS_CNT = 0x40
+
+    def __init__(
+        self,
+        drop_types: Set[libevdev.EventType],
+        drop_codes: Set[libevdev.EventCode],
+        dedup_abs: bool,
+    ):
+        # nothing is produced, and dropped codes must not be requested from
+        # the source
+        super().__init__(set(), set(), self._filter_event)
+        self._drop_types = drop_types
+        self._drop_codes = drop_codes
+        self._dedup_abs = dedup_abs
+        # last value per ABS code, multi touch codes per slot
+        self._abs_values: List[Optional[int]] = [None] * self._ABS_CNT
+        self._mt_values: List[List[Optional[int]]] = []
+        self._slot = 0
+        self._dropped_events = 0
+        self._last_log_time = time.monotonic()
+        self._last_logged_events = 0
+
+    @classmethod
+    def from_config(cls, transform_config: FilterTransform) -> FilterEventTransform:
+        drop_types = set()
+        drop_codes = set()
+        for name in transform_config.drop:
+            bit = libevdev.evbit(name)
+            if isinstance(bit, libevdev.EventType):
+                drop_types.add(bit)
+            else:
+                drop_codes.add(bit)
+        return cls(drop_types, drop_codes, transform_config.dedup_abs)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'dropped_events': self._dropped_events,
+            'dropped_kernel_event_bytes': self._dropped_events * self._EVENT_SIZE,
+        }
+
+    def matches_event(self, event: libevdev.InputEvent) -> bool:
+        return (
+            event.type in self._drop_types
+            or event.code in self._drop_codes
+            or (self._dedup_abs and event.type == libevdev.EV_ABS)
+        )
+
+    def _filter_event(self, event: libevdev.InputEvent) -> Iterable[libevdev.InputEvent]:
+        if not self._should_drop(event):
+            yield event
+            return
+        self._dropped_events += 1
+        now = time.monotonic()
+        if now - self._last_log_time >= self._LOG_INTERVAL:
+            dropped_events = self._dropped_events - self._last_logged_events
+            log.info(
+                f'filter dropped {dropped_events} events '
+                f'({dropped_events * self._EVENT_SIZE} bytes of input_event) in {now - self._last_log_time:.0f} s'
+            )
+            self._last_log_time = now
+            self._last_logged_events = self._dropped_events
+
+    def _should_drop(self, event: libevdev.InputEvent) -> bool:
+        if event.type in self._drop_types or event.code in self._drop_codes:
+            return True
+        return self._is_duplicate_abs(event.code.value, event.value)
+
+    def _is_duplicate_abs(self, code: int, value: int) -> bool:
+        if code == libevdev.EV_ABS.ABS_MT_SLOT.value:
+            # selects the slot of the following events, never dropped
+            self._slot = value
+            return False
+        if code > libevdev.EV_ABS.ABS_MT_SLOT.value and code < self._ABS_CNT:
+            while len(self._mt_values) <= self._slot:
+                self._mt_values.append([None] * self._ABS_CNT)
+            values = self._mt_values[self._slot]
+            if code == libevdev.EV_ABS.ABS_MT_TRACKING_ID.value and value != values[code]:
+                # new contact in the slot, its first values always pass
+                values[:] = [None] * self._ABS_CNT
+        elif code < self._ABS_CNT:
+            values = self._abs_values
+        else:
+            return False
+        if values[code] == value:
+            return True
+        values[code] = value
+        return False
+
+class TouchpadEventTransform(EventTransform):
+    # pointer counts per mm of finger motion at speed 1.0, like a 1000 dpi mouse
+    _COUNTS_PER_MM = 1000 / 25.4
+    # finger motion per wheel detent when scrolling with two fingers
+    _SCROLL_MM_PER_DETENT = 4.0
+    _HI_RES_PER_DETENT = 120
+    # when the device does not report a resolution
+    _DEFAULT_WIDTH_MM = 100.0
+    _REMOVED_INPUT_PROPERTIES = [
+        'INPUT_PROP_POINTER',
+        'INPUT_PROP_BUTTONPAD',
+        'INPUT_PROP_SEMI_MT',
+        'INPUT_PROP_TOPBUTTONPAD',
+    ]
+    # clickpad button by finger count
+    _CLICKFINGER_BUTTONS = {
+        1: libevdev.EV_KEY.BTN_LEFT,
+        2: libevdev.EV_KEY.BTN_RIGHT,
+        3: libevdev.EV_KEY.BTN_MIDDLE,
+    }
+
+    def __init__(
+        self,
+        absinfo: Dict[libevdev.EventCode, libevdev.InputAbsInfo],
+        speed: float,
+        scroll_speed: float,
+        natural_scroll: bool,
+    ):
+        x_units_per_mm = self._get_units_per_mm(absinfo[libevdev.EV_ABS.ABS_MT_POSITION_X])
+        y_units_per_mm = self._get_units_per_mm(absinfo[libevdev.EV_ABS.ABS_MT_POSITION_Y])
+        # precomputed factors from device units to output units
+        self._motion_factor_x = speed * self._COUNTS_PER_MM / x_units_per_mm
+        self._motion_factor_y = speed * self._COUNTS_PER_MM / y_units_per_mm
+        scroll_factor = scroll_speed * self._HI_RES_PER_DETENT / self._SCROLL_MM_PER_DETENT
+        # natural scrolling moves the content with the fingers on both axes,
+        # REL_WHEEL is positive upwards while the touchpad y axis points down
+        scroll_direction = -1 if natural_scroll else 1
+        self._scroll_factor_x = scroll_direction * scroll_factor / x_units_per_mm
+        self._scroll_factor_y = -scroll_direction * scroll_factor / y_units_per_mm
+
+        input_codes = set(absinfo) | {
+            libevdev.EV_KEY.BTN_LEFT,
+            libevdev.EV_KEY.BTN_TOUCH,
+            libevdev.EV_KEY.BTN_TOOL_FINGER,
+            libevdev.EV_KEY.BTN_TOOL_DOUBLETAP,
+            libevdev.EV_KEY.BTN_TOOL_TRIPLETAP,
+            libevdev.EV_KEY.BTN_TOOL_QUADTAP,
+            libevdev.EV_KEY.BTN_TOOL_QUINTTAP,
+            libevdev.EV_SYN.SYN_REPORT,
+        }
+        output_codes = {
+            libevdev.EV_REL.REL_X,
+            libevdev.EV_REL.REL_Y,
+            libevdev.EV_REL.REL_WHEEL,
+            libevdev.EV_REL.REL_HWHEEL,
+            libevdev.EV_REL.REL_WHEEL_HI_RES,
+            libevdev.EV_REL.REL_HWHEEL_HI_RES,
+            *self._CLICKFINGER_BUTTONS.values(),
+            libevdev.EV_SYN.SYN_REPORT,
+        }
+        super().__init__(input_codes, output_codes, self._touchpad_event)
+        self._removed_codes = input_codes - output_codes
+
+        # contact positions by slot, None until reported, e.g. for contacts
+        # restored when a link is attached
+        self._slot = 0
+        self._positions: Dict[int, List[Optional[int]]] = {}
+        self._previous_positions: Dict[int, Tuple[int, int]] = {}
+        self._button: Optional[libevdev.EventCode] = None
+        self._button_value: Optional[int] = None
+        # sub count remainders carried into the next frame
+        self._motion_remainder = [0.0, 0.0]
+        self._scroll_remainder = [0.0, 0.0]
+        self._wheel_remainder = [0.0, 0.0]
+
+    @classmethod
+    def from_config(
+        cls,
+        transform_config: TouchpadTransform,
+        absinfo: Dict[libevdev.EventCode, libevdev.InputAbsInfo],
+    ) -> EventTransform:
+        if not {
+            libevdev.EV_ABS.ABS_MT_SLOT,
+            libevdev.EV_ABS.ABS_MT_POSITION_X,
+            libevdev.EV_ABS.ABS_MT_POSITION_Y,
+        } <= absinfo.keys():
+            # not a multi touch device, e.g. a keyboard on the same link
+            return EventTransform(set(), set(), lambda event: iter(()))
+        return cls(
+            absinfo,
+            transform_config.speed,
+            transform_config.scroll_speed,
+            transform_config.natural_scroll,
+        )
+
+    @property
+    def removed_codes(self) -> Set[libevdev.EventCode]:
+        return self._removed_codes
+
+    @property
+    def removed_input_properties(self) -> Set[libevdev.InputProperty]:
+        return {libevdev.propbit(p) for p in self._REMOVED_INPUT_PROPERTIES}
+
+    def _get_units_per_mm(self, absinfo: libevdev.InputAbsInfo) -> float:
+        if absinfo.resolution:
+            return absinfo.resolution
+        return max(absinfo.maximum - absinfo.minimum, 1) / self._DEFAULT_WIDTH_MM
+
+    def _touchpad_event(self, event: libevdev.InputEvent) -> Iterable[libevdev.InputEvent]:
+        code = event.code
+        if code == libevdev.EV_SYN.SYN_REPORT:
+            yield from self._handle_frame()
+            yield event
+        elif code == libevdev.EV_ABS.ABS_MT_SLOT:
+            self._slot = event.value
+        elif code == libevdev.EV_ABS.ABS_MT_TRACKING_ID:
+            if event.value < 0:
+                self._positions.pop(self._slot, None)
+            else:
+                self._positions.setdefault(self._slot, [None, None])
+        elif code == libevdev.EV_ABS.ABS_MT_POSITION_X:
+            self._positions.setdefault(self._slot, [None, None])[0] = event.value
+        elif code == libevdev.EV_ABS.ABS_MT_POSITION_Y:
+            self._positions.setdefault(self._slot, [None, None])[1] = event.value
+        elif code == libevdev.EV_KEY.BTN_LEFT:
+            self._button_value = event.value
+
+    def _handle_frame(self) -> Iterable[libevdev.InputEvent]:
+        positions = self._positions
+        finger_count = len(positions)
+        previous_positions = self._previous_positions
+        self._previous_positions = {
+            slot: (x, y) for slot, (x, y) in positions.items()
+            if x is not None and y is not None
+        }
+        yield from self._handle_button(finger_count)
+        # no motion when fingers are added or lifted to avoid jumps
+        if finger_count == 0 or positions.keys() != previous_positions.keys():
+            self._scroll_remainder = [0.0, 0.0]
+            self._wheel_remainder = [0.0, 0.0]
+            return
+        dx = sum(positions[s][0] - previous_positions[s][0] for s in positions) / finger_count
+        dy = sum(positions[s][1] - previous_positions[s][1] for s in positions) / finger_count
+        if finger_count == 1:
+            yield from self._relative_events(
+                (libevdev.EV_REL.REL_X, libevdev.EV_REL.REL_Y),
+                self._motion_remainder,
+                dx * self._motion_factor_x,
+                dy * self._motion_factor_y,
+            )
+        elif finger_count == 2:
+            hi_res_x, hi_res_y = self._relative_values(
+                self._scroll_remainder,
+                dx * self._scroll_factor_x,
+                dy * self._scroll_factor_y,
+            )
+            if hi_res_x:
+                yield libevdev.InputEvent(libevdev.EV_REL.REL_HWHEEL_HI_RES, hi_res_x)
+            if hi_res_y:
+                yield libevdev.InputEvent(libevdev.EV_REL.REL_WHEEL_HI_RES, hi_res_y)
+            yield from self._relative_events(
+                (libevdev.EV_REL.REL_HWHEEL, libevdev.EV_REL.REL_WHEEL),
+                self._wheel_remainder,
+                hi_res_x / self._HI_RES_PER_DETENT,
+                hi_res_y / self._HI_RES_PER_DETENT,
+            )
+
+    def _handle_button(self, finger_count: int) -> Iterable[libevdev.InputEvent]:
+        if self._button_value is None:
+            return
+        value = self._button_value
+        self._button_value = None
+        if value and self._button is None:
+            self._button = self._CLICKFINGER_BUTTONS.get(finger_count, libevdev.EV_KEY.BTN_LEFT)
+            yield libevdev.InputEvent(self._button, 1)
+        elif not value and self._button is not None:
+            # release the button that was pressed even if fingers changed
+            yield libevdev.InputEvent(self._button, 0)
+            self._button = None
+
+    def _relative_values(self, remainder: List[float], x: float, y: float) -> Tuple[int, int]:
+        x += remainder[0]
+        y += remainder[1]
+        int_x = int(x)
+        int_y = int(y)
+        remainder[0] = x - int_x
+        remainder[1] = y - int_y
+        return int_x, int_y
+
+    def _relative_events(
+        self,
+        codes: Tuple[libevdev.EventCode, libevdev.EventCode],
+        remainder: List[float],
+        x: float,
+        y: float,
+    ) -> Iterable[libevdev.InputEvent]:
+        int_x, int_y = self._relative_values(remainder, x, y)
+        if int_x:
+            yield libevdev.InputEvent(codes[0], int_x)
+        if int_y:
+            yield libevdev.InputEvent(codes[1], int_y)
@@ -38,7 +38,7 @@ def run(log):
 
     def _transform_event(event: libevdev.InputEvent) -> Iterable[libevdev.InputEvent]:
         for event2 in driver.handle_event(event):
-            log.debug(f'magic_trackpad_driver.py: {event2}')
+            log.debug('magic_trackpad_driver.py: %s', event2)
             yield event2
 
     return input_codes, output_codes, _transform_event
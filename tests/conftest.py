@@ -0,0 +1,4 @@
+from evdev_transformer import log
+
+# the modules log through the package logger, which raises until initialized
+log.init('test', 'WARNING')
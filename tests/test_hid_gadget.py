@@ -0,0 +1,113 @@
+import time
+from typing import List
+
+import pytest
+
+libevdev = pytest.importorskip('libevdev')
+
+from evdev_transformer.device import HidGadgetDestinationDevice
+from evdev_transformer.hid_gadget import HidMouseReportScheduler
+
+_SYN = libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, 0)
+
+def _signed(value: int) -> int:
+    return value - 0x100 if value & 0x80 else value
+
+def _wait_for(predicate, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+def test_mouse_motion_is_clamped_and_carried():
+    reports: List[bytes] = []
+    scheduler = HidMouseReportScheduler(2, reports.append, 0.01)
+    try:
+        scheduler.update(0, 300, -300, 0, 0)
+        _wait_for(lambda: sum(_signed(r[2]) for r in reports) == 300)
+        for report in reports:
+            assert report[0] == 2
+            assert -127 <= _signed(report[2]) <= 127
+            assert -127 <= _signed(report[3]) <= 127
+        assert [_signed(r[2]) for r in reports] == [127, 127, 46]
+        assert [_signed(r[3]) for r in reports] == [-127, -127, -46]
+    finally:
+        scheduler.close()
+
+def test_mouse_button_change_is_not_delayed():
+    reports: List[bytes] = []
+    scheduler = HidMouseReportScheduler(2, reports.append, 60.0)
+    try:
+        scheduler.update(1, 0, 0, 0, 0)
+        scheduler.update(0, 0, 0, 0, 0)
+        assert [r[1] for r in reports] == [1, 0]
+    finally:
+        scheduler.close()
+
+def _create_device(tmp_path, keyboard_report: str) -> (HidGadgetDestinationDevice, str):
+    path = tmp_path / 'hidg0'
+    path.touch()
+    device = HidGadgetDestinationDevice(
+        'test',
+        {'bustype': 0, 'vendor': 0, 'product': 0, 'version': 0},
+        {},
+        {},
+        {},
+        [],
+        {'device': str(path), 'keyboard_report': keyboard_report},
+    )
+    return device, path
+
+def _send_key(device: HidGadgetDestinationDevice, name: str, value: int):
+    device.send_events([libevdev.InputEvent(libevdev.evbit(name), value), _SYN])
+
+def _read_reports(device: HidGadgetDestinationDevice, path, size: int) -> List[bytes]:
+    # the writer thread is joined, all reports are written
+    device.close()
+    data = path.read_bytes()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def test_boot_keyboard_report(tmp_path):
+    device, path = _create_device(tmp_path, 'boot')
+    _send_key(device, 'KEY_LEFTSHIFT', 1)
+    _send_key(device, 'KEY_A', 1)
+    _send_key(device, 'KEY_BACKSLASH', 1)
+    _send_key(device, 'KEY_A', 2)
+    _send_key(device, 'KEY_A', 0)
+    reports = _read_reports(device, path, 9)
+    assert reports == [
+        bytes([0x01, 0x02, 0, 0, 0, 0, 0, 0, 0]),
+        bytes([0x01, 0x02, 0, 0x04, 0, 0, 0, 0, 0]),
+        bytes([0x01, 0x02, 0, 0x04, 0x32, 0, 0, 0, 0]),
+        bytes([0x01, 0x02, 0, 0x32, 0, 0, 0, 0, 0]),
+    ]
+
+def test_boot_keyboard_rollover(tmp_path):
+    device, path = _create_device(tmp_path, 'boot')
+    keys = ['KEY_A', 'KEY_B', 'KEY_C', 'KEY_D', 'KEY_E', 'KEY_F', 'KEY_G']
+    for key in keys:
+        _send_key(device, key, 1)
+    _send_key(device, 'KEY_C', 0)
+    reports = _read_reports(device, path, 9)
+    assert reports[5] == bytes([0x01, 0, 0, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09])
+    # more keys than fit the report
+    assert reports[6] == bytes([0x01, 0, 0]) + bytes([0x01]) * 6
+    assert reports[7] == bytes([0x01, 0, 0, 0x04, 0x05, 0x07, 0x08, 0x09, 0x0a])
+
+def test_nkro_keyboard_report(tmp_path):
+    device, path = _create_device(tmp_path, 'nkro')
+    keys = ['KEY_A', 'KEY_B', 'KEY_C', 'KEY_D', 'KEY_E', 'KEY_F', 'KEY_G']
+    for key in keys:
+        _send_key(device, key, 1)
+    _send_key(device, 'KEY_RIGHTMETA', 1)
+    _send_key(device, 'KEY_A', 0)
+    reports = _read_reports(device, path, 34)
+    assert len(reports) == 9
+    assert all(r[0] == 0x03 and len(r) == 34 for r in reports)
+    pressed = reports[6][2:]
+    # usages 0x04-0x0a
+    assert pressed[0] == 0xf0
+    assert pressed[1] == 0x07
+    assert not any(pressed[2:])
+    assert reports[7][1] == 0x80
+    assert reports[8][2] == 0xe0
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+from evdev_transformer import ipc
+from evdev_transformer.ipc import (
+    AckTracker,
+    DescriptorCache,
+    IpcStream,
+)
+
+class _Writer:
+    def __init__(self):
+        self.messages: List[Dict] = []
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.messages += [json.loads(line) for line in data.splitlines()]
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+def _read(
+    chunks: List[bytes],
+    descriptor_cache: Optional[DescriptorCache] = None,
+) -> (List[Dict], _Writer):
+    async def read():
+        reader = asyncio.StreamReader()
+        for chunk in chunks:
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        stream = IpcStream(reader, writer, descriptor_cache or DescriptorCache())
+        return [message async for message in stream]
+    writer = _Writer()
+    return asyncio.run(read()), writer
+
+def _details(descriptor: Dict, **kwargs) -> Dict:
+    descriptor_hash = hashlib.sha256(json.dumps(descriptor, sort_keys=True).encode('utf-8')).hexdigest()
+    return {'host': 'h', 'vendor': 1, 'product': 2, 'hash': descriptor_hash, 'data': descriptor, **kwargs}
+
+def _line(data: Dict) -> bytes:
+    return json.dumps(data).encode('utf-8') + b'\n'
+
+def test_lines_split_across_reads():
+    messages, writer = _read([b'{"events": [1, 0, 1]}\n{"eve', b'nts": []}\n\n', b'{"events": [2]}'])
+    # the last line has no newline
+    assert messages == [{'events': [1, 0, 1]}, {'events': []}]
+    assert writer.closed
+
+def test_invalid_message_ends_stream():
+    messages, writer = _read([b'{"events": []}\nnot json\n{"events": []}\n'])
+    assert messages == [{'events': []}]
+    assert writer.closed
+    messages, _ = _read([b'[1, 2]\n{"events": []}\n'])
+    assert messages == []
+
+def test_line_too_long_ends_stream():
+    messages, _ = _read([b'{"events": [' + b'0, ' * (IpcStream._MAX_LINE_LENGTH // 3 + 1)])
+    assert messages == []
+
+def test_descriptor_is_cached_by_hash():
+    descriptor_cache = DescriptorCache()
+    details = _details({'name': 'keyboard'})
+    messages, _ = _read([_line(details)], descriptor_cache)
+    assert messages == [details]
+    reconnect = {k: v for k, v in details.items() if k != 'data'}
+    messages, writer = _read([_line(reconnect), b'{"events": []}\n'], descriptor_cache)
+    assert messages == [details, {'events': []}]
+    assert writer.messages == []
+
+def test_unknown_hash_requests_details():
+    details = _details({'name': 'keyboard'})
+    reconnect = {k: v for k, v in details.items() if k != 'data'}
+    messages, writer = _read([_line(reconnect), b'{"events": []}\n', _line(details), b'{"events": [1]}\n'])
+    # events for the unknown device are skipped until the details arrive
+    assert messages == [details, {'events': [1]}]
+    assert writer.messages == [{'resend_details': True}]
+
+def test_hash_mismatch_is_not_cached():
+    descriptor_cache = DescriptorCache()
+    details = {**_details({'name': 'keyboard'}), 'hash': 'wrong'}
+    messages, writer = _read([_line(details), b'{"events": []}\n'], descriptor_cache)
+    assert messages == []
+    assert writer.closed
+    assert descriptor_cache.get('wrong') is None
+
+def test_ack_and_event_format_replies():
+    details = _details({'name': 'mouse'}, ack={'interval': 0.0}, event_formats=['flat'])
+    messages, writer = _read([_line(details), b'{"events": [], "seq": 1}\n'])
+    assert len(messages) == 2
+    assert [m.get('ack') for m in writer.messages if 'ack' in m] == [0, 1]
+    assert {'event_format': 'flat'} in writer.messages
+
+def test_descriptor_cache_evicts_least_recently_used():
+    descriptor_cache = DescriptorCache()
+    for i in range(DescriptorCache._MAX_SIZE):
+        descriptor_cache.put(str(i), {'i': i})
+    assert descriptor_cache.get('0') == {'i': 0}
+    descriptor_cache.put('new', {})
+    assert descriptor_cache.get('0') == {'i': 0}
+    assert descriptor_cache.get('1') is None
+    assert descriptor_cache.get('new') == {}
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_ack_tracker_rtt_and_congestion(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(ipc.time, 'monotonic', clock)
+    tracker = AckTracker(interval=0.1, max_queue_delay=0.02)
+    assert not tracker.congested
+    assert [tracker.next_seq() for _ in range(3)] == [1, 2, 3]
+    clock.now += 0.005
+    tracker.handle_ack(1, 0.0)
+    stats = tracker.to_dict()
+    assert stats['supported']
+    assert stats['in_flight'] == 2
+    assert abs(stats['rtt'] - 0.005) < 1e-9
+    assert not tracker.congested
+    clock.now += 0.05
+    # acknowledges the frames before it as well
+    tracker.handle_ack(3, 0.0)
+    assert tracker.to_dict()['in_flight'] == 0
+    assert abs(tracker.to_dict()['min_rtt'] - 0.005) < 1e-9
+    assert tracker.congested
+
+def test_ack_tracker_ignores_unknown_ack(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(ipc.time, 'monotonic', clock)
+    tracker = AckTracker(interval=0.1, max_queue_delay=0.02)
+    tracker.next_seq()
+    tracker.handle_ack(5, 0.0)
+    assert tracker.to_dict()['rtt'] is None
+    assert tracker.to_dict()['acked_seq'] == 0
+
+def test_ack_tracker_reset():
+    tracker = AckTracker(interval=0.1, max_queue_delay=0.02)
+    for _ in range(AckTracker._MAX_UNACKED + 10):
+        tracker.next_seq()
+    assert len(tracker._unacked) == AckTracker._MAX_UNACKED
+    tracker.handle_ack(tracker.to_dict()['seq'], 0.0)
+    tracker.reset()
+    stats = tracker.to_dict()
+    assert not stats['supported']
+    assert stats['in_flight'] == 0
+    assert stats['rtt'] is None
+    assert not tracker.congested
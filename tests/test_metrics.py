@@ -0,0 +1,48 @@
+from evdev_transformer.metrics import LatencyHistogram
+
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.count == 0
+    assert histogram.percentile(50) == 0
+    assert histogram.percentile(99) == 0
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for value in [1, 2, 3, 4, 5, 6, 7]:
+        histogram.record(value)
+    assert histogram.percentile(0) == 1
+    assert histogram.percentile(50) == 4
+    assert histogram.percentile(100) == 7
+
+def test_percentiles_within_bucket_error():
+    histogram = LatencyHistogram()
+    for value in range(1, 10001):
+        histogram.record(value * 1000)
+    for percentile in [50, 90, 99, 99.9]:
+        expected = percentile / 100 * 10000 * 1000
+        assert abs(histogram.percentile(percentile) - expected) <= expected * 0.125
+    assert histogram.count == 10000
+    assert histogram.max == 10000 * 1000
+
+def test_percentile_is_limited_to_max():
+    histogram = LatencyHistogram()
+    histogram.record(1024)
+    # the middle of the bucket 1024..1151 would be above the value
+    assert histogram.percentile(100) == 1024
+
+def test_negative_and_huge_values():
+    histogram = LatencyHistogram()
+    histogram.record(-5)
+    histogram.record(1 << 60)
+    assert histogram.percentile(0) == 0
+    # counted in the last bucket, the maximum stays exact
+    assert histogram.percentile(100) <= 1 << 60
+    assert histogram.max == 1 << 60
+
+def test_reset():
+    histogram = LatencyHistogram()
+    histogram.record(100)
+    histogram.reset()
+    assert histogram.count == 0
+    assert histogram.max == 0
+    assert histogram.to_dict() == {'count': 0, 'max': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'p99.9': 0}
@@ -0,0 +1,134 @@
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+import pytest
+
+libevdev = pytest.importorskip('libevdev')
+
+from evdev_transformer.config import Transform
+from evdev_transformer.transform import EventTransform
+
+def _event(name: str, value: int) -> libevdev.InputEvent:
+    return libevdev.InputEvent(libevdev.evbit(name), value)
+
+def _create_transform(type_: str, properties: Dict, absinfo: Dict = {}) -> EventTransform:
+    return EventTransform.from_config(Transform.from_dict({'type': type_, 'properties': properties}), absinfo)
+
+def _run(transform: EventTransform, events: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    result = []
+    for name, value in events:
+        event = _event(name, value)
+        if transform.matches_event(event):
+            result += [(e.code.name, e.value) for e in transform.transform_event(event)]
+        else:
+            result.append((name, value))
+    return result
+
+def test_filter_drops_configured_events():
+    transform = _create_transform('filter', {'drop': ['EV_MSC', 'REL_WHEEL_HI_RES']})
+    result = _run(transform, [('MSC_SCAN', 4), ('KEY_A', 1), ('REL_WHEEL_HI_RES', 120), ('REL_WHEEL', 1)])
+    assert result == [('KEY_A', 1), ('REL_WHEEL', 1)]
+    assert transform.stats == {'dropped_events': 2, 'dropped_kernel_event_bytes': 48}
+
+def test_filter_drops_repeated_abs_values():
+    transform = _create_transform('filter', {})
+    result = _run(transform, [('ABS_X', 5), ('ABS_X', 5), ('ABS_Y', 5), ('ABS_X', 6), ('ABS_X', 5)])
+    assert result == [('ABS_X', 5), ('ABS_Y', 5), ('ABS_X', 6), ('ABS_X', 5)]
+    assert transform.stats['dropped_events'] == 1
+
+def test_filter_keeps_abs_values_without_dedup():
+    transform = _create_transform('filter', {'dedup_abs': False})
+    result = _run(transform, [('ABS_X', 5), ('ABS_X', 5)])
+    assert result == [('ABS_X', 5), ('ABS_X', 5)]
+
+def test_filter_dedups_multi_touch_per_slot():
+    transform = _create_transform('filter', {})
+    result = _run(transform, [
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_TRACKING_ID', 1),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_SLOT', 1),
+        ('ABS_MT_TRACKING_ID', 2),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_SLOT', 0),
+    ])
+    # the slot is never dropped, the position only repeats in slot 0
+    assert result == [
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_TRACKING_ID', 1),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_SLOT', 1),
+        ('ABS_MT_TRACKING_ID', 2),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_SLOT', 0),
+    ]
+
+def test_filter_new_tracking_id_resets_slot():
+    transform = _create_transform('filter', {})
+    result = _run(transform, [
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_TRACKING_ID', 1),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_TRACKING_ID', -1),
+        ('ABS_MT_TRACKING_ID', 2),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_POSITION_X', 3),
+    ])
+    # the first position of the new contact passes
+    assert result == [
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_TRACKING_ID', 1),
+        ('ABS_MT_POSITION_X', 3),
+        ('ABS_MT_TRACKING_ID', -1),
+        ('ABS_MT_TRACKING_ID', 2),
+        ('ABS_MT_POSITION_X', 3),
+    ]
+
+def _touchpad_absinfo() -> Dict:
+    E = libevdev.EV_ABS
+    return {
+        E.ABS_MT_SLOT: libevdev.InputAbsInfo(minimum=0, maximum=4, resolution=0),
+        E.ABS_MT_TRACKING_ID: libevdev.InputAbsInfo(minimum=0, maximum=65535, resolution=0),
+        E.ABS_MT_POSITION_X: libevdev.InputAbsInfo(minimum=0, maximum=4000, resolution=40),
+        E.ABS_MT_POSITION_Y: libevdev.InputAbsInfo(minimum=0, maximum=3000, resolution=40),
+        E.ABS_X: libevdev.InputAbsInfo(minimum=0, maximum=4000, resolution=40),
+        E.ABS_Y: libevdev.InputAbsInfo(minimum=0, maximum=3000, resolution=40),
+    }
+
+def _scroll(natural_scroll: bool, dx: int, dy: int) -> Dict[str, int]:
+    transform = _create_transform('touchpad', {'natural_scroll': natural_scroll}, _touchpad_absinfo())
+    def fingers(x: int, y: int) -> List[Tuple[str, int]]:
+        return [
+            ('ABS_MT_SLOT', 0),
+            ('ABS_MT_POSITION_X', x),
+            ('ABS_MT_POSITION_Y', y),
+            ('ABS_MT_SLOT', 1),
+            ('ABS_MT_POSITION_X', x + 400),
+            ('ABS_MT_POSITION_Y', y),
+            ('SYN_REPORT', 0),
+        ]
+    _run(transform, [
+        ('ABS_MT_SLOT', 0),
+        ('ABS_MT_TRACKING_ID', 1),
+        ('ABS_MT_SLOT', 1),
+        ('ABS_MT_TRACKING_ID', 2),
+        *fingers(1000, 1000),
+    ])
+    # two fingers moving by 5 mm
+    result = _run(transform, fingers(1000 + dx, 1000 + dy))
+    return {name: value for name, value in result if name in {'REL_WHEEL', 'REL_HWHEEL'}}
+
+def test_touchpad_scroll_direction():
+    assert _scroll(False, 0, 200) == {'REL_WHEEL': -1}
+    assert _scroll(False, 0, -200) == {'REL_WHEEL': 1}
+    assert _scroll(False, 200, 0) == {'REL_HWHEEL': 1}
+
+def test_touchpad_natural_scroll_direction():
+    assert _scroll(True, 0, 200) == {'REL_WHEEL': 1}
+    assert _scroll(True, 200, 0) == {'REL_HWHEEL': -1}